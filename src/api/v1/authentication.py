@@ -1,32 +1,55 @@
-from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
 from rest_framework import authentication
 from rest_framework import exceptions
 
 from apps.users.models import User
 from apps.users.utils import UserRole
-from core.libs.keycloak import get_keycloak_user_info
+from core.libs.keycloak import aget_keycloak_user_info, get_keycloak_user_info
 
 
 class KeyCloakAuthentication(authentication.BaseAuthentication):
-    def authenticate(self, request):
+
+    @staticmethod
+    def get_token(request) -> str:
         keycloak_token = request.META.get('HTTP_AUTHORIZATION')
         if keycloak_token is None:
             raise exceptions.AuthenticationFailed()
+        return keycloak_token
 
-        user_info = get_keycloak_user_info(keycloak_token)
+    @staticmethod
+    def check_user_info(user_info) -> dict:
         if user_info is None:
             raise exceptions.AuthenticationFailed()
+        return user_info
+
+    @staticmethod
+    def get_new_user_data(user_info: dict) -> dict:
+        """Данные нового пользователя для create_keycloak_user, без роли чата - ошибка аутентификации"""
+        role = UserRole.get_keycloak_user_role(user_info['roles'])
+        if role is None:
+            raise exceptions.AuthenticationFailed()
+        return {'username': user_info['username'], 'role': role, 'name': user_info['name']}
+
+    @staticmethod
+    def get_users():
+        # пользователь создается при первом запросе, на реплике его может еще не быть
+        return User.objects.using(DEFAULT_DB_ALIAS)
 
-        user = User.objects.filter(username=user_info['username']).first()
+    def authenticate(self, request):
+        user_info = self.check_user_info(get_keycloak_user_info(self.get_token(request)))
+        user = self.get_users().filter(username=user_info['username']).first()
         if user is None:
-            role = UserRole.get_keycloak_user_role(user_info['roles'])
-            if role is None:
-                raise exceptions.AuthenticationFailed()
-            user = User.objects.create_keycloak_user(
-                username=user_info['username'],
-                role=role,
-                name=user_info['name']
-            )
+            user = User.objects.create_keycloak_user(**self.get_new_user_data(user_info))
         else:
             user.check_keycloak_update(user_info)
         return user, None
+
+    async def aauthenticate(self, request):
+        """Асинхронная версия authenticate для api.v1.views.AsyncAPIView"""
+        user_info = self.check_user_info(await aget_keycloak_user_info(self.get_token(request)))
+        user = await self.get_users().filter(username=user_info['username']).afirst()
+        if user is None:
+            user = await User.objects.acreate_keycloak_user(**self.get_new_user_data(user_info))
+        else:
+            await user.acheck_keycloak_update(user_info)
+        return user, None
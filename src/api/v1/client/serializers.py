@@ -1,10 +1,10 @@
-from django.conf import settings
-from django.core.validators import FileExtensionValidator
 from rest_framework import serializers
 
+from api.v1.messages import ChatMessageCreateBaseSerializer
+from api.v1.serializers import ChatMessageFileUrlField
 from apps.chat.models import Chat, ChatMessage, ChatMessageFile, ChatTopic
-from apps.chat.utils import ChatStatus, MessageType
-from ws.utils import ws_event_new_chat, ws_event_new_message
+from apps.chat.utils import ChatStatus
+from ws.utils import ws_event_new_chat
 
 
 class TopicListSerializer(serializers.ModelSerializer):
@@ -42,6 +42,8 @@ class ChatTopicSerializer(serializers.ModelSerializer):
 
 
 class ChatMessageFileSerializer(serializers.ModelSerializer):
+    file = ChatMessageFileUrlField()
+
     class Meta:
         model = ChatMessageFile
         fields = (
@@ -89,33 +91,7 @@ class ChatMessageListSerializer(serializers.ModelSerializer):
         return obj.sender_id == self.context['request'].user.pk
 
 
-class ChatMessageCreateSerializer(serializers.ModelSerializer):
-    files = serializers.ListField(
-        child=serializers.FileField(validators=[FileExtensionValidator(settings.CHAT_MESSAGE_ALLOWED_FILE_EXTENSIONS)]),
-        write_only=True,
-        required=False
-    )
-
-    class Meta:
-        model = ChatMessage
-        fields = (
-            'id', 'text', 'message_type', 'files', 'chat'
-        )
-
-    def create(self, validated_data):
-        user = self.context['request'].user
-        files = validated_data.pop('files', [])
-        message = ChatMessage.objects.create(
-            sender=user,
-            **validated_data
-        )
-        for file in files:
-            ChatMessageFile.objects.create(
-                message=message,
-                file=file
-            )
-        ws_event_new_message(message, user, self.context['request'])
-        return message
+class ChatMessageCreateSerializer(ChatMessageCreateBaseSerializer):
 
     def to_representation(self, instance):
         serializer = ChatMessageListSerializer(instance, context=self.context)
@@ -127,16 +103,3 @@ class ChatMessageCreateSerializer(serializers.ModelSerializer):
         if value.status == ChatStatus.CLOSED:
             raise serializers.ValidationError('Чат закрыт')
         return value
-
-    def validate(self, attrs):
-        attrs = super().validate(attrs)
-        if attrs['message_type'] == MessageType.TEXT and not attrs.get('text'):
-            raise serializers.ValidationError({'message_type': 'поле text не должно быть пустым'})
-        if attrs['message_type'] == MessageType.FILE and not attrs.get('files'):
-            raise serializers.ValidationError({'message_type': 'поле files не должно быть пустым'})
-        return attrs
-
-    def validate_files(self, value):
-        if value and max(map(lambda x: x.size, value)) > settings.CHAT_MESSAGE_FILE_MAX_SIZE * 1024 * 1024:
-            raise serializers.ValidationError(f'Максимальный размер файла {settings.CHAT_MESSAGE_FILE_MAX_SIZE} MB')
-        return value
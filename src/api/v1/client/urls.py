@@ -1,12 +1,21 @@
 from django.urls import include, path, re_path
 
 from api.v1.client import views
+from api.v1.views import hot_path_view
 
 urlpatterns = [
     path('topics/', views.TopicListAPIView.as_view()),
-    path('chats/<int:pk>/messages/', views.ChatMessageListAPIView.as_view()),
+    path('bootstrap/', views.BootstrapAPIView.as_view()),
+    path(
+        'chats/<int:pk>/messages/',
+        hot_path_view(views.ChatMessageListAPIView, views.ChatMessageListAsyncAPIView)
+    ),
     path('chats/<int:chat_id>/messages/<int:message_id>/read/', views.ChatMessageReadAPIView.as_view()),
-    path('chats/messages/', views.ChatMessageCreateAPIView.as_view()),
-    path('chats/', views.ChatListCreateAPIView.as_view()),
+    path(
+        'chats/messages/',
+        hot_path_view(views.ChatMessageCreateAPIView, views.ChatMessageCreateAsyncAPIView)
+    ),
+    path('chats/changes/', hot_path_view(views.ChatChangesAPIView, views.ChatChangesAsyncAPIView)),
+    path('chats/', hot_path_view(views.ChatListCreateAPIView, views.ChatListCreateAsyncAPIView)),
 
 ]
@@ -1,5 +1,5 @@
-from django.db.models import Max, Prefetch, Q, Count
-from django.db.models.functions import Coalesce
+from asgiref.sync import sync_to_async
+from django.db.models import Q
 from django_filters.rest_framework import DjangoFilterBackend
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import generics, status, permissions
@@ -12,12 +12,21 @@ from api.v1.client import serializers
 from api.v1.client import swagger_docs
 from api.v1.client.filters import ChatListFilter
 from api.v1.permissions import ClientPermission
-from apps.chat.models import ChatTopic, Chat, ChatMessage
+from api.v1.utils import (
+    AsyncChatChangesMixin, AsyncChatMessageCreateMixin, AsyncChatPageMixin, ChatChangesMixin, ChatPageMixin,
+    ChatsVersionMixin, get_ws_token_data
+)
+from api.v1.views import AsyncGenericAPIView
+from apps.chat.archive import aget_chat_messages, get_chat_messages
+from apps.chat.changes import get_chats_version
+from apps.chat.models import ChatTopic, Chat, ChatMessage, ChatTombstone
+from ws.summary import ws_event_chat_summary_changed
 from ws.utils import ws_read_chat_message
 
 
 class TopicListAPIView(generics.ListAPIView):
     """Список тем"""
+    query_budget = 4
     queryset = ChatTopic.objects.all()
     serializer_class = serializers.TopicListSerializer
     authentication_classes = (KeyCloakAuthentication,)
@@ -26,8 +35,10 @@ class TopicListAPIView(generics.ListAPIView):
     search_fields = ('title', 'description')
 
 
-class ChatListCreateAPIView(generics.ListCreateAPIView):
+class ChatListCreateAPIView(ChatPageMixin, ChatsVersionMixin, generics.ListCreateAPIView):
     """Создание и список чатов"""
+    read_replica = True
+    query_budget = 8
     authentication_classes = (KeyCloakAuthentication,)
     permission_classes = (ClientPermission,)
     filter_backends = (DjangoFilterBackend, OrderingFilter, SearchFilter)
@@ -41,40 +52,100 @@ class ChatListCreateAPIView(generics.ListCreateAPIView):
         return serializers.ChatListSerializer
 
     def get_queryset(self):
+        self.chats_version = get_chats_version()
         queryset = Chat.objects.filter(
             client=self.request.user
         ).select_related(
             'topic',
-        ).prefetch_related(
-            Prefetch('messages', queryset=ChatMessage.objects.prefetch_related('files').order_by('-created_at'),
-                     to_attr='last_messages')
-        ).annotate(
-            last_message_created_at=Coalesce(
-                Max('messages__created_at'), 'created_at'
-            ),
-            unread_messages_count=Count(
-                'messages',
-                filter=Q(Q(messages__is_read=False) & ~Q(messages__sender_id=self.request.user.pk)),
-                distinct=True
-            )
+        ).annotate_messages(
+            self.request.user
         ).order_by('-last_message_created_at')
         return queryset
 
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        ws_event_chat_summary_changed(serializer.instance.pk, self.request.user, self.request)
+
+
+class ChatListCreateAsyncAPIView(AsyncChatPageMixin, AsyncGenericAPIView, ChatListCreateAPIView):
+    """Создание и список чатов, асинхронная версия"""
+
+    async def get(self, request, *args, **kwargs):
+        return await self.alist(request, *args, **kwargs)
+
+    async def post(self, request, *args, **kwargs):
+        return await sync_to_async(self.create)(request, *args, **kwargs)
+
+
+class ChatChangesAPIView(ChatChangesMixin, ChatListCreateAPIView):
+    """
+    Изменения списка чатов после версии since: измененные чаты в формате списка и id удаленных
+    из списка (удалены, не подходят под фильтры). Фильтры - как у списка
+    """
+
+    def get_tombstones(self):
+        return ChatTombstone.objects.filter(client_id=self.request.user.pk)
+
+
+class ChatChangesAsyncAPIView(AsyncChatChangesMixin, AsyncGenericAPIView, ChatChangesAPIView):
+    """Изменения списка чатов, асинхронная версия"""
+
+
+class BootstrapAPIView(ChatListCreateAPIView):
+    """
+    Данные для загрузки страницы клиента одним запросом: темы (topics/, все), первая страница чатов
+    (chats/, те же параметры, без ссылок пагинации) с версией для chats/changes/, наличие уведомлений
+    (lms-crm/notifications/) и токен подключения к вебсокету
+    """
+    query_budget = 9
+    http_method_names = ('get',)
+
+    def get(self, request, *args, **kwargs):
+        # ссылки пагинации вели бы на bootstrap, следующие страницы - chats/ с offset
+        chats = self.list(request, *args, **kwargs).data
+        chats = {'count': chats['count'], 'results': chats['results']}
+        return Response({
+            'topics': serializers.TopicListSerializer(
+                ChatTopic.objects.all(), many=True, context=self.get_serializer_context()
+            ).data,
+            'chats': chats,
+            'chats_version': self.chats_version,
+            'has_notifications': ChatMessage.objects.has_notifications(request.user),
+            **get_ws_token_data(request),
+        })
+
 
 class ChatMessageListAPIView(generics.ListAPIView):
     """"""
+    query_budget = 8
     serializer_class = serializers.ChatMessageListSerializer
     authentication_classes = (KeyCloakAuthentication,)
     permission_classes = (ClientPermission,)
 
-    def get_queryset(self):
-        chat_id = self.kwargs['pk']
-        if not Chat.objects.filter(client=self.request.user, id=chat_id).exists():
+    def get_chat_queryset(self):
+        """Чат клиента из URL, поля для get_chat_messages"""
+        return Chat.objects.filter(
+            client=self.request.user, id=self.kwargs['pk']
+        ).only('id', 'created_at', 'archived_at')
+
+    @staticmethod
+    def check_chat(chat) -> Chat:
+        if chat is None:
             raise NotFound('Чат не найден')
-        queryset = ChatMessage.objects.filter(
-            chat_id=chat_id
-        ).prefetch_related('files')
-        return queryset
+        return chat
+
+    def get_queryset(self):
+        return get_chat_messages(self.check_chat(self.get_chat_queryset().first()))
+
+
+class ChatMessageListAsyncAPIView(AsyncGenericAPIView, ChatMessageListAPIView):
+    """Сообщения чата, асинхронная версия"""
+
+    async def get(self, request, *args, **kwargs):
+        return await self.alist(request, *args, **kwargs)
+
+    async def aget_queryset(self):
+        return await aget_chat_messages(self.check_chat(await self.get_chat_queryset().afirst()))
 
 
 class ChatMessageCreateAPIView(generics.CreateAPIView):
@@ -87,6 +158,18 @@ class ChatMessageCreateAPIView(generics.CreateAPIView):
     def post(self, request, *args, **kwargs):
         return super().post(request, *args, **kwargs)
 
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        ws_event_chat_summary_changed(serializer.instance.chat_id, self.request.user, self.request)
+
+
+class ChatMessageCreateAsyncAPIView(AsyncChatMessageCreateMixin, AsyncGenericAPIView, ChatMessageCreateAPIView):
+    """Создание сообщения в чате, асинхронная версия"""
+
+    @swagger_auto_schema(responses=swagger_docs.CREATE_CHAT_MESSAGE)
+    async def post(self, request, *args, **kwargs):
+        return await self.acreate_message(request)
+
 
 class ChatMessageReadAPIView(generics.GenericAPIView):
     """Отметить сообщения в чате как прочитанные """
@@ -104,8 +187,11 @@ class ChatMessageReadAPIView(generics.GenericAPIView):
     def get(self, request, *args, **kwargs):
         chat = Chat.objects.filter(client_id=self.request.user.pk, id=self.kwargs['chat_id']).first()
         if chat:
-            chat.messages.filter(
+            ChatMessage.objects.of_chat(chat).filter(
                 Q(id__lte=self.kwargs['message_id']) & ~Q(sender_id=self.request.user.pk)
             ).update(is_read=True)
+            chat.read_archived_messages(self.request.user, self.kwargs['message_id'])
+            Chat.objects.filter(pk=chat.pk).mark_changed()
             ws_read_chat_message(chat, self.request.user, self.kwargs['message_id'])
+            ws_event_chat_summary_changed(chat.pk, self.request.user, request)
         return Response(status=status.HTTP_200_OK)
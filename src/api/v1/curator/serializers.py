@@ -1,12 +1,13 @@
-from django.conf import settings
-from django.core.validators import FileExtensionValidator
 from rest_framework import serializers
 
+from api.v1.messages import ChatMessageCreateBaseSerializer
+from api.v1.serializers import ChatMessageFileUrlField
+from apps.chat.changes import add_tombstone
 from apps.chat.models import Chat, ChatMessage, ChatMessageFile, ChatTopic, ChatComment
-from apps.chat.utils import ChatStatus, MessageType
+from apps.chat.utils import ChatStatus
 from apps.users.models import User
 from apps.users.utils import UserRole
-from ws.utils import ws_event_new_chat, ws_event_new_message, ws_update_chat_status, ws_event_update_message
+from ws.utils import ws_event_new_chat, ws_update_chat_status, ws_event_update_message
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -42,14 +43,24 @@ class CuratorChatListTopicSerializer(serializers.ModelSerializer):
 
 
 class CuratorChatUserSerializer(serializers.ModelSerializer):
+    is_online = serializers.SerializerMethodField()
+
     class Meta:
         model = User
         fields = (
             'id', 'is_online', 'username'
         )
 
+    def get_is_online(self, obj) -> bool:
+        online_user_ids = self.context.get('online_user_ids')
+        if online_user_ids is None:
+            return obj.is_online
+        return obj.pk in online_user_ids
+
 
 class CuratorChatMessageFileSerializer(serializers.ModelSerializer):
+    file = ChatMessageFileUrlField()
+
     class Meta:
         model = ChatMessageFile
         fields = (
@@ -117,7 +128,11 @@ class CuratorChatUpdateSerializer(serializers.ModelSerializer):
         }
 
     def update(self, instance, validated_data):
+        topic_id = instance.topic_id
         instance = super().update(instance, validated_data)
+        if instance.topic_id != topic_id:
+            # чат пропадает из списка кураторов прежней темы
+            add_tombstone(instance.pk, instance.client_id, topic_id)
         if 'status' in validated_data:
             ws_update_chat_status(instance, self.context['request'].user)
         return instance
@@ -155,33 +170,7 @@ class CuratorChatMessageUpdateSerializer(serializers.ModelSerializer):
         return instance
 
 
-class CuratorChatMessageCreateSerializer(serializers.ModelSerializer):
-    files = serializers.ListField(
-        child=serializers.FileField(validators=[FileExtensionValidator(settings.CHAT_MESSAGE_ALLOWED_FILE_EXTENSIONS)]),
-        write_only=True,
-        required=False
-    )
-
-    class Meta:
-        model = ChatMessage
-        fields = (
-            'id', 'text', 'message_type', 'files', 'chat'
-        )
-
-    def create(self, validated_data):
-        user = self.context['request'].user
-        files = validated_data.pop('files', [])
-        message = ChatMessage.objects.create(
-            sender=user,
-            **validated_data
-        )
-        for file in files:
-            ChatMessageFile.objects.create(
-                message=message,
-                file=file
-            )
-        ws_event_new_message(message, user, self.context['request'])
-        return message
+class CuratorChatMessageCreateSerializer(ChatMessageCreateBaseSerializer):
 
     def to_representation(self, instance):
         serializer = CuratorChatMessageListSerializer(instance, context=self.context)
@@ -192,19 +181,6 @@ class CuratorChatMessageCreateSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError('Чат закрыт')
         return value
 
-    def validate(self, attrs):
-        attrs = super().validate(attrs)
-        if attrs['message_type'] == MessageType.TEXT and not attrs.get('text'):
-            raise serializers.ValidationError({'message_type': 'поле text не должно быть пустым'})
-        if attrs['message_type'] == MessageType.FILE and not attrs.get('files'):
-            raise serializers.ValidationError({'message_type': 'поле files не должно быть пустым'})
-        return attrs
-
-    def validate_files(self, value):
-        if value and max(map(lambda x: x.size, value)) > settings.CHAT_MESSAGE_FILE_MAX_SIZE * 1024 * 1024:
-            raise serializers.ValidationError(f'Максимальный размер файла {settings.CHAT_MESSAGE_FILE_MAX_SIZE} MB')
-        return value
-
 
 class CuratorChatCommentSerializer(serializers.ModelSerializer):
     curator = UserSerializer()
@@ -1,5 +1,5 @@
-from django.db.models import Max, Prefetch, Q, Count
-from django.db.models.functions import Coalesce
+from asgiref.sync import sync_to_async
+from django.db.models import Q, Count
 from django_filters.rest_framework import DjangoFilterBackend
 from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
@@ -12,9 +12,19 @@ from api.v1.curator import serializers
 from api.v1.curator import swagger_docs
 from api.v1.curator.filters import ChatListFilter
 from api.v1.permissions import CuratorPermission
-from apps.chat.models import ChatTopic, Chat, ChatMessage, ChatComment
+from api.v1.utils import (
+    AsyncChatChangesMixin, AsyncChatMessageCreateMixin, AsyncChatPageMixin, ChatChangesMixin, ChatPageMixin,
+    ChatsVersionMixin, get_ws_token_data
+)
+from api.v1.views import AsyncGenericAPIView
+from apps.chat.archive import aget_chat_messages, get_chat_comments, get_chat_messages
+from apps.chat.changes import get_chats_version
+from apps.chat.topics import aget_user_topic_ids, get_user_topic_ids
+from apps.chat.models import ChatTopic, Chat, ChatMessage, ChatComment, ChatTombstone
 from apps.chat.utils import ChatType
-from core.libs.keycloak import get_keycloak_user_roles
+from apps.users.models import User
+from core.libs.keycloak import aget_keycloak_user_roles, get_keycloak_user_roles
+from ws.summary import ws_event_chat_summary_changed
 from ws.utils import ws_event_assign_curator, ws_update_chat_status, ws_read_chat_message, ws_event_delete_message
 
 
@@ -28,7 +38,7 @@ class ChatInfoAPIView(generics.RetrieveAPIView):
 
     def get_object(self):
         chats_count = Chat.objects.filter(
-            topic__permission__in=get_keycloak_user_roles(self.request.META.get('HTTP_AUTHORIZATION'))
+            topic_id__in=get_user_topic_ids(get_keycloak_user_roles(self.request.META.get('HTTP_AUTHORIZATION')))
         ).aggregate(
             topic_count=Count('id', filter=Q(chat_type=ChatType.TOPIC)),
             order_count=Count('id', filter=Q(chat_type=ChatType.ORDER)),
@@ -40,23 +50,26 @@ class ChatTopicListAPIView(generics.ListAPIView):
     """
     Список тем чатов
     """
+    query_budget = 4
     serializer_class = serializers.CuratorChatTopicListSerializer
     authentication_classes = (KeyCloakAuthentication,)
     permission_classes = (CuratorPermission,)
 
     def get_queryset(self):
         queryset = ChatTopic.objects.filter(
-            permission__in=get_keycloak_user_roles(self.request.META.get('HTTP_AUTHORIZATION'))
+            id__in=get_user_topic_ids(get_keycloak_user_roles(self.request.META.get('HTTP_AUTHORIZATION')))
         ).annotate(
             chat_count=Count('chats')
         )
         return queryset
 
 
-class ChatCreateListAPIView(generics.ListCreateAPIView):
+class ChatCreateListAPIView(ChatPageMixin, ChatsVersionMixin, generics.ListCreateAPIView):
     """
     Список чатов и создание заказа
     """
+    read_replica = True
+    query_budget = 8
     filter_backends = (DjangoFilterBackend, OrderingFilter, SearchFilter)
     search_fields = ('client__name',)
     filterset_class = ChatListFilter
@@ -70,25 +83,112 @@ class ChatCreateListAPIView(generics.ListCreateAPIView):
         return serializers.CuratorChatListSerializer
 
     def get_queryset(self):
+        self.topic_ids = get_user_topic_ids(get_keycloak_user_roles(self.request.META.get('HTTP_AUTHORIZATION')))
+        return self.get_chats(self.topic_ids)
+
+    def get_chats(self, topic_ids: list):
+        self.chats_version = get_chats_version()
         queryset = Chat.objects.filter(
-            topic__permission__in=get_keycloak_user_roles(self.request.META.get('HTTP_AUTHORIZATION'))
+            topic_id__in=topic_ids
         ).select_related(
             'topic', 'client', 'curator'
-        ).prefetch_related(
-            Prefetch('messages', queryset=ChatMessage.objects.prefetch_related('files').order_by('-created_at'),
-                     to_attr='last_messages')
-        ).annotate(
-            last_message_created_at=Coalesce(
-                Max('messages__created_at'), 'created_at'
-            ),
-            unread_messages_count=Count(
-                'messages',
-                filter=Q(Q(messages__is_read=False) & ~Q(messages__sender_id=self.request.user.pk)),
-                distinct=True
-            )
+        ).annotate_messages(
+            self.request.user
         ).order_by('-last_message_created_at')
         return queryset
 
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        ws_event_chat_summary_changed(serializer.instance.pk, self.request.user, self.request)
+
+
+class AsyncChatListMixin(AsyncChatPageMixin):
+    """
+    Асинхронная загрузка списка чатов куратора (ChatCreateListAPIView.get_chats) для списка и дельты списка:
+    темы куратора и онлайн-статус клиентов и кураторов страницы одним запросом в кэш
+    """
+
+    async def aget_queryset(self):
+        self.topic_ids = await aget_user_topic_ids(
+            await aget_keycloak_user_roles(self.request.META.get('HTTP_AUTHORIZATION'))
+        )
+        return self.get_chats(self.topic_ids)
+
+    async def aattach_chats(self, chats: list) -> None:
+        await super().aattach_chats(chats)
+        self.online_user_ids = await User.objects.aget_online_ids(
+            {user_id for chat in chats for user_id in (chat.client_id, chat.curator_id) if user_id}
+        )
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if hasattr(self, 'online_user_ids'):
+            context['online_user_ids'] = self.online_user_ids
+        return context
+
+
+class ChatCreateListAsyncAPIView(AsyncChatListMixin, AsyncGenericAPIView, ChatCreateListAPIView):
+    """
+    Список чатов и создание заказа, асинхронная версия
+    """
+
+    async def get(self, request, *args, **kwargs):
+        return await self.alist(request, *args, **kwargs)
+
+    async def post(self, request, *args, **kwargs):
+        return await sync_to_async(self.create)(request, *args, **kwargs)
+
+
+class ChatChangesAPIView(ChatChangesMixin, ChatCreateListAPIView):
+    """
+    Изменения списка чатов после версии since: измененные чаты в формате списка и id удаленных
+    из списка (удалены, перенесены в другую тему, не подходят под фильтры). Фильтры - как у списка
+    """
+
+    def get_tombstones(self):
+        return ChatTombstone.objects.filter(topic_id__in=self.topic_ids)
+
+
+class ChatChangesAsyncAPIView(AsyncChatChangesMixin, AsyncChatListMixin, AsyncGenericAPIView, ChatChangesAPIView):
+    """Изменения списка чатов, асинхронная версия"""
+
+
+class BootstrapAPIView(ChatCreateListAPIView):
+    """
+    Данные для загрузки страницы куратора одним запросом: количество обращений и заказов (chats/info/),
+    темы (chats/topics/, все), первая страница чатов (chats/, те же параметры, без ссылок пагинации)
+    с версией для chats/changes/, наличие уведомлений (lms-crm/notifications/) и токен подключения к вебсокету
+    """
+    query_budget = 10
+    http_method_names = ('get',)
+
+    def get_queryset(self):
+        return self.get_chats(self.topic_ids)
+
+    def get(self, request, *args, **kwargs):
+        self.topic_ids = get_user_topic_ids(get_keycloak_user_roles(self.request.META.get('HTTP_AUTHORIZATION')))
+        counts = Chat.objects.filter(topic_id__in=self.topic_ids).count_by_topic_and_type()
+        topics = list(ChatTopic.objects.filter(id__in=self.topic_ids))
+        for topic in topics:
+            topic.chat_count = sum(count for (topic_id, _), count in counts.items() if topic_id == topic.pk)
+        info = {
+            'topic_count': sum(count for (_, chat_type), count in counts.items() if chat_type == ChatType.TOPIC),
+            'order_count': sum(count for (_, chat_type), count in counts.items() if chat_type == ChatType.ORDER),
+        }
+        # ссылки пагинации вели бы на bootstrap, следующие страницы - chats/ с offset
+        chats = self.list(request, *args, **kwargs).data
+        chats = {'count': chats['count'], 'results': chats['results']}
+        return Response({
+            'info': serializers.CuratorChatInfoSerializer(info).data,
+            'topics': serializers.CuratorChatTopicListSerializer(
+                topics, many=True, context=self.get_serializer_context()
+            ).data,
+            'chats': chats,
+            'chats_version': self.chats_version,
+            'has_notifications': ChatMessage.objects.has_notifications(request.user),
+            **get_ws_token_data(request),
+        })
+
 
 class ChatMessageReadAPIView(generics.GenericAPIView):
     """Отметить сообщения в чате как прочитанные """
@@ -106,13 +206,15 @@ class ChatMessageReadAPIView(generics.GenericAPIView):
     def get(self, request, *args, **kwargs):
         chat = Chat.objects.filter(id=self.kwargs['chat_id']).first()
         if chat:
-            ChatMessage.objects.filter(
-                Q(chat_id=self.kwargs['chat_id']) &
+            ChatMessage.objects.of_chat(chat).filter(
                 Q(id__lte=self.kwargs['message_id']) &
                 ~Q(sender_id=self.request.user.pk)
 
             ).update(is_read=True)
+            chat.read_archived_messages(self.request.user, self.kwargs['message_id'])
+            Chat.objects.filter(pk=chat.pk).mark_changed()
             ws_read_chat_message(chat, self.request.user, self.kwargs['message_id'])
+            ws_event_chat_summary_changed(chat.pk, self.request.user, request)
         return Response(status=status.HTTP_200_OK)
 
 
@@ -125,14 +227,16 @@ class ChatCommentCreateAPIView(generics.CreateAPIView):
 
 class ChatCommentListAPIView(generics.ListAPIView):
     """Создание и список комментариев к чату"""
+    query_budget = 6
     serializer_class = serializers.CuratorChatCommentSerializer
     authentication_classes = (KeyCloakAuthentication,)
     permission_classes = (CuratorPermission,)
 
     def get_queryset(self):
-        return ChatComment.objects.filter(
-            chat_id=self.kwargs['pk']
-        ).select_related('curator')
+        chat = Chat.objects.filter(id=self.kwargs['pk']).only('id', 'archived_at').first()
+        if chat is None:
+            return ChatComment.objects.none()
+        return get_chat_comments(chat)
 
 
 class ChatCommentUpdateDeleteAPIView(generics.RetrieveUpdateDestroyAPIView):
@@ -157,6 +261,7 @@ class ChatCloseAPIView(generics.GenericAPIView):
         chat = self.get_object()
         chat.close_chat()
         ws_update_chat_status(chat, self.request.user)
+        ws_event_chat_summary_changed(chat.pk, self.request.user, request)
         return Response(status=status.HTTP_200_OK)
 
     def get_queryset(self):
@@ -172,9 +277,13 @@ class ChatUpdateAPIView(generics.UpdateAPIView):
 
     def get_queryset(self):
         return Chat.objects.filter(
-            topic__permission__in=get_keycloak_user_roles(self.request.META.get('HTTP_AUTHORIZATION'))
+            topic_id__in=get_user_topic_ids(get_keycloak_user_roles(self.request.META.get('HTTP_AUTHORIZATION')))
         )
 
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        ws_event_chat_summary_changed(serializer.instance.pk, self.request.user, self.request)
+
 
 class ChatAssignCuratorAPIView(generics.GenericAPIView):
     """Назначить куратора"""
@@ -189,20 +298,39 @@ class ChatAssignCuratorAPIView(generics.GenericAPIView):
         chat: Chat = serializer.validated_data['chat']
         chat.assign_curator(serializer.validated_data['curator'])
         ws_event_assign_curator(chat, self.request.user)
+        ws_event_chat_summary_changed(chat.pk, self.request.user, request)
         return Response(status=status.HTTP_200_OK)
 
 
 class ChatMessageListAPIView(generics.ListAPIView):
     """Сообщения в чата"""
+    query_budget = 8
     serializer_class = serializers.CuratorChatMessageListSerializer
     authentication_classes = (KeyCloakAuthentication,)
     permission_classes = (CuratorPermission,)
 
+    def get_chat_queryset(self):
+        """Чат из URL, поля для get_chat_messages"""
+        return Chat.objects.filter(id=self.kwargs['pk']).only('id', 'created_at', 'archived_at')
+
     def get_queryset(self):
-        queryset = ChatMessage.objects.filter(
-            chat_id=self.kwargs['pk']
-        ).prefetch_related('files')
-        return queryset
+        chat = self.get_chat_queryset().first()
+        if chat is None:
+            return ChatMessage.objects.none()
+        return get_chat_messages(chat)
+
+
+class ChatMessageListAsyncAPIView(AsyncGenericAPIView, ChatMessageListAPIView):
+    """Сообщения в чата, асинхронная версия"""
+
+    async def get(self, request, *args, **kwargs):
+        return await self.alist(request, *args, **kwargs)
+
+    async def aget_queryset(self):
+        chat = await self.get_chat_queryset().afirst()
+        if chat is None:
+            return ChatMessage.objects.none()
+        return await aget_chat_messages(chat)
 
 
 class ChatMessageUpdateDeleteAPIView(generics.RetrieveUpdateDestroyAPIView):
@@ -215,11 +343,17 @@ class ChatMessageUpdateDeleteAPIView(generics.RetrieveUpdateDestroyAPIView):
     def get_queryset(self):
         return ChatMessage.objects.all()
 
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        ws_event_chat_summary_changed(serializer.instance.chat_id, self.request.user, self.request)
+
     def perform_destroy(self, instance):
         chat = instance.chat
         message_id = instance.id
         instance.delete()
+        Chat.objects.filter(pk=chat.pk).mark_changed()
         ws_event_delete_message(self.request.user, chat, message_id, chat.client_id)
+        ws_event_chat_summary_changed(chat.pk, self.request.user, self.request)
 
 
 class ChatMessageCreateAPIView(generics.CreateAPIView):
@@ -231,3 +365,15 @@ class ChatMessageCreateAPIView(generics.CreateAPIView):
     @swagger_auto_schema(responses=swagger_docs.CREATE_CHAT_MESSAGE)
     def post(self, request, *args, **kwargs):
         return super().post(request, *args, **kwargs)
+
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        ws_event_chat_summary_changed(serializer.instance.chat_id, self.request.user, self.request)
+
+
+class ChatMessageCreateAsyncAPIView(AsyncChatMessageCreateMixin, AsyncGenericAPIView, ChatMessageCreateAPIView):
+    """Создание сообщения в чате, асинхронная версия"""
+
+    @swagger_auto_schema(responses=swagger_docs.CREATE_CHAT_MESSAGE)
+    async def post(self, request, *args, **kwargs):
+        return await self.acreate_message(request)
@@ -0,0 +1,9 @@
+from django.urls import path
+
+from api.v1.files import views
+
+urlpatterns = [
+    path('<int:pk>/', views.ChatMessageFileAPIView.as_view(), name='chat-message-file'),
+    path('archive/<int:chat_id>/<int:pk>/', views.ArchivedChatMessageFileAPIView.as_view(),
+         name='archived-chat-message-file'),
+]
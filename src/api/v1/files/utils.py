@@ -0,0 +1,53 @@
+import mimetypes
+import os
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_cache_control
+from django.utils.http import content_disposition_header, parse_etags
+
+from apps.chat.models import ChatMessageFile
+
+
+def etag_matches(etag: str, if_none_match: str) -> bool:
+    """
+    Проверка If-None-Match: список тегов через запятую или *, теги сравниваются слабо (без W/)
+    :param etag: ETag файла
+    :param if_none_match: значение заголовка If-None-Match
+    :return: bool - у клиента актуальная копия, ответ 304
+    """
+    etags = parse_etags(if_none_match)
+    if etags == ['*']:
+        return True
+    return etag in (tag.removeprefix('W/') for tag in etags)
+
+
+def get_file_response(request, message_file: ChatMessageFile) -> HttpResponse:
+    """
+    Ответ с файлом сообщения.
+    В production байты отдает nginx (X-Accel-Redirect), он же обрабатывает Range запросы
+    и добавляет Accept-Ranges, в development файл отдается целиком через FileResponse
+    :param request: HttpRequest
+    :param message_file: ChatMessageFile - файл сообщения
+    :return: HttpResponse
+    """
+    etag = f'"{message_file.sha256}"' if message_file.sha256 else None
+    if etag and etag_matches(etag, request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+    else:
+        filename = message_file.name or os.path.basename(message_file.file.name)
+        content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        if settings.MEDIA_X_ACCEL_REDIRECT:
+            response = HttpResponse(content_type=content_type)
+            response['X-Accel-Redirect'] = f'{settings.MEDIA_X_ACCEL_REDIRECT_LOCATION}{quote(message_file.file.name)}'
+        else:
+            response = FileResponse(message_file.file.open('rb'), content_type=content_type)
+        response['Content-Disposition'] = content_disposition_header(False, filename)
+
+    if etag:
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, max_age=settings.CHAT_MESSAGE_FILE_CACHE_TIMEOUT, immutable=True)
+    else:
+        patch_cache_control(response, private=True, no_cache=True)
+    return response
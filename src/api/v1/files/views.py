@@ -0,0 +1,58 @@
+from django.db.models import Q
+from django.http import Http404
+from django.shortcuts import get_object_or_404
+from rest_framework import generics, permissions
+
+from api.v1.authentication import KeyCloakAuthentication
+from api.v1.files.utils import get_file_response
+from apps.chat.archive import get_archived_message_file
+from apps.chat.models import Chat, ChatMessageFile
+from apps.chat.topics import get_user_topic_ids
+from apps.users.utils import UserRole
+from core.libs.keycloak import get_keycloak_user_roles
+
+
+class ChatMemberMixin:
+
+    def get_chats(self):
+        """Чаты, файлы которых доступны пользователю: клиенту - его чаты, куратору - чаты его тем
+        (как в списке чатов куратора) и назначенные ему"""
+        user = self.request.user
+        if user.role == UserRole.CLIENT:
+            return Chat.objects.filter(client_id=user.pk)
+        if user.role == UserRole.CURATOR:
+            return Chat.objects.filter(
+                Q(topic_id__in=get_user_topic_ids(get_keycloak_user_roles(self.request.META.get('HTTP_AUTHORIZATION')))) |
+                Q(curator_id=user.pk)
+            )
+        return Chat.objects.none()
+
+
+class ChatMessageFileAPIView(ChatMemberMixin, generics.RetrieveAPIView):
+    """
+    Файл сообщения, доступен только участникам чата.
+    Сами байты отдает nginx через X-Accel-Redirect
+    """
+    authentication_classes = (KeyCloakAuthentication,)
+    permission_classes = (permissions.IsAuthenticated,)
+    pagination_class = None
+
+    def get_queryset(self):
+        return ChatMessageFile.objects.filter(message__chat__in=self.get_chats())
+
+    def retrieve(self, request, *args, **kwargs):
+        return get_file_response(request, self.get_object())
+
+
+class ArchivedChatMessageFileAPIView(ChatMemberMixin, generics.GenericAPIView):
+    """Файл сообщения архивного чата"""
+    authentication_classes = (KeyCloakAuthentication,)
+    permission_classes = (permissions.IsAuthenticated,)
+    pagination_class = None
+
+    def get(self, request, *args, **kwargs):
+        chat = get_object_or_404(self.get_chats(), pk=self.kwargs['chat_id'], archived_at__isnull=False)
+        message_file = get_archived_message_file(chat, self.kwargs['pk'])
+        if message_file is None:
+            raise Http404
+        return get_file_response(request, message_file)
@@ -17,25 +17,21 @@ from apps.users.utils import UserRole
 
 class UserNotificationAPIView(generics.GenericAPIView):
     """Уведомления пользователя"""
+    query_budget = 5
     serializer_class = serializers.UserNotificationSerializer
     pagination_class = None
     authentication_classes = (KeyCloakAuthentication,)
     permission_classes = (permissions.IsAuthenticated,)
 
     def get(self, request, *args, **kwargs):
-        user = self.request.user
-        if user.role == UserRole.CURATOR:
-            q = Q(chat__curator_id=user.pk)
-        else:
-            q = Q(chat__client_id=user.pk)
-        has_notifications = ChatMessage.objects.filter(
-            Q(is_read=False) & ~Q(sender_id=self.request.user.pk) & q
-        ).exists()
+        has_notifications = ChatMessage.objects.has_notifications(self.request.user)
         return Response(data={'has_notifications': has_notifications}, status=status.HTTP_200_OK)
 
 
 class TopicsPopularityAPIView(generics.ListAPIView):
     """Наиболее популярные темы"""
+    read_replica = True
+    query_budget = 5
     serializer_class = serializers.TopicsPopularitySerializer
     authentication_classes = (KeyCloakAuthentication,)
     permission_classes = (permissions.IsAuthenticated,)
@@ -69,6 +65,8 @@ class TopicsPopularityAPIView(generics.ListAPIView):
 
 class ChatsAvgResolutionTimeAPIView(generics.GenericAPIView):
     """Среднее время разрешения тем"""
+    read_replica = True
+    query_budget = 5
     serializer_class = serializers.ChatsAvgResolutionTimeSerializer
     pagination_class = None
     authentication_classes = (KeyCloakAuthentication,)
@@ -98,6 +96,8 @@ class ChatsAvgResolutionTimeAPIView(generics.GenericAPIView):
 
 class TopicsAvgResolutionTimeAPIView(generics.ListAPIView):
     """Время разрешения по темам"""
+    read_replica = True
+    query_budget = 5
     serializer_class = serializers.TopicsAvgResolutionTimeSerializer
     authentication_classes = (KeyCloakAuthentication,)
     permission_classes = (permissions.IsAuthenticated,)
@@ -130,6 +130,8 @@ class TopicsAvgResolutionTimeAPIView(generics.ListAPIView):
 
 class ClosedChatPercentageAPIView(generics.GenericAPIView):
     """Процент решенных тикетов"""
+    read_replica = True
+    query_budget = 5
     serializer_class = serializers.ClosedChatPercentageSerializer
     pagination_class = None
     authentication_classes = (KeyCloakAuthentication,)
@@ -161,6 +163,8 @@ class ClosedChatPercentageAPIView(generics.GenericAPIView):
 
 class ClosedChatPercentageForTopicAPIView(generics.ListAPIView):
     """Процент решенных тикетов по каждой теме"""
+    read_replica = True
+    query_budget = 5
     serializer_class = serializers.ClosedChatPercentageForTopicSerializer
     authentication_classes = (KeyCloakAuthentication,)
     permission_classes = (permissions.IsAuthenticated,)
@@ -188,6 +192,8 @@ class ClosedChatPercentageForTopicAPIView(generics.ListAPIView):
 
 class CuratorChatsAPIView(generics.ListAPIView):
     """ Количество тикетов по менеджерам"""
+    read_replica = True
+    query_budget = 5
     serializer_class = serializers.CuratorChatsSerializer
     authentication_classes = (KeyCloakAuthentication,)
     permission_classes = (permissions.IsAuthenticated,)
@@ -214,6 +220,8 @@ class CuratorChatsAPIView(generics.ListAPIView):
 
 class CuratorChatsAvgTimeAPIView(generics.ListAPIView):
     """ Cреднее время разрешения тикетов для каждого менеджера."""
+    read_replica = True
+    query_budget = 5
     serializer_class = serializers.CuratorChatsAvgTimeSerializer
     authentication_classes = (KeyCloakAuthentication,)
     permission_classes = (permissions.IsAuthenticated,)
@@ -0,0 +1,74 @@
+"""
+Создание сообщений, общее для API клиента и куратора. Отдельно от api.v1.serializers:
+события WS (ws.utils) импортируют ws.serializers, а они - api.v1.serializers
+"""
+from django.conf import settings
+from django.core.validators import FileExtensionValidator
+from rest_framework import serializers
+
+from api.v1.serializers import PreloadedPrimaryKeyRelatedField
+from apps.chat.models import ChatMessage, ChatMessageFile
+from apps.chat.utils import MessageType
+from ws.utils import aws_event_new_message, ws_event_new_message
+
+
+class ChatMessageCreateBaseSerializer(serializers.ModelSerializer):
+    """
+    Создание сообщения клиентом или куратором: create для синхронных view, acreate для асинхронных.
+    Проверка чата (validate_chat) и ответ (to_representation) - в сериализаторах клиента и куратора
+    """
+    files = serializers.ListField(
+        child=serializers.FileField(validators=[FileExtensionValidator(settings.CHAT_MESSAGE_ALLOWED_FILE_EXTENSIONS)]),
+        write_only=True,
+        required=False
+    )
+
+    serializer_related_field = PreloadedPrimaryKeyRelatedField
+
+    class Meta:
+        model = ChatMessage
+        fields = (
+            'id', 'text', 'message_type', 'files', 'chat'
+        )
+
+    def create(self, validated_data):
+        user = self.context['request'].user
+        files = validated_data.pop('files', [])
+        message = ChatMessage.objects.create(
+            sender=user,
+            **validated_data
+        )
+        for file in files:
+            ChatMessageFile.objects.create(
+                message=message,
+                file=file
+            )
+        ws_event_new_message(message, user, self.context['request'])
+        return message
+
+    async def acreate(self, validated_data):
+        """Создание сообщения из асинхронной view, chat загружен view вместе с topic"""
+        user = self.context['request'].user
+        files = validated_data.pop('files', [])
+        message = await ChatMessage.objects.acreate(
+            sender=user,
+            **validated_data
+        )
+        message._prefetched_objects_cache = {'files': [
+            await ChatMessageFile.objects.acreate(message=message, file=file) for file in files
+        ]}
+        await aws_event_new_message(message, user, self.context['request'])
+        return message
+
+    def validate(self, attrs):
+        attrs = super().validate(attrs)
+        if attrs['message_type'] == MessageType.TEXT and not attrs.get('text'):
+            raise serializers.ValidationError({'message_type': 'поле text не должно быть пустым'})
+        if attrs['message_type'] == MessageType.FILE and not attrs.get('files'):
+            raise serializers.ValidationError({'message_type': 'поле files не должно быть пустым'})
+        return attrs
+
+    def validate_files(self, value):
+        if value and max(map(lambda x: x.size, value)) > settings.CHAT_MESSAGE_FILE_MAX_SIZE * 1024 * 1024:
+            raise serializers.ValidationError(f'Максимальный размер файла {settings.CHAT_MESSAGE_FILE_MAX_SIZE} MB')
+        return value
@@ -0,0 +1,27 @@
+from django.db.models import QuerySet
+from rest_framework.pagination import LimitOffsetPagination
+
+
+class AsyncLimitOffsetPagination(LimitOffsetPagination):
+    """LimitOffsetPagination для асинхронных view: count и выборка страницы через async ORM"""
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+
+        if isinstance(queryset, QuerySet):
+            self.count = await queryset.acount()
+        else:
+            self.count = len(queryset)
+        self.offset = self.get_offset(request)
+        if self.count > self.limit and self.template is not None:
+            self.display_page_controls = True
+
+        if self.count == 0 or self.offset > self.count:
+            return []
+        page = queryset[self.offset:self.offset + self.limit]
+        if isinstance(page, QuerySet):
+            return [obj async for obj in page]
+        return list(page)
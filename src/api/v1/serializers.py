@@ -0,0 +1,41 @@
+from django.urls import reverse
+from rest_framework import serializers
+
+
+class ChatMessageFileUrlField(serializers.Field):
+    """Ссылка на файл сообщения через авторизованный эндпоинт, а не MEDIA_URL"""
+
+    def __init__(self, **kwargs):
+        kwargs['source'] = '*'
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, value) -> str:
+        archived_chat_id = getattr(value, 'archived_chat_id', None)
+        if archived_chat_id is not None:
+            url = reverse('archived-chat-message-file', kwargs={'chat_id': archived_chat_id, 'pk': value.pk})
+        else:
+            url = reverse('chat-message-file', kwargs={'pk': value.pk})
+        request = self.context.get('request', None)
+        if request is not None:
+            return request.build_absolute_uri(url)
+        return url
+
+
+class PreloadedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    PrimaryKeyRelatedField с целочисленным ключом без запроса в БД: если view уже загрузила
+    объект и передала его в context под именем поля (асинхронные view), берется он
+    """
+
+    def to_internal_value(self, data):
+        if self.field_name not in self.context:
+            return super().to_internal_value(data)
+        instance = self.context[self.field_name]
+        if instance is not None and str(instance.pk) == str(data):
+            return instance
+        try:
+            int(data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        self.fail('does_not_exist', pk_value=data)
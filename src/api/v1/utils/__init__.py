@@ -0,0 +1,180 @@
+from typing import Optional
+
+from django.conf import settings
+from drf_yasg import openapi
+from drf_yasg.utils import swagger_auto_schema
+from rest_framework import status
+from rest_framework.response import Response
+
+from apps.chat.changes import CHATS_VERSION_HEADER, get_chats_version, parse_chats_version
+from apps.chat.models import Chat, ChatMessage, ChatTombstone
+from apps.chat.topics import get_permission_topics, get_user_topic_permissions
+from core.libs.keycloak import get_keycloak_user_roles
+from ws.auth import create_ws_token
+from ws.summary import aws_event_chat_summary_changed
+
+CHANGES_SINCE_PARAMETER = openapi.Parameter(
+    'since', openapi.IN_QUERY, type=openapi.TYPE_STRING, required=True,
+    description='Версия из заголовка X-Chats-Version списка чатов или из version прошлого ответа'
+)
+
+
+async def aget_message_chat(chat_id) -> Optional[Chat]:
+    """
+    Чат для создания сообщения в асинхронной view, с темой для ws события
+    :param chat_id: значение поля chat из данных запроса
+    :return: Chat or None
+    """
+    try:
+        chat_id = int(chat_id)
+    except (TypeError, ValueError):
+        return None
+    return await Chat.objects.select_related('topic').filter(pk=chat_id).afirst()
+
+
+class AsyncChatMessageCreateMixin:
+    """
+    Создание сообщения в асинхронной view: чат загружается с темой одним запросом и передается сериализатору
+    (PreloadedPrimaryKeyRelatedField), сообщение создается через acreate сериализатора
+    """
+
+    async def acreate_message(self, request) -> Response:
+        chat = await aget_message_chat(request.data.get('chat'))
+        serializer = self.get_serializer(data=request.data, context={**self.get_serializer_context(), 'chat': chat})
+        serializer.is_valid(raise_exception=True)
+        serializer.instance = await serializer.acreate(serializer.validated_data)
+        await aws_event_chat_summary_changed(chat.pk, request.user, request)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+def get_ws_token_data(request) -> dict:
+    """
+    Токен подключения к вебсокету для ответа bootstrap: ws://{domain}/connect/?ws_token={ws_token}
+    :param request: запрос, аутентифицированный KeyCloakAuthentication
+    :return: {'ws_token': str, 'ws_token_expires_in': int}
+    """
+    roles = get_keycloak_user_roles(request.META.get('HTTP_AUTHORIZATION'))
+    return {
+        'ws_token': create_ws_token(request.user.pk, get_user_topic_permissions(roles, get_permission_topics())),
+        'ws_token_expires_in': settings.WS_TOKEN_MAX_AGE_SECONDS,
+    }
+
+
+class ChatsVersionMixin:
+    """
+    Список чатов с версией для ChatChangesMixin в заголовке X-Chats-Version,
+    версию ставит get_queryset до чтения списка
+    """
+    chats_version = None
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if self.chats_version is not None:
+            response[CHATS_VERSION_HEADER] = self.chats_version
+        return response
+
+
+class ChatPageMixin:
+    """
+    Загрузка данных страницы чатов (последние сообщения) одним запросом на страницу,
+    attach_chats используется и для чатов дельты списка (ChatChangesMixin)
+    """
+
+    def attach_chats(self, chats: list) -> None:
+        ChatMessage.objects.attach_last_messages(chats)
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        if page is not None:
+            self.attach_chats(page)
+        return page
+
+
+class AsyncChatPageMixin:
+    """ChatPageMixin для AsyncGenericAPIView"""
+
+    async def aattach_chats(self, chats: list) -> None:
+        await ChatMessage.objects.aattach_last_messages(chats)
+
+    async def apaginate_queryset(self, queryset):
+        page = await super().apaginate_queryset(queryset)
+        if page is not None:
+            await self.aattach_chats(page)
+        return page
+
+
+class ChatChangesMixin:
+    """
+    Дельта списка чатов (apps/chat/changes.py) поверх view списка: чаты из get_queryset, измененные после
+    версии since, в формате списка и id чатов, убранных из списка - удаленных (get_tombstones) или
+    больше не подходящих под фильтры запроса. Запросы в БД - по измененным чатам, а не по всему списку.
+    Ответ: {"version": str, "reset": bool, "changed": [...], "removed": [id, ...]},
+    reset - версия устарела или изменений больше CHAT_CHANGES_MAX_SIZE, список нужно загрузить заново
+    """
+    http_method_names = ('get',)
+    pagination_class = None
+
+    def get_tombstones(self):
+        """ChatTombstone чатов, убранных из списка пользователя, по умолчанию - нет удаленных"""
+        return ChatTombstone.objects.none()
+
+    @staticmethod
+    def get_changed_ids(queryset, since):
+        """id измененных чатов, на один больше CHAT_CHANGES_MAX_SIZE - для проверки переполнения"""
+        return queryset.filter(summary_changed_at__gt=since).order_by().values_list('id', flat=True)[
+            :settings.CHAT_CHANGES_MAX_SIZE + 1
+        ]
+
+    def get_removed_ids(self, since):
+        return self.get_tombstones().filter(created_at__gt=since).values_list('chat_id', flat=True)
+
+    @swagger_auto_schema(manual_parameters=[CHANGES_SINCE_PARAMETER])
+    def get(self, request, *args, **kwargs):
+        version = get_chats_version()
+        since = parse_chats_version(request.query_params.get('since'))
+        if since is None:
+            return self.get_reset_response(version)
+        queryset = self.get_queryset()
+        changed_ids = list(self.get_changed_ids(queryset, since))
+        if len(changed_ids) > settings.CHAT_CHANGES_MAX_SIZE:
+            return self.get_reset_response(version)
+        chats = []
+        if changed_ids:
+            chats = list(self.filter_queryset(queryset).filter(id__in=changed_ids))
+            self.attach_chats(chats)
+        return self.get_changes_response(version, chats, changed_ids, set(self.get_removed_ids(since)))
+
+    def get_changes_response(self, version: str, chats: list, changed_ids: list, removed_ids: set) -> Response:
+        removed_ids = (removed_ids | set(changed_ids)) - {chat.pk for chat in chats}
+        return Response({
+            'version': version,
+            'reset': False,
+            'changed': self.get_serializer(chats, many=True).data,
+            'removed': sorted(removed_ids),
+        })
+
+    @staticmethod
+    def get_reset_response(version: str) -> Response:
+        return Response({'version': version, 'reset': True, 'changed': [], 'removed': []})
+
+
+class AsyncChatChangesMixin(AsyncChatPageMixin, ChatChangesMixin):
+    """ChatChangesMixin для AsyncGenericAPIView, запросы те же"""
+
+    @swagger_auto_schema(manual_parameters=[CHANGES_SINCE_PARAMETER])
+    async def get(self, request, *args, **kwargs):
+        version = get_chats_version()
+        since = parse_chats_version(request.query_params.get('since'))
+        if since is None:
+            return self.get_reset_response(version)
+        queryset = await self.aget_queryset()
+        changed_ids = [chat_id async for chat_id in self.get_changed_ids(queryset, since)]
+        if len(changed_ids) > settings.CHAT_CHANGES_MAX_SIZE:
+            return self.get_reset_response(version)
+        chats = []
+        if changed_ids:
+            queryset = await self.afilter_queryset(queryset)
+            chats = [chat async for chat in queryset.filter(id__in=changed_ids)]
+            await self.aattach_chats(chats)
+        removed_ids = {chat_id async for chat_id in self.get_removed_ids(since)}
+        return self.get_changes_response(version, chats, changed_ids, removed_ids)
@@ -1,2 +1,111 @@
+import asyncio
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import QuerySet
+from rest_framework import exceptions, generics
+from rest_framework.response import Response
+from rest_framework.views import APIView
 
+from api.v1.pagination import AsyncLimitOffsetPagination
+
+
+class AsyncAPIView(APIView):
+    """
+    APIView с асинхронными обработчиками методов. Аутентификация через aauthenticate
+    аутентификаторов, проверки прав и сериализация те же, что в APIView
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await self.ainitial(request, *args, **kwargs)
+
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(self, request.method.lower(), self.http_method_not_allowed)
+            else:
+                handler = self.http_method_not_allowed
+
+            response = handler(request, *args, **kwargs)
+            if asyncio.iscoroutine(response):
+                response = await response
+
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
+
+    async def ainitial(self, request, *args, **kwargs):
+        self.format_kwarg = self.get_format_suffix(**kwargs)
+
+        neg = self.perform_content_negotiation(request)
+        request.accepted_renderer, request.accepted_media_type = neg
+
+        version, scheme = self.determine_version(request, *args, **kwargs)
+        request.version, request.versioning_scheme = version, scheme
+
+        await self.aperform_authentication(request)
+        self.check_permissions(request)
+        self.check_throttles(request)
+
+    async def aperform_authentication(self, request):
+        for authenticator in request.authenticators:
+            try:
+                user_auth_tuple = await authenticator.aauthenticate(request)
+            except exceptions.APIException:
+                request._not_authenticated()
+                raise
+
+            if user_auth_tuple is not None:
+                request._authenticator = authenticator
+                request.user, request.auth = user_auth_tuple
+                return
+
+        request._not_authenticated()
+
+
+class AsyncGenericAPIView(AsyncAPIView, generics.GenericAPIView):
+    pagination_class = AsyncLimitOffsetPagination
+
+    async def aget_queryset(self):
+        return self.get_queryset()
+
+    async def afilter_queryset(self, queryset):
+        if not self.filter_backends:
+            return queryset
+        # DjangoFilterBackend проверяет значения фильтров запросами в БД
+        return await sync_to_async(self.filter_queryset)(queryset)
+
+    async def apaginate_queryset(self, queryset):
+        if self.paginator is None:
+            return None
+        return await self.paginator.apaginate_queryset(queryset, self.request, view=self)
+
+    async def alist(self, request, *args, **kwargs):
+        queryset = await self.afilter_queryset(await self.aget_queryset())
+
+        page = await self.apaginate_queryset(queryset)
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+
+        if isinstance(queryset, QuerySet):
+            queryset = [obj async for obj in queryset]
+        serializer = self.get_serializer(queryset, many=True)
+        return Response(serializer.data)
+
+
+def hot_path_view(sync_view_class, async_view_class):
+    """
+    View нагруженного эндпоинта: асинхронная версия в ASGI процессе (API_ASYNC_VIEWS),
+    синхронная в gunicorn с sync воркерами
+    """
+    if settings.API_ASYNC_VIEWS:
+        return async_view_class.as_view()
+    return sync_view_class.as_view()
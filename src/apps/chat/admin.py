@@ -1,9 +1,30 @@
 from django.contrib import admin
 
-from apps.chat.models import ChatTopic
+from apps.chat.models import Chat, ChatTopic
 
 
 @admin.register(ChatTopic)
 class ChatTopicAdmin(admin.ModelAdmin):
     list_display = ('title', 'created_at', 'updated_at')
     search_fields = ('title', 'description')
+
+    # чаты темы удаляются пачками до каскадного удаления темы, которое загрузило бы все сообщения разом;
+    # delete_view выполняет удаление одной транзакцией admin
+    def delete_model(self, request, obj):
+        Chat.objects.delete_batched(obj.chats.values_list('id', flat=True))
+        super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        Chat.objects.delete_batched(Chat.objects.filter(topic__in=queryset).values_list('id', flat=True))
+        super().delete_queryset(request, queryset)
+
+    def get_deleted_objects(self, objs, request):
+        # сообщения чатов тем не загружаются для страницы подтверждения, только количество чатов
+        perms_needed = set()
+        if not request.user.has_perm('chat.delete_chat'):
+            perms_needed.add(Chat._meta.verbose_name)
+        model_count = {
+            ChatTopic._meta.verbose_name_plural: len(objs),
+            Chat._meta.verbose_name_plural: Chat.objects.filter(topic__in=objs).count(),
+        }
+        return [str(obj) for obj in objs], model_count, perms_needed, []
@@ -0,0 +1,303 @@
+"""
+Холодный архив закрытых чатов: сообщения, файлы сообщений и комментарии чата
+переносятся в сжатый JSON (chats/<chat_id>.json.gz), строка Chat остается в БД.
+Чат после архивации можно открыть снова: новые сообщения хранятся в БД и читаются вместе с архивом,
+при следующей архивации дописываются в архив
+"""
+import gzip
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models import Count
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import LazyObject, empty
+
+from apps.chat.models import Chat, ChatComment, ChatFile, ChatMessage, ChatMessageFile
+from apps.users.models import User
+
+
+class ArchiveStorage(LazyObject):
+    def _setup(self):
+        self._wrapped = FileSystemStorage(location=settings.CHAT_ARCHIVE_ROOT)
+
+
+archive_storage = ArchiveStorage()
+
+# разобранные архивы процесса: путь -> (версия файла, данные), страницы сообщений архивного чата
+# не распаковывают архив заново
+_archive_cache = OrderedDict()
+_archive_cache_lock = threading.Lock()
+
+
+@receiver(setting_changed)
+def reset_archive_storage(setting, **kwargs):
+    # новый CHAT_ARCHIVE_ROOT в тестах (override_settings)
+    if setting == 'CHAT_ARCHIVE_ROOT':
+        archive_storage._wrapped = empty
+        with _archive_cache_lock:
+            _archive_cache.clear()
+
+
+def get_archive_name(chat_id: int) -> str:
+    return f'chats/{chat_id}.json.gz'
+
+
+def _merge_rows(archived: list, rows: list) -> list:
+    """Строки архива и БД по id, строка из БД заменяет строку архива (прерванная архивация)"""
+    merged = {row['id']: row for row in archived}
+    merged.update((row['id'], row) for row in json.loads(json.dumps(rows, cls=DjangoJSONEncoder)))
+    return sorted(merged.values(), key=lambda row: (row['created_at'], row['id']))
+
+
+def dump_chat(chat: Chat, archived: Optional[dict] = None) -> dict:
+    """
+    Вернет данные чата для архива: сообщения и комментарии из БД, дописанные к предыдущему архиву
+    :param chat: Chat
+    :param archived: предыдущий архив чата (load_chat_archive)
+    :return: dict
+    """
+    archived = archived or {'messages': [], 'comments': []}
+    messages = ChatMessage.objects.of_chat(chat).prefetch_related('files').order_by('created_at')
+    return {
+        'chat_id': chat.pk,
+        'messages': _merge_rows(archived['messages'], [
+            {
+                'id': message.pk,
+                'sender_id': message.sender_id,
+                'text': message.text,
+                'message_type': message.message_type,
+                'is_read': message.is_read,
+                'created_at': message.created_at,
+                'updated_at': message.updated_at,
+                'files': [
+                    {
+                        'id': message_file.pk,
+                        'file': message_file.file.name,
+                        'name': message_file.name,
+                        'sha256': message_file.sha256,
+                        'created_at': message_file.created_at,
+                    }
+                    for message_file in message.files.all()
+                ],
+            }
+            for message in messages.iterator(chunk_size=settings.CHAT_DELETE_BATCH_SIZE)
+        ]),
+        'comments': _merge_rows(archived['comments'], list(
+            ChatComment.objects.filter(chat=chat).order_by('created_at').values(
+                'id', 'curator_id', 'text', 'created_at', 'updated_at'
+            )
+        )),
+    }
+
+
+def load_chat_archive(chat_id: int) -> Optional[dict]:
+    """
+    Вернет данные чата из архива. Разобранный архив кэшируется в процессе (CHAT_ARCHIVE_CACHE_SIZE архивов)
+    до замены файла, возвращаемые данные общие для всех вызовов и не изменяются
+    :param chat_id: int
+    :return: dict or None
+    """
+    path = archive_storage.path(get_archive_name(chat_id))
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    # write_chat_archive заменяет файл целиком (os.replace), новый файл - новая версия
+    version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    with _archive_cache_lock:
+        item = _archive_cache.get(path)
+        if item is not None and item[0] == version:
+            _archive_cache.move_to_end(path)
+            return item[1]
+    with open(path, 'rb') as f:
+        data = json.loads(gzip.decompress(f.read()))
+    with _archive_cache_lock:
+        _archive_cache[path] = (version, data)
+        _archive_cache.move_to_end(path)
+        while len(_archive_cache) > settings.CHAT_ARCHIVE_CACHE_SIZE:
+            _archive_cache.popitem(last=False)
+    return data
+
+
+def write_chat_archive(chat: Chat) -> dict:
+    """
+    Запись архива чата: предыдущий архив и строки из БД. Файл архива заменяется только после
+    записи нового целиком
+    :param chat: Chat
+    :return: dict - записанные данные
+    """
+    data = dump_chat(chat, load_chat_archive(chat.pk))
+    name = get_archive_name(chat.pk)
+    tmp_name = f'{name}.tmp'
+    archive_storage.delete(tmp_name)
+    archive_storage.save(tmp_name, ContentFile(gzip.compress(json.dumps(data, cls=DjangoJSONEncoder).encode())))
+    os.replace(archive_storage.path(tmp_name), archive_storage.path(name))
+    return data
+
+
+def purge_chat(chat: Chat, data: dict, batch_size: int) -> None:
+    """
+    Удаление из БД сообщений и комментариев, записанных в архив data. Строки, которых нет в архиве
+    (добавлены после записи), остаются. Ссылки файлов сообщений на ChatFile переходят к архиву:
+    счетчик увеличивается за архив в той же транзакции, в которой файл сообщения удаляется
+    и освобождает свою ссылку (ChatFile.objects.release). Так же в Chat.archived_unread переходят
+    непрочитанные: каждое непрочитанное сообщение считается либо в БД, либо в архиве
+    :param chat: Chat
+    :param data: данные write_chat_archive
+    :param batch_size: int - сообщений за одну транзакцию
+    :return: None
+    """
+    archived_ids = {message['id'] for message in data['messages']}
+    message_ids = [
+        message_id for message_id in ChatMessage.objects.of_chat(chat).values_list('id', flat=True)
+        if message_id in archived_ids
+    ]
+    for start in range(0, len(message_ids), batch_size):
+        batch = message_ids[start:start + batch_size]
+        with transaction.atomic():
+            ChatFile.objects.retain(
+                ChatMessageFile.objects.filter(message_id__in=batch).exclude(sha256='').values_list('sha256', flat=True)
+            )
+            unread_by_sender = dict(
+                ChatMessage.objects.filter(id__in=batch, chat_id=chat.pk, is_read=False).order_by().values_list(
+                    'sender_id'
+                ).annotate(count=Count('id'))
+            )
+            if unread_by_sender:
+                chat.add_archived_unread(unread_by_sender)
+            ChatMessage.objects.filter(id__in=batch, chat_id=chat.pk).delete()
+    ChatComment.objects.filter(chat=chat, id__in=[comment['id'] for comment in data['comments']]).delete()
+
+
+def archive_chat(chat: Chat, batch_size: Optional[int] = None) -> None:
+    """
+    Перенос чата в архив. Сначала записывается архив и ставятся archived_at и archived_last_message, затем сообщения
+    удаляются из БД пачками. Повторная архивация (прерванная или после нового открытия чата)
+    дописывает строки из БД к архиву
+    :param chat: Chat - закрытый чат
+    :param batch_size: int - сообщений за одну транзакцию
+    :return: None
+    """
+    data = write_chat_archive(chat)
+    # строка в списке чатов не меняется, summary_changed_at остается: прерванная архивация продолжится.
+    # Последнее сообщение для списка чатов сохраняется до удаления сообщений из БД
+    chat.archived_at = timezone.now()
+    chat.archived_last_message = data['messages'][-1] if data['messages'] else None
+    Chat.objects.filter(pk=chat.pk).update(
+        archived_at=chat.archived_at, archived_last_message=chat.archived_last_message
+    )
+    purge_chat(chat, data, batch_size or settings.CHAT_DELETE_BATCH_SIZE)
+
+
+def release_chat_archive(chat_id: int) -> None:
+    """
+    Освобождение ссылок архива на ChatFile и удаление архива, вызывается при удалении чата
+    :param chat_id: int
+    :return: None
+    """
+    data = load_chat_archive(chat_id)
+    if data is None:
+        return
+    for message in data['messages']:
+        for message_file in message['files']:
+            if message_file['sha256']:
+                ChatFile.objects.release(message_file['sha256'])
+    name = get_archive_name(chat_id)
+    transaction.on_commit(lambda: archive_storage.delete(name))
+
+
+def get_archived_messages(chat: Chat) -> list:
+    """
+    Вернет сообщения чата из архива как несохраненные ChatMessage, новые сверху
+    :param chat: Chat
+    :return: list[ChatMessage]
+    """
+    data = load_chat_archive(chat.pk) or {'messages': []}
+    return [ChatMessage.from_archive(chat.pk, item) for item in reversed(data['messages'])]
+
+
+def get_archived_comments(chat: Chat) -> list:
+    """
+    Вернет комментарии чата из архива как несохраненные ChatComment
+    :param chat: Chat
+    :return: list[ChatComment]
+    """
+    data = load_chat_archive(chat.pk) or {'comments': []}
+    curators = User.objects.in_bulk({item['curator_id'] for item in data['comments']})
+    comments = []
+    for item in data['comments']:
+        comment = ChatComment(
+            id=item['id'],
+            chat_id=chat.pk,
+            curator_id=item['curator_id'],
+            text=item['text'],
+            created_at=parse_datetime(item['created_at']),
+            updated_at=parse_datetime(item['updated_at']),
+        )
+        if item['curator_id'] in curators:
+            comment.curator = curators[item['curator_id']]
+        comments.append(comment)
+    return comments
+
+
+def get_chat_messages(chat: Chat):
+    """
+    Сообщения чата с чтением из архива: для неархивных чатов QuerySet,
+    для архивных список из архива и сообщений, добавленных после архивации
+    :param chat: Chat
+    :return: QuerySet or list[ChatMessage]
+    """
+    queryset = ChatMessage.objects.of_chat(chat).prefetch_related('files')
+    if chat.archived_at is None:
+        return queryset
+    messages = list(queryset)
+    hot_ids = {message.pk for message in messages}
+    messages += [message for message in get_archived_messages(chat) if message.pk not in hot_ids]
+    return sorted(messages, key=lambda message: message.created_at, reverse=True)
+
+
+async def aget_chat_messages(chat: Chat):
+    """Асинхронная версия get_chat_messages, архив читается в потоке"""
+    if chat.archived_at is None:
+        return get_chat_messages(chat)
+    return await sync_to_async(get_chat_messages)(chat)
+
+
+def get_chat_comments(chat: Chat):
+    """
+    Комментарии чата с чтением из архива
+    :param chat: Chat
+    :return: QuerySet or list[ChatComment]
+    """
+    queryset = ChatComment.objects.filter(chat_id=chat.pk).select_related('curator')
+    if chat.archived_at is None:
+        return queryset
+    comments = list(queryset)
+    hot_ids = {comment.pk for comment in comments}
+    return [comment for comment in get_archived_comments(chat) if comment.pk not in hot_ids] + comments
+
+
+def get_archived_message_file(chat: Chat, file_id: int) -> Optional[ChatMessageFile]:
+    """
+    Вернет файл сообщения из архива чата
+    :param chat: Chat
+    :param file_id: int - id ChatMessageFile на момент архивации
+    :return: ChatMessageFile or None
+    """
+    for message in get_archived_messages(chat):
+        for message_file in message._prefetched_objects_cache['files']:
+            if message_file.pk == file_id:
+                return message_file
+    return None
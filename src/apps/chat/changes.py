@@ -0,0 +1,58 @@
+"""
+Дельта списка чатов: версия - время выдачи в миллисекундах. Клиент получает версию в заголовке
+X-Chats-Version ответа списка и запрашивает изменения после нее: чаты с Chat.summary_changed_at позже версии
+и удаленные (ChatTombstone). Изменения за CHAT_CHANGES_OVERLAP_SECONDS до версии возвращаются повторно -
+транзакции, начатые до выдачи версии, и отставание реплики не теряются
+"""
+import datetime
+from typing import Optional
+
+from django.conf import settings
+from django.utils import timezone
+
+from apps.chat.models import ChatTombstone
+
+CHATS_VERSION_HEADER = 'X-Chats-Version'
+
+
+def get_chats_version() -> str:
+    """Версия списка чатов, берется до чтения списка"""
+    return str(int(timezone.now().timestamp() * 1000))
+
+
+def parse_chats_version(version) -> Optional[datetime.datetime]:
+    """
+    Время, после которого ищутся изменения
+    :param version: версия из get_chats_version
+    :return: datetime или None - версия неверная или старше CHAT_CHANGES_RETENTION_SECONDS, нужен полный список
+    """
+    try:
+        issued = datetime.datetime.fromtimestamp(int(version) / 1000, datetime.timezone.utc)
+    except (TypeError, ValueError, OverflowError, OSError):
+        return None
+    now = timezone.now()
+    if issued > now or now - issued > datetime.timedelta(seconds=settings.CHAT_CHANGES_RETENTION_SECONDS):
+        return None
+    return issued - datetime.timedelta(seconds=settings.CHAT_CHANGES_OVERLAP_SECONDS)
+
+
+def add_tombstone(chat_id: int, client_id: int, topic_id: Optional[int]) -> None:
+    """
+    Чат убран из списка клиента и кураторов темы topic_id
+    :param chat_id: id чата
+    :param client_id: клиент чата
+    :param topic_id: тема, из списка которой убран чат
+    """
+    ChatTombstone.objects.create(chat_id=chat_id, client_id=client_id, topic_id=topic_id)
+
+
+def prune_tombstones() -> int:
+    """
+    Удаление записей, которые уже не вернет ни одна действующая версия
+    :return: int - удалено записей
+    """
+    threshold = timezone.now() - datetime.timedelta(
+        seconds=settings.CHAT_CHANGES_RETENTION_SECONDS + settings.CHAT_CHANGES_OVERLAP_SECONDS
+    )
+    deleted, _ = ChatTombstone.objects.filter(created_at__lt=threshold).delete()
+    return deleted
@@ -0,0 +1,43 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from loguru import logger
+
+from apps.chat.archive import archive_chat
+from apps.chat.changes import prune_tombstones
+from apps.chat.models import Chat, ChatComment, ChatMessage
+from apps.chat.utils import ChatStatus
+
+
+class Command(BaseCommand):
+    help = 'Перенос давно закрытых чатов в архив'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=settings.CHAT_ARCHIVE_AFTER_DAYS)
+        parser.add_argument('--limit', type=int, default=None, help='Максимум чатов за запуск')
+        parser.add_argument('--batch-size', type=int, default=settings.CHAT_DELETE_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        threshold = timezone.now() - datetime.timedelta(days=options['days'])
+        # архивные чаты с сообщениями или комментариями в БД - прерванная архивация или чат открывали снова,
+        # строки дописываются к архиву
+        chats = Chat.objects.filter(
+            status=ChatStatus.CLOSED, summary_changed_at__lt=threshold
+        ).filter(
+            Q(archived_at__isnull=True) |
+            Q(Exists(ChatMessage.objects.filter(chat_id=OuterRef('pk')))) |
+            Q(Exists(ChatComment.objects.filter(chat_id=OuterRef('pk'))))
+        ).order_by('id')
+        if options['limit']:
+            chats = chats[:options['limit']]
+
+        count = 0
+        for chat in chats.iterator():
+            archive_chat(chat, options['batch_size'])
+            count += 1
+        pruned = prune_tombstones()
+        logger.info(f'archive_closed_chats: archived {count}, pruned tombstones {pruned}')
+        self.stdout.write(f'Заархивировано чатов: {count}, удалено записей об удаленных чатах: {pruned}')
@@ -0,0 +1,227 @@
+import datetime
+import json
+import platform
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from jwcrypto import jwk
+
+from apps.chat.management.commands.benchmark_messages import Command as MessagesBenchmark
+from apps.chat.models import Chat, ChatTopic
+from apps.chat.utils import ChatStatus, ChatType, MessageType
+from apps.users.models import User
+from apps.users.utils import UserRole
+
+STATS_PERIOD = '?start_date={start}&end_date={end}'
+# (имя, роль токена, метод, путь); {chat_id} - чат пользователя токена
+SCENARIOS = (
+    ('client.topics', UserRole.CLIENT, 'GET', '/api/v1/client/topics/'),
+    ('client.chats', UserRole.CLIENT, 'GET', '/api/v1/client/chats/'),
+    ('client.messages', UserRole.CLIENT, 'GET', '/api/v1/client/chats/{chat_id}/messages/'),
+    ('client.notifications', UserRole.CLIENT, 'GET', '/api/v1/lms-crm/notifications/'),
+    ('curator.chats', UserRole.CURATOR, 'GET', '/api/v1/curator/chats/'),
+    ('curator.chats_open', UserRole.CURATOR, 'GET', f'/api/v1/curator/chats/?status={ChatStatus.OPEN}'),
+    ('curator.topics', UserRole.CURATOR, 'GET', '/api/v1/curator/chats/topics/'),
+    ('curator.info', UserRole.CURATOR, 'GET', '/api/v1/curator/chats/info/'),
+    ('curator.messages', UserRole.CURATOR, 'GET', '/api/v1/curator/chats/{chat_id}/messages/'),
+    ('curator.comments', UserRole.CURATOR, 'GET', '/api/v1/curator/chats/{chat_id}/comments/'),
+    ('lms_crm.topics_popularity', UserRole.CURATOR, 'GET', '/api/v1/lms-crm/stats/topics-popularity/'),
+    ('lms_crm.topics_closed_percentage', UserRole.CURATOR, 'GET',
+     '/api/v1/lms-crm/stats/topics-closed-chat-percentage/'),
+    ('lms_crm.closed_percentage', UserRole.CURATOR, 'GET', '/api/v1/lms-crm/stats/closed-chat-percentage/'),
+    ('lms_crm.closed_percentage_period', UserRole.CURATOR, 'GET',
+     '/api/v1/lms-crm/stats/closed-chat-percentage/' + STATS_PERIOD),
+    ('lms_crm.topics_avg_time', UserRole.CURATOR, 'GET', '/api/v1/lms-crm/stats/topics-avg-time/'),
+    ('lms_crm.chat_avg_time', UserRole.CURATOR, 'GET', '/api/v1/lms-crm/stats/chat-avg-time/'),
+    ('lms_crm.curator_chats_avg_time', UserRole.CURATOR, 'GET', '/api/v1/lms-crm/stats/curator-chats-avg-time/'),
+    ('lms_crm.curator_chats_count', UserRole.CURATOR, 'GET', '/api/v1/lms-crm/stats/curator-chats-count/'),
+)
+# изменяющие сценарии, включаются --writes
+WRITE_SCENARIOS = (
+    ('client.create_message', UserRole.CLIENT, 'POST', '/api/v1/client/chats/messages/'),
+    ('curator.create_message', UserRole.CURATOR, 'POST', '/api/v1/curator/chats/messages/'),
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Бенчмарк REST API client, curator и lms-crm в одном процессе (django.test.Client, полный стек middleware): '
+        'перцентили задержек и количество запросов в БД по эндпоинтам в JSON отчет. '
+        'Токены подписываются локальным ключом вместо KeyCloak. '
+        'Данные - seed_benchmark, отчеты двух запусков сравниваются через --compare'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Запросов на эндпоинт')
+        parser.add_argument('--warmup', type=int, default=10, help='Запросов на эндпоинт до замера')
+        parser.add_argument('--users', type=int, default=20, help='Пользователей каждой роли')
+        parser.add_argument('--only', action='append', default=[], help='Префикс имени сценария, например curator.')
+        parser.add_argument('--writes', action='store_true', help='Добавить создание сообщений (меняет данные)')
+        parser.add_argument('--output', default=None, help='Файл JSON отчета')
+        parser.add_argument('--compare', default=None, help='JSON отчет предыдущего запуска')
+
+    def handle(self, *args, **options):
+        scenarios = SCENARIOS + (WRITE_SCENARIOS if options['writes'] else ())
+        if options['only']:
+            scenarios = tuple(
+                scenario for scenario in scenarios if scenario[0].startswith(tuple(options['only']))
+            )
+        if not scenarios:
+            raise CommandError('Нет сценариев для --only')
+
+        key = jwk.JWK.generate(kty='RSA', size=2048)
+        identities = self.get_identities(key, options['users'])
+        client = Client(raise_request_exception=False, SERVER_NAME=self.get_host())
+
+        results = {}
+        with override_settings(KEYCLOAK_PUBLIC_KEY=key.export_to_pem().decode()):
+            for name, role, method, path in scenarios:
+                if not identities[role]:
+                    self.stderr.write(f'{name}: нет чатов для роли {role}, пропущен')
+                    continue
+                results[name] = self.run(client, identities[role], method, path, options)
+                self.write_result(name, results[name])
+
+        report = {
+            'created_at': datetime.datetime.now().isoformat(),
+            'environment': self.get_environment(),
+            'options': {key: options[key] for key in ('requests', 'warmup', 'users', 'writes')},
+            'endpoints': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+            self.stdout.write(f'Отчет записан в {options["output"]}')
+        if options['compare']:
+            with open(options['compare']) as f:
+                self.compare(json.load(f), report)
+
+    def run(self, client: Client, identities: list, method: str, path: str, options: dict) -> dict:
+        today = datetime.date.today()
+        latencies, queries, query_seconds, statuses = [], [], [], {}
+        for i in range(options['warmup'] + options['requests']):
+            token, chat_id = identities[i % len(identities)]
+            url = path.format(chat_id=chat_id, start=today - datetime.timedelta(days=30), end=today)
+            started = time.perf_counter()
+            if method == 'POST':
+                response = client.post(
+                    url, {'chat': chat_id, 'text': f'benchmark {i}', 'message_type': MessageType.TEXT},
+                    content_type='application/json', HTTP_AUTHORIZATION=token
+                )
+            else:
+                response = client.get(url, HTTP_AUTHORIZATION=token)
+            latency = time.perf_counter() - started
+            if i < options['warmup']:
+                continue
+            latencies.append(latency)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            # статистика MetricsMiddleware
+            db_queries = getattr(response, 'db_queries', None)
+            if db_queries is not None:
+                queries.append(db_queries['count'])
+                query_seconds.append(db_queries['duration'])
+        return {
+            'requests': len(latencies),
+            'errors': sum(count for status, count in statuses.items() if status >= 400),
+            'statuses': {str(status): count for status, count in sorted(statuses.items())},
+            'latency_ms': get_percentiles(latencies),
+            'db_queries': {
+                'mean': round(statistics.fmean(queries), 2) if queries else None,
+                'max': max(queries) if queries else None,
+            },
+            'db_query_ms': get_percentiles(query_seconds),
+        }
+
+    @staticmethod
+    def get_identities(key: jwk.JWK, count: int) -> dict:
+        """
+        Токены и чаты пользователей: клиенты открытых чатов по темам, кураторы с правами всех тем
+        :return: {role: [(token, chat_id), ...]}
+        """
+        client_chats = list(
+            Chat.objects.filter(chat_type=ChatType.TOPIC).exclude(
+                status=ChatStatus.CLOSED
+            ).order_by('-id').values_list('id', 'client_id')[:count]
+        )
+        curator_chats = list(
+            Chat.objects.filter(chat_type=ChatType.TOPIC, curator__isnull=False).exclude(
+                status=ChatStatus.CLOSED
+            ).order_by('-id').values_list('id', 'curator_id')[:count]
+        )
+        users = User.objects.in_bulk({user_id for _, user_id in client_chats + curator_chats})
+        curator_roles = [settings.KEYCLOAK_CURATOR_ROLE, *set(ChatTopic.objects.values_list('permission', flat=True))]
+        return {
+            UserRole.CLIENT: [
+                (MessagesBenchmark.make_token(key, users[user_id], [settings.KEYCLOAK_CLIENT_ROLE]), chat_id)
+                for chat_id, user_id in client_chats
+            ],
+            UserRole.CURATOR: [
+                (MessagesBenchmark.make_token(key, users[user_id], curator_roles), chat_id)
+                for chat_id, user_id in curator_chats
+            ],
+        }
+
+    @staticmethod
+    def get_host() -> str:
+        hosts = [host for host in settings.ALLOWED_HOSTS if host != '*']
+        return hosts[0].lstrip('.') if hosts else 'localhost'
+
+    @staticmethod
+    def get_environment() -> dict:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT version()')
+            database = cursor.fetchone()[0] if connection.vendor == 'postgresql' else connection.vendor
+        return {
+            'python': platform.python_version(),
+            'database': database,
+            'api_async_views': settings.API_ASYNC_VIEWS,
+            'chats': Chat.objects.count(),
+            'topics': ChatTopic.objects.count(),
+        }
+
+    def write_result(self, name: str, result: dict) -> None:
+        latency = result['latency_ms']
+        self.stdout.write(
+            f'{name:<36} p50 {latency["p50"]:>8.2f}ms p95 {latency["p95"]:>8.2f}ms p99 {latency["p99"]:>8.2f}ms '
+            f'queries {result["db_queries"]["mean"]} errors {result["errors"]}'
+        )
+
+    def compare(self, previous: dict, current: dict) -> None:
+        self.stdout.write(f'\nсравнение с отчетом {previous["created_at"]}:')
+        for name, result in current['endpoints'].items():
+            before = previous['endpoints'].get(name)
+            if before is None:
+                continue
+            p50, p95 = before['latency_ms']['p50'], before['latency_ms']['p95']
+            self.stdout.write(
+                f'{name:<36} p50 {p50:>8.2f} -> {result["latency_ms"]["p50"]:>8.2f}ms '
+                f'({get_change(p50, result["latency_ms"]["p50"])}) '
+                f'p95 {p95:>8.2f} -> {result["latency_ms"]["p95"]:>8.2f}ms '
+                f'({get_change(p95, result["latency_ms"]["p95"])}) '
+                f'queries {before["db_queries"]["mean"]} -> {result["db_queries"]["mean"]}'
+            )
+
+
+def get_percentiles(values: list) -> dict:
+    """Перцентили в миллисекундах"""
+    if not values:
+        return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'mean': 0.0, 'max': 0.0}
+    values = sorted(values)
+    quantiles = statistics.quantiles(values, n=100) if len(values) > 1 else values * 99
+    return {
+        'p50': round(quantiles[49] * 1000, 3),
+        'p95': round(quantiles[94] * 1000, 3),
+        'p99': round(quantiles[98] * 1000, 3),
+        'mean': round(statistics.fmean(values) * 1000, 3),
+        'max': round(values[-1] * 1000, 3),
+    }
+
+
+def get_change(before: float, after: float) -> str:
+    if not before:
+        return 'n/a'
+    return f'{(after - before) / before * 100:+.1f}%'
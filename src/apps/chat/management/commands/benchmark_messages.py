@@ -0,0 +1,207 @@
+import datetime
+import http.client
+import json
+import os
+import statistics
+import threading
+import time
+from typing import Optional
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from jwcrypto import jwk, jwt
+
+from apps.chat.models import Chat, ChatTopic
+from apps.chat.utils import ChatStatus, MessageType
+from apps.users.models import User
+from apps.users.utils import UserRole
+
+BENCHMARK_TOPIC_PERMISSION = 'benchmark_topic'
+
+
+class Command(BaseCommand):
+    help = (
+        'Нагрузочный тест REST API сообщений: постоянная нагрузка на создание (и список) сообщений '
+        'в течение --duration секунд, messages/sec, задержки и RSS процессов сервера (--pid). '
+        'Токены подписываются ключом --private-key, сервер запускается с KEYCLOAK_PUBLIC_KEY этого ключа'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000')
+        parser.add_argument('--private-key', required=True, help='PEM файл, создается при отсутствии')
+        parser.add_argument('--duration', type=int, default=30)
+        parser.add_argument('--concurrency', type=int, default=50)
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--role', choices=(UserRole.CLIENT, UserRole.CURATOR), default=UserRole.CLIENT)
+        parser.add_argument('--list-ratio', type=float, default=0.0, help='Доля запросов списка сообщений, 0..1')
+        parser.add_argument('--pid', type=int, action='append', default=[], help='PID мастер-процесса сервера')
+
+    def handle(self, *args, **options):
+        key = self.get_key(options['private_key'])
+        if key is None:
+            return
+
+        chats = self.get_chats(options['users'])
+        if options['role'] == UserRole.CLIENT:
+            tokens = [
+                (self.make_token(key, chat.client, [settings.KEYCLOAK_CLIENT_ROLE]), chat.pk) for chat in chats
+            ]
+        else:
+            roles = [settings.KEYCLOAK_CURATOR_ROLE, BENCHMARK_TOPIC_PERMISSION]
+            tokens = [
+                (self.make_token(key, curator, roles), chat.pk)
+                for curator, chat in zip(self.get_users(UserRole.CURATOR, options['users']), chats)
+            ]
+
+        rss_before = self.get_rss(options['pid'])
+        stats = self.run(tokens, options)
+        rss_after = self.get_rss(options['pid'])
+
+        created, listed, failed, latencies, elapsed = stats
+        latencies.sort()
+        quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+        self.stdout.write(
+            f'url: {options["url"]}, role: {options["role"]}, concurrency: {options["concurrency"]}, '
+            f'duration: {elapsed:.1f}s, failed: {failed}\n'
+            f'messages/sec: {created / elapsed:.1f}, list requests/sec: {listed / elapsed:.1f}\n'
+            f'latency ms p50: {quantiles[49] * 1000:.2f} p95: {quantiles[94] * 1000:.2f} '
+            f'p99: {quantiles[98] * 1000:.2f}'
+        )
+        if options['pid']:
+            self.stdout.write(
+                f'server rss MB before: {rss_before / 1024:.1f} after: {rss_after / 1024:.1f}, '
+                f'messages/sec per GB: {created / elapsed / (rss_after / 1024 / 1024):.1f}'
+            )
+
+    def run(self, tokens: list, options: dict) -> tuple:
+        url = urlsplit(options['url'])
+        prefix = '/api/v1/client' if options['role'] == UserRole.CLIENT else '/api/v1/curator'
+        deadline = time.perf_counter() + options['duration']
+        lock = threading.Lock()
+        latencies = []
+        counters = {'created': 0, 'listed': 0, 'failed': 0}
+
+        def worker(number: int):
+            connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=60)
+            i = number
+            while time.perf_counter() < deadline:
+                token, chat_id = tokens[i % len(tokens)]
+                is_list = options['list_ratio'] and (i * 0.6180339887) % 1 < options['list_ratio']
+                started = time.perf_counter()
+                try:
+                    if is_list:
+                        connection.request(
+                            'GET', f'{prefix}/chats/{chat_id}/messages/?limit=20', headers={'Authorization': token}
+                        )
+                    else:
+                        body = {'chat': chat_id, 'text': f'benchmark {i}', 'message_type': MessageType.TEXT}
+                        connection.request(
+                            'POST', f'{prefix}/chats/messages/', body=json.dumps(body),
+                            headers={'Authorization': token, 'Content-Type': 'application/json'}
+                        )
+                    response = connection.getresponse()
+                    response.read()
+                    ok = response.status in (200, 201)
+                except (OSError, http.client.HTTPException):
+                    connection.close()
+                    ok = False
+                latency = time.perf_counter() - started
+                with lock:
+                    latencies.append(latency)
+                    if not ok:
+                        counters['failed'] += 1
+                    elif is_list:
+                        counters['listed'] += 1
+                    else:
+                        counters['created'] += 1
+                i += options['concurrency']
+            connection.close()
+
+        started = time.perf_counter()
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(options['concurrency'])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        return counters['created'], counters['listed'], counters['failed'], latencies, elapsed
+
+    def get_key(self, path: str):
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                return jwk.JWK.from_pem(f.read())
+        key = jwk.JWK.generate(kty='RSA', size=2048)
+        with open(path, 'wb') as f:
+            f.write(key.export_to_pem(private_key=True, password=None))
+        public_key = key.export_to_pem().decode()
+        self.stdout.write(
+            f'Ключ записан в {path}. Запустите сервер с KEYCLOAK_PUBLIC_KEY:\n{public_key}'
+        )
+        return None
+
+    def get_chats(self, count: int) -> list:
+        topic, _ = ChatTopic.objects.get_or_create(
+            permission=BENCHMARK_TOPIC_PERMISSION,
+            defaults={'title': 'benchmark', 'description': 'benchmark'}
+        )
+        chats = []
+        for client in self.get_users(UserRole.CLIENT, count):
+            chat = Chat.objects.filter(client=client, topic=topic).exclude(status=ChatStatus.CLOSED).first()
+            chats.append(chat or Chat.objects.create_client_chat(client=client, topic=topic))
+        return chats
+
+    @staticmethod
+    def get_users(role: str, count: int) -> list:
+        users = []
+        for i in range(count):
+            user, _ = User.objects.get_or_create(username=f'benchmark_{role}_{i}', defaults={'role': role})
+            users.append(user)
+        return users
+
+    @staticmethod
+    def get_rss(pids: list) -> int:
+        """RSS процессов и всех их потомков в KB (Linux /proc)"""
+        children = {}
+        for name in os.listdir('/proc'):
+            if not name.isdigit():
+                continue
+            try:
+                with open(f'/proc/{name}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(name))
+
+        total = 0
+        stack = list(pids)
+        while stack:
+            pid = stack.pop()
+            stack.extend(children.get(pid, []))
+            try:
+                with open(f'/proc/{pid}/status') as f:
+                    for line in f:
+                        if line.startswith('VmRSS:'):
+                            total += int(line.split()[1])
+            except OSError:
+                continue
+        return total
+
+    @staticmethod
+    def make_token(key: jwk.JWK, user: User, roles: list, key_id: Optional[str] = None) -> str:
+        header = {'alg': 'RS256', 'typ': 'JWT'}
+        if key_id:
+            # ключ стенда нагрузочного теста, см. KEYCLOAK_TEST_PUBLIC_KEY
+            header['kid'] = key_id
+        token = jwt.JWT(
+            header=header,
+            claims={
+                'sub': str(user.pk),
+                'preferred_username': user.username,
+                'name': user.name,
+                'realm_access': {'roles': roles},
+                'exp': int((datetime.datetime.now() + datetime.timedelta(hours=1)).timestamp()),
+            }
+        )
+        token.make_signed_token(key)
+        return token.serialize()
@@ -0,0 +1,121 @@
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.chat.management.commands.benchmark_api import get_change
+
+DEFAULT_MODULES = ('core.asgi', 'core.wsgi')
+
+
+class Command(BaseCommand):
+    help = (
+        'Время запуска процесса: импорт --module (по умолчанию core.asgi и core.wsgi, с django.setup) '
+        'в отдельном интерпретаторе с python -X importtime, медиана --runs запусков и самые дорогие пакеты. '
+        'С --max-ms завершается ошибкой, если импорт дольше'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--module', action='append', default=[], help='Модуль, можно несколько')
+        parser.add_argument('--runs', type=int, default=5)
+        parser.add_argument('--top', type=int, default=15, help='Пакетов в отчете')
+        parser.add_argument('--max-ms', type=float, default=None, help='Допустимая медиана импорта модуля')
+        parser.add_argument('--output', default=None, help='Файл JSON отчета')
+        parser.add_argument('--compare', default=None, help='JSON отчет предыдущего запуска')
+
+    def handle(self, *args, **options):
+        results = {}
+        for module in options['module'] or DEFAULT_MODULES:
+            results[module] = self.run(module, options)
+            self.write_result(module, results[module])
+
+        report = {
+            'created_at': datetime.datetime.now().isoformat(),
+            'environment': {'python': platform.python_version()},
+            'options': {'runs': options['runs']},
+            'modules': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f'Отчет записан в {options["output"]}')
+        if options['compare']:
+            with open(options['compare']) as f:
+                self.compare(json.load(f), report)
+
+        if options['max_ms'] is not None:
+            over = [module for module, result in results.items() if result['import_ms'] > options['max_ms']]
+            if over:
+                raise CommandError(f'Импорт дольше {options["max_ms"]}ms: {", ".join(over)}')
+
+    def run(self, module: str, options: dict) -> dict:
+        import_times, wall_times, packages = [], [], {}
+        for _ in range(options['runs']):
+            started = time.perf_counter()
+            process = subprocess.run(
+                [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                cwd=settings.BASE_DIR, env=os.environ.copy(), capture_output=True, text=True,
+            )
+            wall_times.append(time.perf_counter() - started)
+            if process.returncode:
+                raise CommandError(f'import {module}:\n{process.stderr[-2000:]}')
+            imports = parse_importtime(process.stderr)
+            import_times.append(imports[module][1] / 1_000_000)
+            for name, (self_us, _) in imports.items():
+                package = name.split('.', 1)[0]
+                packages[package] = packages.get(package, 0) + self_us / 1_000_000 / options['runs']
+        top = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:options['top']]
+        return {
+            'import_ms': round(statistics.median(import_times) * 1000, 1),
+            'wall_ms': round(statistics.median(wall_times) * 1000, 1),
+            'modules': len(imports),
+            'top_packages_ms': {package: round(seconds * 1000, 1) for package, seconds in top},
+        }
+
+    def write_result(self, module: str, result: dict) -> None:
+        self.stdout.write(
+            f'{module}: import {result["import_ms"]:.1f}ms, process {result["wall_ms"]:.1f}ms, '
+            f'modules {result["modules"]}'
+        )
+        for package, ms in result['top_packages_ms'].items():
+            self.stdout.write(f'  {package:<32} {ms:>8.1f}ms')
+
+    def compare(self, previous: dict, current: dict) -> None:
+        self.stdout.write(f'\nсравнение с отчетом {previous["created_at"]}:')
+        for module, result in current['modules'].items():
+            before = previous['modules'].get(module)
+            if before is None:
+                continue
+            self.stdout.write(
+                f'{module:<16} import {before["import_ms"]:>8.1f} -> {result["import_ms"]:>8.1f}ms '
+                f'({get_change(before["import_ms"], result["import_ms"])}) '
+                f'process {before["wall_ms"]:>8.1f} -> {result["wall_ms"]:>8.1f}ms '
+                f'({get_change(before["wall_ms"], result["wall_ms"])}) '
+                f'modules {before["modules"]} -> {result["modules"]}'
+            )
+            dropped = set(before['top_packages_ms']) - set(result['top_packages_ms'])
+            if dropped:
+                self.stdout.write(f'  больше не в топе: {", ".join(sorted(dropped))}')
+
+
+def parse_importtime(output: str) -> dict:
+    """
+    Вывод python -X importtime: "import time: self [us] | cumulative | imported package"
+    :return: {module: (self us, cumulative us)}
+    """
+    imports = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        if not self_us.strip().isdigit():
+            continue
+        imports[name.strip()] = (int(self_us), int(cumulative_us))
+    return imports
@@ -0,0 +1,97 @@
+import asyncio
+import datetime
+import statistics
+import time
+
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from jwcrypto import jwk, jwt
+
+from apps.chat import topics
+from apps.users.models import User
+from apps.users.utils import UserRole
+from core.libs import keycloak
+
+
+class Command(BaseCommand):
+    help = (
+        'Бенчмарк подключений к вебсокету (connects/sec) в одном процессе: ASGI приложение ws '
+        'вызывается напрямую, токены подписываются локальным ключом вместо KeyCloak'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=1000)
+        parser.add_argument('--concurrency', type=int, default=50)
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--role', choices=(UserRole.CLIENT, UserRole.CURATOR), default=UserRole.CLIENT)
+        parser.add_argument('--cold', action='store_true', help='Сбрасывать кэши процесса перед каждым подключением')
+
+    def handle(self, *args, **options):
+        from core.asgi import application
+
+        key = jwk.JWK.generate(kty='RSA', size=2048)
+        roles = [settings.KEYCLOAK_CLIENT_ROLE if options['role'] == UserRole.CLIENT else settings.KEYCLOAK_CURATOR_ROLE]
+        tokens = [
+            self.make_token(key, user, roles)
+            for user in self.get_users(options['role'], options['users'])
+        ]
+
+        with override_settings(KEYCLOAK_PUBLIC_KEY=key.export_to_pem().decode()):
+            latencies, elapsed, failed = asyncio.run(self.run(application, tokens, options))
+
+        latencies.sort()
+        quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+        self.stdout.write(
+            f'connections: {options["connections"]}, concurrency: {options["concurrency"]}, failed: {failed}\n'
+            f'connects/sec: {len(latencies) / elapsed:.1f}\n'
+            f'latency ms p50: {quantiles[49] * 1000:.2f} p95: {quantiles[94] * 1000:.2f} '
+            f'p99: {quantiles[98] * 1000:.2f}'
+        )
+
+    async def run(self, application, tokens: list, options: dict) -> tuple:
+        semaphore = asyncio.Semaphore(options['concurrency'])
+        latencies = []
+        failed = 0
+
+        async def connect(token: str):
+            nonlocal failed
+            async with semaphore:
+                if options['cold']:
+                    keycloak._verified_tokens.clear()
+                    topics._permission_topics['version'] = None
+                started = time.perf_counter()
+                communicator = WebsocketCommunicator(application, f'/connect/?token={token}')
+                connected, _ = await communicator.connect()
+                latencies.append(time.perf_counter() - started)
+                if not connected:
+                    failed += 1
+                await communicator.disconnect()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(connect(tokens[i % len(tokens)]) for i in range(options['connections'])))
+        return latencies, time.perf_counter() - started, failed
+
+    @staticmethod
+    def get_users(role: str, count: int) -> list:
+        users = []
+        for i in range(count):
+            user, _ = User.objects.get_or_create(username=f'benchmark_{role}_{i}', defaults={'role': role})
+            users.append(user)
+        return users
+
+    @staticmethod
+    def make_token(key: jwk.JWK, user: User, roles: list) -> str:
+        token = jwt.JWT(
+            header={'alg': 'RS256', 'typ': 'JWT'},
+            claims={
+                'sub': str(user.pk),
+                'preferred_username': user.username,
+                'name': user.name,
+                'realm_access': {'roles': roles},
+                'exp': int((datetime.datetime.now() + datetime.timedelta(hours=1)).timestamp()),
+            }
+        )
+        token.make_signed_token(key)
+        return token.serialize()
@@ -0,0 +1,410 @@
+import asyncio
+import datetime
+import http.client
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import redis
+from autobahn.asyncio.websocket import WebSocketClientFactory, WebSocketClientProtocol
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from jwcrypto import jwk
+
+from apps.chat.management.commands.benchmark_api import get_percentiles
+from apps.chat.management.commands.benchmark_messages import (
+    BENCHMARK_TOPIC_PERMISSION, Command as MessagesBenchmark
+)
+from apps.chat.utils import MessageType
+from apps.users.utils import UserRole
+
+MARKER = 'ws-load:'
+# сокет без сообщений клиента дольше WS_IDLE_TIMEOUT_SECONDS закрывается, сокеты периодически отправляют ping
+KEEPALIVE_INTERVAL = 30
+PING = json.dumps({'event_type': 'ping'}).encode()
+DEFAULT_WS_URL = 'ws://127.0.0.1:8001/connect/'
+
+
+class LoadSocket:
+    """Состояние одного сокета нагрузочного теста"""
+
+    def __init__(self, role: str, user_id: int, token: str):
+        self.role = role
+        self.user_id = user_id
+        self.token = token
+        self.protocol = None
+        self.opened = None
+        self.closed = False
+
+
+class LoadClientProtocol(WebSocketClientProtocol):
+
+    def onOpen(self):
+        self.factory.socket.protocol = self
+        if not self.factory.socket.opened.done():
+            self.factory.socket.opened.set_result(True)
+
+    def onMessage(self, payload, isBinary):
+        self.factory.harness.on_message(payload)
+
+    def onClose(self, wasClean, code, reason):
+        socket = self.factory.socket
+        socket.closed = True
+        if not socket.opened.done():
+            socket.opened.set_result(False)
+
+
+class Command(BaseCommand):
+    help = (
+        'Нагрузочный тест вебсокетов (ws): --clients и --curators сокетов, сообщения через REST API, '
+        'задержка доставки new_message, полнота рассылки, память на соединение и CPU на событие сервера ws (--pid). '
+        'Токены подписываются ключом --private-key с kid KEYCLOAK_TEST_KEY_ID, '
+        'серверы ws и API запускаются с KEYCLOAK_TEST_PUBLIC_KEY этого ключа. '
+        'Несколько --ws-url распределяют сокеты по процессам ws, команды и трафик Redis считаются на сообщение'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--ws-url', action='append', default=[], help=f'URL процесса ws, можно несколько, по умолчанию {DEFAULT_WS_URL}'
+        )
+        parser.add_argument('--api-url', default='http://127.0.0.1:8000')
+        parser.add_argument('--private-key', required=True, help='PEM файл, создается при отсутствии')
+        parser.add_argument('--clients', type=int, default=1000)
+        parser.add_argument('--curators', type=int, default=20, help='Каждый куратор получает сообщения всех чатов')
+        parser.add_argument('--connect-rate', type=float, default=200, help='Подключений в секунду')
+        parser.add_argument('--rate', type=float, default=20, help='Сообщений в секунду через REST API')
+        parser.add_argument('--duration', type=int, default=30, help='Секунды отправки сообщений')
+        parser.add_argument('--drain', type=float, default=5, help='Секунды ожидания доставки после отправки')
+        parser.add_argument('--http-concurrency', type=int, default=20)
+        parser.add_argument('--pid', type=int, action='append', default=[], help='PID процесса сервера ws')
+        parser.add_argument('--output', default=None, help='Файл JSON отчета')
+        parser.add_argument('--compare', default=None, help='JSON отчет предыдущего запуска')
+
+    def handle(self, *args, **options):
+        key = self.get_key(options['private_key'])
+        if key is None:
+            return
+
+        chats = MessagesBenchmark().get_chats(options['clients'])
+        client_role = [settings.KEYCLOAK_CLIENT_ROLE]
+        curator_roles = [settings.KEYCLOAK_CURATOR_ROLE, BENCHMARK_TOPIC_PERMISSION]
+        sockets = [
+            LoadSocket(
+                UserRole.CLIENT, chat.client_id,
+                MessagesBenchmark.make_token(key, chat.client, client_role, settings.KEYCLOAK_TEST_KEY_ID)
+            )
+            for chat in chats
+        ] + [
+            LoadSocket(
+                UserRole.CURATOR, curator.pk,
+                MessagesBenchmark.make_token(key, curator, curator_roles, settings.KEYCLOAK_TEST_KEY_ID)
+            )
+            for curator in MessagesBenchmark.get_users(UserRole.CURATOR, options['curators'])
+        ]
+        # сообщение отправляет клиент чата через REST API
+        senders = [(socket.token, chat.pk) for socket, chat in zip(sockets, chats)]
+
+        report = asyncio.run(Harness(options, sockets, senders).run())
+        report['created_at'] = datetime.datetime.now().isoformat()
+        report['options'] = {
+            key: options[key] for key in ('clients', 'curators', 'connect_rate', 'rate', 'duration', 'drain')
+        }
+        report['options']['ws_processes'] = len(options['ws_url'] or [DEFAULT_WS_URL])
+        self.write_report(report)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f'Отчет записан в {options["output"]}')
+        if options['compare']:
+            with open(options['compare']) as f:
+                self.compare(json.load(f), report)
+
+    def get_key(self, path: str):
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                return jwk.JWK.from_pem(f.read())
+        key = jwk.JWK.generate(kty='RSA', size=2048)
+        with open(path, 'wb') as f:
+            f.write(key.export_to_pem(private_key=True, password=None))
+        self.stdout.write(
+            f'Ключ записан в {path}. Запустите серверы ws и API с KEYCLOAK_TEST_PUBLIC_KEY:\n'
+            f'{key.export_to_pem().decode()}'
+        )
+        return None
+
+    def write_report(self, report: dict) -> None:
+        connect, delivery, server = report['connect'], report['delivery'], report['server']
+        self.stdout.write(
+            f'sockets: {connect["opened"]}/{connect["sockets"]}, connect p95: {connect["latency_ms"]["p95"]:.1f}ms\n'
+            f'messages sent: {report["messages"]["sent"]}, http errors: {report["messages"]["errors"]}, '
+            f'http p95: {report["messages"]["latency_ms"]["p95"]:.1f}ms\n'
+            f'deliveries: {delivery["received"]}/{delivery["expected"]} '
+            f'({delivery["completeness"] * 100:.2f}%), events/sec: {delivery["events_per_second"]:.1f}\n'
+            f'delivery latency ms p50: {delivery["latency_ms"]["p50"]:.1f} p95: {delivery["latency_ms"]["p95"]:.1f} '
+            f'p99: {delivery["latency_ms"]["p99"]:.1f}'
+        )
+        if server['pids']:
+            self.stdout.write(
+                f'server rss KB per connection: {server["rss_kb_per_connection"]}, '
+                f'cpu ms per event: {server["cpu_ms_per_event"]}'
+            )
+        if report['redis'] is not None:
+            self.stdout.write(
+                f'redis commands per message: {report["redis"]["commands_per_message"]}, '
+                f'redis KB per message: {report["redis"]["kb_per_message"]}, '
+                f'top: {report["redis"]["top_commands"]}'
+            )
+
+    def compare(self, previous: dict, current: dict) -> None:
+        self.stdout.write(f'\nсравнение с отчетом {previous["created_at"]}:')
+        rows = (
+            ('completeness', ('delivery', 'completeness')),
+            ('delivery p50 ms', ('delivery', 'latency_ms', 'p50')),
+            ('delivery p95 ms', ('delivery', 'latency_ms', 'p95')),
+            ('delivery p99 ms', ('delivery', 'latency_ms', 'p99')),
+            ('events/sec', ('delivery', 'events_per_second')),
+            ('rss KB per connection', ('server', 'rss_kb_per_connection')),
+            ('cpu ms per event', ('server', 'cpu_ms_per_event')),
+            ('redis commands per msg', ('redis', 'commands_per_message')),
+            ('redis KB per msg', ('redis', 'kb_per_message')),
+        )
+        for title, path in rows:
+            before, after = previous, current
+            for part in path:
+                before, after = (before or {}).get(part, {}), (after or {}).get(part, {})
+            if isinstance(before, (int, float)) and isinstance(after, (int, float)):
+                change = f'{(after - before) / before * 100:+.1f}%' if before else 'n/a'
+                self.stdout.write(f'{title:<24} {before:>12.3f} -> {after:>12.3f} ({change})')
+
+
+class Harness:
+    """Подключение сокетов, отправка сообщений и учет доставки в одном event loop"""
+
+    def __init__(self, options: dict, sockets: list, senders: list):
+        self.options = options
+        self.sockets = sockets
+        self.senders = senders
+        self.ws_urls = options['ws_url'] or [DEFAULT_WS_URL]
+        self.api_url = urlsplit(options['api_url'])
+        self.sent = {}  # marker -> (time.perf_counter() отправки, ожидаемых доставок)
+        self.deliveries = {}  # marker -> доставлено
+        self.delivery_latencies = []
+        self.local = threading.local()
+
+    def on_message(self, payload: bytes) -> None:
+        received = time.perf_counter()
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            return
+        if not isinstance(event, dict) or event.get('event_type') != 'new_message':
+            return
+        text = (event.get('data') or {}).get('text') or ''
+        if not text.startswith(MARKER) or text not in self.sent:
+            return
+        self.deliveries[text] = self.deliveries.get(text, 0) + 1
+        self.delivery_latencies.append(received - self.sent[text][0])
+
+    async def run(self) -> dict:
+        pids = self.options['pid']
+        rss_before = MessagesBenchmark.get_rss(pids)
+        connect_latencies = await self.connect_all()
+        opened = [socket for socket in self.sockets if socket.protocol is not None and not socket.closed]
+        await asyncio.sleep(1)
+        rss_connected = MessagesBenchmark.get_rss(pids)
+
+        keepalive = asyncio.create_task(self.keepalive())
+        cpu_before = get_cpu_seconds(pids)
+        redis_before = get_redis_stats()
+        started = time.perf_counter()
+        http_latencies, errors = await self.send_messages(opened)
+        await asyncio.sleep(self.options['drain'])
+        elapsed = time.perf_counter() - started
+        cpu_used = get_cpu_seconds(pids) - cpu_before
+        redis_after = get_redis_stats()
+        keepalive.cancel()
+
+        for socket in opened:
+            socket.protocol.sendClose()
+        await asyncio.sleep(0.5)
+
+        expected = sum(count for _, count in self.sent.values())
+        received = sum(self.deliveries.values())
+        connections = len(opened)
+        return {
+            'connect': {
+                'sockets': len(self.sockets),
+                'opened': connections,
+                'latency_ms': get_percentiles(connect_latencies),
+            },
+            'messages': {
+                'sent': len(self.sent),
+                'errors': errors,
+                'latency_ms': get_percentiles(http_latencies),
+            },
+            'delivery': {
+                'expected': expected,
+                'received': received,
+                'completeness': round(received / expected, 5) if expected else 0,
+                'events_per_second': round(received / elapsed, 2),
+                'latency_ms': get_percentiles(self.delivery_latencies),
+            },
+            'server': {
+                'pids': pids,
+                'rss_kb_before': rss_before,
+                'rss_kb_connected': rss_connected,
+                'rss_kb_per_connection': round((rss_connected - rss_before) / connections, 2)
+                if pids and connections else None,
+                'cpu_seconds': round(cpu_used, 3),
+                'cpu_ms_per_event': round(cpu_used * 1000 / received, 4) if pids and received else None,
+            },
+            'redis': get_redis_usage(redis_before, redis_after, len(self.sent)),
+        }
+
+    async def connect_all(self) -> list:
+        loop = asyncio.get_running_loop()
+        latencies = []
+
+        async def connect(socket: LoadSocket, ws_url: str):
+            socket.opened = loop.create_future()
+            factory = WebSocketClientFactory(f'{ws_url}?token={socket.token}')
+            factory.protocol = LoadClientProtocol
+            factory.socket = socket
+            factory.harness = self
+            url = urlsplit(ws_url)
+            started = time.perf_counter()
+            try:
+                await loop.create_connection(factory, url.hostname, url.port or 80)
+                if await asyncio.wait_for(socket.opened, timeout=30):
+                    latencies.append(time.perf_counter() - started)
+            except (OSError, asyncio.TimeoutError):
+                socket.closed = True
+
+        tasks = []
+        for number, socket in enumerate(self.sockets):
+            tasks.append(asyncio.create_task(connect(socket, self.ws_urls[number % len(self.ws_urls)])))
+            await asyncio.sleep(1 / self.options['connect_rate'])
+        await asyncio.gather(*tasks)
+        return latencies
+
+    async def keepalive(self) -> None:
+        while True:
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
+            for socket in self.sockets:
+                if socket.protocol is not None and not socket.closed:
+                    socket.protocol.sendMessage(PING)
+
+    async def send_messages(self, opened: list) -> tuple:
+        """Сообщения с постоянной частотой, получатели - все кураторы и сокет клиента чата"""
+        loop = asyncio.get_running_loop()
+        curators = sum(1 for socket in opened if socket.role == UserRole.CURATOR)
+        online_clients = {socket.token for socket in opened if socket.role == UserRole.CLIENT}
+        senders = [sender for sender in self.senders if sender[0] in online_clients]
+        latencies, errors = [], 0
+        semaphore = asyncio.Semaphore(self.options['http_concurrency'])
+        executor = ThreadPoolExecutor(self.options['http_concurrency'])
+
+        async def send(number: int):
+            nonlocal errors
+            token, chat_id = senders[number % len(senders)]
+            marker = f'{MARKER}{number}'
+            async with semaphore:
+                self.sent[marker] = (time.perf_counter(), curators + 1)
+                started = time.perf_counter()
+                ok = await loop.run_in_executor(executor, self.post_message, token, chat_id, marker)
+                latencies.append(time.perf_counter() - started)
+            if not ok:
+                errors += 1
+                self.sent.pop(marker, None)
+
+        tasks = []
+        if senders:
+            deadline = time.perf_counter() + self.options['duration']
+            number = 0
+            while time.perf_counter() < deadline:
+                tasks.append(asyncio.create_task(send(number)))
+                number += 1
+                await asyncio.sleep(1 / self.options['rate'])
+            await asyncio.gather(*tasks)
+        executor.shutdown()
+        return latencies, errors
+
+    def post_message(self, token: str, chat_id: int, text: str) -> bool:
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = http.client.HTTPConnection(
+                self.api_url.hostname, self.api_url.port or 80, timeout=60
+            )
+        body = {'chat': chat_id, 'text': text, 'message_type': MessageType.TEXT}
+        try:
+            connection.request(
+                'POST', '/api/v1/client/chats/messages/', body=json.dumps(body),
+                headers={'Authorization': token, 'Content-Type': 'application/json'}
+            )
+            response = connection.getresponse()
+            response.read()
+            return response.status == 201
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            self.local.connection = None
+            return False
+
+
+def get_cpu_seconds(pids: list) -> float:
+    """CPU (user + system) процессов в секундах (Linux /proc), потомки не учитываются"""
+    ticks = os.sysconf('SC_CLK_TCK')
+    total = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        total += int(fields[11]) + int(fields[12])
+    return total / ticks
+
+
+
+def get_redis_stats():
+    """
+    Счетчики команд и сетевого трафика (INFO) всех хостов Redis: кэш, channel layer, присутствие.
+    None - Redis недоступен
+    """
+    hosts = {
+        (settings.CACHE_REDIS_HOST, settings.CACHE_REDIS_PORT),
+        *settings.CHANNEL_LAYER_REDIS_HOSTS, *settings.CHANNEL_LAYER_REDIS_PREVIOUS_HOSTS,
+        *settings.PRESENCE_REDIS_HOSTS, *settings.PRESENCE_REDIS_PREVIOUS_HOSTS,
+    }
+    result = {'commands': {}, 'net_bytes': 0}
+    for host, port in hosts:
+        try:
+            client = redis.Redis(host=host, port=port, socket_timeout=5)
+            commands = client.info('commandstats')
+            stats = client.info('stats')
+        except redis.RedisError:
+            return None
+        for name, value in commands.items():
+            name = name.removeprefix('cmdstat_')
+            result['commands'][name] = result['commands'].get(name, 0) + value['calls']
+        result['net_bytes'] += stats['total_net_input_bytes'] + stats['total_net_output_bytes']
+    return result
+
+
+def get_redis_usage(before, after, messages: int):
+    """Команды и трафик Redis за время отправки сообщений, включая кэш и запросы API"""
+    if before is None or after is None or not messages:
+        return None
+    commands = {
+        name: calls - before['commands'].get(name, 0) for name, calls in after['commands'].items()
+        if calls > before['commands'].get(name, 0)
+    }
+    total = sum(commands.values())
+    return {
+        'commands': total,
+        'commands_per_message': round(total / messages, 2),
+        'kb_per_message': round((after['net_bytes'] - before['net_bytes']) / 1024 / messages, 2),
+        'top_commands': dict(sorted(commands.items(), key=lambda item: item[1], reverse=True)[:5]),
+    }
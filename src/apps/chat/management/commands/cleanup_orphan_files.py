@@ -0,0 +1,73 @@
+import datetime
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from apps.chat.models import ChatFile, ChatMessageFile, FileDeletion
+
+CHAT_FILES_ROOT = 'Chat'
+
+
+class Command(BaseCommand):
+    help = 'Сверка хранилища с БД: исправляет счетчики ссылок и ставит в очередь удаления файлы-сироты'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Только показать, ничего не менять')
+        parser.add_argument('--grace', type=int, default=settings.ORPHAN_FILES_GRACE_PERIOD)
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        self.fix_ref_counts(dry_run)
+
+        storage = ChatFile._meta.get_field('file').storage
+        threshold = timezone.now() - datetime.timedelta(seconds=options['grace'])
+        orphans = []
+        for names in self.walk(storage, CHAT_FILES_ROOT):
+            referenced = set(ChatFile.objects.filter(file__in=names).values_list('file', flat=True))
+            referenced |= set(ChatMessageFile.objects.filter(file__in=names).values_list('file', flat=True))
+            referenced |= set(FileDeletion.objects.filter(name__in=names).values_list('name', flat=True))
+            for name in names:
+                if name not in referenced and storage.get_modified_time(name) < threshold:
+                    orphans.append(name)
+
+        self.stdout.write(f'Файлов-сирот: {len(orphans)}')
+        if not dry_run:
+            FileDeletion.objects.bulk_create(
+                [FileDeletion(name=name) for name in orphans], batch_size=settings.FILE_DELETION_BATCH_SIZE
+            )
+
+    def fix_ref_counts(self, dry_run: bool) -> None:
+        """Счетчик ссылок ChatFile приводится к фактическому количеству ChatMessageFile"""
+        actual = ChatMessageFile.objects.filter(
+            sha256=OuterRef('sha256')
+        ).order_by().values('sha256').annotate(count=Count('id')).values('count')
+        chat_files = ChatFile.objects.annotate(
+            actual_ref_count=Coalesce(Subquery(actual), 0)
+        )
+        for chat_file in chat_files.iterator(chunk_size=settings.FILE_DELETION_BATCH_SIZE):
+            if chat_file.ref_count == chat_file.actual_ref_count:
+                continue
+            self.stdout.write(
+                f'{chat_file.sha256}: ref_count {chat_file.ref_count} -> {chat_file.actual_ref_count}'
+            )
+            if dry_run:
+                continue
+            if chat_file.actual_ref_count == 0:
+                chat_file.delete()
+                FileDeletion.objects.create(name=chat_file.file.name)
+            else:
+                ChatFile.objects.filter(id=chat_file.id).update(ref_count=chat_file.actual_ref_count)
+
+    def walk(self, storage, path: str):
+        """Обход хранилища, отдает пути файлов пачками по каталогам"""
+        if not storage.exists(path):
+            return
+        directories, files = storage.listdir(path)
+        if files:
+            yield [os.path.join(path, name) for name in files]
+        for directory in directories:
+            yield from self.walk(storage, os.path.join(path, directory))
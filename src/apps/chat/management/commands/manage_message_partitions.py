@@ -0,0 +1,38 @@
+import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.chat.partitions import (
+    SCHEMA_NAME_RE, create_message_partitions, detach_message_partition, get_message_partitions, next_month,
+    partition_month
+)
+
+
+class Command(BaseCommand):
+    help = 'Создание будущих помесячных партиций chat_messages и отсоединение старых для архивации'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months-ahead', type=int, default=settings.CHAT_MESSAGES_PARTITIONS_AHEAD)
+        parser.add_argument('--detach-before', type=str, help='YYYY-MM, отсоединить партиции старше этого месяца')
+        parser.add_argument('--schema', type=str, default=None, help='Схема для отсоединенных партиций')
+
+    def handle(self, *args, **options):
+        end = datetime.date.today()
+        for _ in range(options['months_ahead']):
+            end = next_month(end)
+        for name in create_message_partitions(datetime.date.today(), end):
+            self.stdout.write(f'Создана партиция {name}')
+
+        if options['detach_before']:
+            try:
+                detach_before = datetime.datetime.strptime(options['detach_before'], '%Y-%m').date()
+            except ValueError:
+                raise CommandError('--detach-before в формате YYYY-MM')
+            if options['schema'] and not SCHEMA_NAME_RE.match(options['schema']):
+                raise CommandError('--schema: только буквы, цифры и _')
+            for name in get_message_partitions():
+                month = partition_month(name)
+                if month is not None and month < detach_before:
+                    detach_message_partition(name, options['schema'])
+                    self.stdout.write(f'Отсоединена партиция {name}')
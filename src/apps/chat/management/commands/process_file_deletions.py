@@ -0,0 +1,27 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from loguru import logger
+
+from apps.chat.models import FileDeletion
+
+
+class Command(BaseCommand):
+    help = 'Удаление файлов из хранилища по очереди FileDeletion'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Работать постоянно')
+        parser.add_argument('--batch-size', type=int, default=settings.FILE_DELETION_BATCH_SIZE)
+        parser.add_argument('--interval', type=int, default=settings.FILE_DELETION_INTERVAL)
+
+    def handle(self, *args, **options):
+        while True:
+            processed = 0
+            while count := FileDeletion.objects.process_batch(options['batch_size']):
+                processed += count
+            if processed:
+                logger.info(f'process_file_deletions: processed {processed}')
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,88 @@
+import json
+import os
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = (
+        'Сводка профилей из PROFILING_DIR: самые частые кадры по собственным (self) и '
+        'накопленным (total) сэмплам и самые медленные обработки. '
+        '--folded сохраняет объединенные стеки для flamegraph.pl/speedscope'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=None, help='Каталог профилей, по умолчанию PROFILING_DIR')
+        parser.add_argument('--kind', choices=('http', 'ws'), default=None)
+        parser.add_argument('--name', default=None, help='Подстрока пути запроса или обработчика consumer')
+        parser.add_argument('--min-duration', type=float, default=0, help='Секунды')
+        parser.add_argument('--limit', type=int, default=25)
+        parser.add_argument('--folded', default=None, help='Файл для объединенных стеков')
+
+    def handle(self, *args, **options):
+        profiles = self.load(options)
+        if not profiles:
+            self.stdout.write('Профили не найдены')
+            return
+
+        stacks = Counter()
+        for profile in profiles:
+            stacks.update(profile['samples'])
+        total = sum(stacks.values())
+        own, cumulative = Counter(), Counter()
+        for stack, count in stacks.items():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for frame in set(frames):
+                cumulative[frame] += count
+
+        self.stdout.write(
+            f'profiles: {len(profiles)}, samples: {total}, '
+            f'idle samples: {sum(profile["idle_samples"] for profile in profiles)}'
+        )
+        for title, counter in (('self', own), ('total', cumulative)):
+            self.stdout.write(f'\nhottest frames by {title} samples:')
+            for frame, count in counter.most_common(options['limit']):
+                self.stdout.write(f'{count:>8} {count / max(total, 1) * 100:6.1f}%  {frame}')
+
+        self.stdout.write('\nslowest:')
+        for profile in sorted(profiles, key=lambda item: item['duration'], reverse=True)[:options['limit']]:
+            meta = profile['meta']
+            self.stdout.write(
+                f'{profile["duration"] * 1000:>10.1f}ms  {profile["kind"]} {profile["name"]} '
+                f'status={meta.get("status")} user={meta.get("user_id")} trace={meta.get("trace_id")} '
+                f'{profile["file"]}'
+            )
+
+        if options['folded']:
+            with open(options['folded'], 'w') as f:
+                for stack, count in stacks.most_common():
+                    f.write(f'{stack} {count}\n')
+            self.stdout.write(f'\nfolded stacks: {options["folded"]}')
+
+    @staticmethod
+    def load(options: dict) -> list:
+        directory = options['dir'] or settings.PROFILING_DIR
+        if not os.path.isdir(directory):
+            return []
+        profiles = []
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                with open(path) as f:
+                    profile = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if options['kind'] and profile['kind'] != options['kind']:
+                continue
+            if options['name'] and options['name'] not in profile['name']:
+                continue
+            if profile['duration'] < options['min_duration']:
+                continue
+            profile['file'] = name
+            profiles.append(profile)
+        return profiles
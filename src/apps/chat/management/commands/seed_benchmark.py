@@ -0,0 +1,244 @@
+import datetime
+import hashlib
+import io
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection
+from django.utils import timezone
+
+from apps.chat.models import Chat, ChatComment, ChatFile, ChatMessage, ChatMessageFile, ChatTopic
+from apps.chat.partitions import create_message_partitions
+from apps.chat.topics import invalidate_permission_topics
+from apps.chat.utils import ChatStatus, ChatType, MessageType
+from apps.users.models import User
+from apps.users.utils import UserRole
+
+TEXTS = (
+    'Здравствуйте', 'Добрый день, подскажите пожалуйста', 'Спасибо!', 'Хорошо, жду ответа',
+    'Не могу оплатить заказ, карта не проходит', 'Когда будет доставка?', 'Проверьте, пожалуйста, статус',
+    'Сейчас уточню и вернусь с ответом', 'Ваш вопрос передан специалисту', 'Вопрос решен, чат закрываю',
+    'Пришлите, пожалуйста, номер заказа', 'Курс не открывается после оплаты, пишет ошибку доступа',
+)
+EMOJIS = ('👍', '🙏', '😊', '👌', '🔥')
+FILE_NAMES = ('document.pdf', 'scan.jpg', 'photo.png', 'report.xlsx', 'contract.docx', 'video.mp4')
+# статусы чатов и их доли
+STATUSES = (
+    (ChatStatus.CLOSED, 0.7), (ChatStatus.IN_PROGRESS, 0.1), (ChatStatus.OPEN, 0.15), (ChatStatus.DELAYED, 0.05),
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Синтетические данные для бенчмарков (только PostgreSQL, отдельная БД): темы, клиенты, кураторы, '
+        'чаты и сообщения с неравномерным распределением (Парето) сообщений по чатам, файлы и комментарии. '
+        'Чаты, сообщения, файлы и комментарии загружаются через COPY, результат воспроизводим при одном --seed'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--topics', type=int, default=50)
+        parser.add_argument('--clients', type=int, default=100_000)
+        parser.add_argument('--curators', type=int, default=500)
+        parser.add_argument('--chats', type=int, default=1_000_000)
+        parser.add_argument('--messages', type=int, default=50_000_000, help='Приблизительно, всего сообщений')
+        parser.add_argument('--max-chat-messages', type=int, default=20_000)
+        parser.add_argument('--skew', type=float, default=1.5, help='Параметр Парето (>1), меньше - неравномернее')
+        parser.add_argument('--order-ratio', type=float, default=0.1, help='Доля чатов-заказов')
+        parser.add_argument('--file-ratio', type=float, default=0.02, help='Доля сообщений с файлом')
+        parser.add_argument('--distinct-files', type=int, default=5000, help='Уникальных файлов (ChatFile)')
+        parser.add_argument('--comment-ratio', type=float, default=0.05, help='Доля чатов с комментариями')
+        parser.add_argument('--days', type=int, default=365, help='Период создания чатов')
+        parser.add_argument('--batch-size', type=int, default=10_000, help='Чатов за один проход')
+        parser.add_argument('--prefix', default='seed', help='Префикс логинов и прав тем')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('seed_benchmark работает только с PostgreSQL')
+        if options['skew'] <= 1:
+            raise CommandError('--skew должен быть больше 1')
+        prefix = options['prefix']
+        if User.objects.filter(username__startswith=f'{prefix}_').exists():
+            raise CommandError(f'Данные с префиксом {prefix} уже загружены')
+
+        self.rng = random.Random(options['seed'])
+        self.now = timezone.now()
+        started = time.perf_counter()
+
+        topics = self.create_topics(options)
+        clients = self.create_users(UserRole.CLIENT, options['clients'], prefix)
+        curators = self.create_users(UserRole.CURATOR, options['curators'], prefix)
+        self.stdout.write(f'topics: {len(topics)}, clients: {len(clients)}, curators: {len(curators)}')
+
+        create_message_partitions((self.now - datetime.timedelta(days=options['days'])).date(), self.now.date())
+        files = self.make_files(options)
+        totals = self.load_chats(options, topics, clients, curators, files)
+        self.load_files(files)
+
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(
+                no_style(), [Chat, ChatMessage, ChatMessageFile, ChatFile, ChatComment]
+            ):
+                cursor.execute(sql)
+            for model in (Chat, ChatMessage, ChatMessageFile, ChatFile, ChatComment):
+                cursor.execute(f'ANALYZE {model._meta.db_table}')
+
+        self.stdout.write(
+            f'chats: {totals["chats"]}, messages: {totals["messages"]}, message files: {totals["files"]}, '
+            f'comments: {totals["comments"]}, {time.perf_counter() - started:.0f}s'
+        )
+
+    def create_topics(self, options: dict) -> list:
+        topics = ChatTopic.objects.bulk_create([
+            ChatTopic(
+                title=f'Тема {i}', description=f'Синтетическая тема {i}', permission=f'{options["prefix"]}_topic_{i}'
+            )
+            for i in range(options['topics'])
+        ])
+        invalidate_permission_topics()
+        return [topic.pk for topic in topics]
+
+    @staticmethod
+    def create_users(role: str, count: int, prefix: str) -> list:
+        users = User.objects.bulk_create(
+            [User(username=f'{prefix}_{role}_{i}', role=role, name=f'{role} {i}') for i in range(count)],
+            batch_size=5000
+        )
+        return [user.pk for user in users]
+
+    def make_files(self, options: dict) -> list:
+        """Уникальные файлы: [sha256, path, size, ref_count], содержимое в хранилище не создается"""
+        files = []
+        for i in range(options['distinct_files']):
+            sha256 = hashlib.sha256(f'{options["prefix"]}-{options["seed"]}-{i}'.encode()).hexdigest()
+            size = int(self.rng.lognormvariate(12, 1.5))
+            files.append([sha256, f'Chat/files/{sha256[:2]}/{sha256}', size, 0])
+        return files
+
+    def load_chats(self, options: dict, topics: list, clients: list, curators: list, files: list) -> dict:
+        rng = self.rng
+        totals = {'chats': 0, 'messages': 0, 'files': 0, 'comments': 0}
+        # популярность тем и клиентов убывает по закону Ципфа
+        topic_weights = [1 / (i + 1) for i in range(len(topics))]
+        statuses, status_weights = zip(*STATUSES)
+        mean_weight = options['skew'] / (options['skew'] - 1)
+        per_chat = options['messages'] / max(options['chats'], 1)
+        period = options['days'] * 86400
+        start = self.now.timestamp() - period
+        now = self.now.timestamp()
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM chats')
+            chat_id = cursor.fetchone()[0]
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM chat_messages')
+            message_id = cursor.fetchone()[0]
+            cursor.execute('SELECT COALESCE(MAX(id), 0) FROM chat_message_files')
+            message_file_id = cursor.fetchone()[0]
+
+        writer = CopyWriter()
+        for number in range(options['chats']):
+            chat_id += 1
+            created = start + period * number / options['chats'] + rng.random() * 60
+            client = clients[int(len(clients) * rng.random() ** 2)]
+            if rng.random() < options['order_ratio']:
+                chat_type, topic, status = ChatType.ORDER, None, rng.choices(statuses, status_weights)[0]
+                curator = rng.choice(curators)
+            else:
+                chat_type, status = ChatType.TOPIC, rng.choices(statuses, status_weights)[0]
+                topic = rng.choices(topics, topic_weights)[0]
+                curator = None if status == ChatStatus.OPEN else rng.choice(curators)
+
+            count = min(
+                options['max_chat_messages'],
+                max(1, int(rng.paretovariate(options['skew']) * per_chat / mean_weight))
+            )
+            unread = 0 if status == ChatStatus.CLOSED else rng.randint(0, 3)
+            moment = created
+            for i in range(count):
+                message_id += 1
+                moment = min(moment + rng.expovariate(1 / 300), now)
+                sender = curator if curator is not None and rng.random() < 0.45 else client
+                roll = rng.random()
+                if roll < options['file_ratio']:
+                    message_type, text = MessageType.FILE, None
+                    message_file_id += 1
+                    chat_file = files[int(len(files) * rng.random() ** 3)]
+                    chat_file[3] += 1
+                    writer.add(
+                        'chat_message_files', message_file_id, format_time(moment), format_time(moment),
+                        chat_file[1], message_id, chat_file[0], rng.choice(FILE_NAMES)
+                    )
+                    totals['files'] += 1
+                elif roll < options['file_ratio'] + 0.03:
+                    message_type, text = MessageType.EMOJI, rng.choice(EMOJIS)
+                else:
+                    message_type, text = MessageType.TEXT, rng.choice(TEXTS)
+                writer.add(
+                    'chat_messages', message_id, format_time(moment), format_time(moment), text, message_type,
+                    i < count - unread, chat_id, sender
+                )
+            totals['messages'] += count
+
+            if curator is not None and rng.random() < options['comment_ratio']:
+                for _ in range(rng.randint(1, 3)):
+                    writer.add(
+                        'chat_comments', format_time(moment), format_time(moment), 'Комментарий куратора',
+                        chat_id, curator
+                    )
+                    totals['comments'] += 1
+
+            writer.add(
+                'chats', chat_id, format_time(moment), format_time(created), status, chat_type, client, curator, topic
+            )
+            totals['chats'] += 1
+            if totals['chats'] % options['batch_size'] == 0 or totals['chats'] == options['chats']:
+                writer.flush()
+                self.stdout.write(f'chats: {totals["chats"]}, messages: {totals["messages"]}')
+        return totals
+
+    @staticmethod
+    def load_files(files: list) -> None:
+        writer = CopyWriter()
+        moment = format_time(timezone.now().timestamp())
+        for sha256, path, size, ref_count in files:
+            if ref_count:
+                writer.add('chat_files', moment, moment, sha256, path, size, ref_count)
+        writer.flush()
+
+
+def format_time(timestamp: float) -> str:
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).isoformat()
+
+
+class CopyWriter:
+    """Буферы строк для COPY по таблицам, чаты записываются раньше ссылающихся на них таблиц"""
+    COLUMNS = {
+        'chats': ('id', 'updated_at', 'created_at', 'status', 'chat_type', 'client_id', 'curator_id', 'topic_id'),
+        'chat_messages': (
+            'id', 'updated_at', 'created_at', 'text', 'message_type', 'is_read', 'chat_id', 'sender_id'
+        ),
+        'chat_message_files': ('id', 'updated_at', 'created_at', 'file', 'message_id', 'sha256', 'name'),
+        'chat_comments': ('updated_at', 'created_at', 'text', 'chat_id', 'curator_id'),
+        'chat_files': ('updated_at', 'created_at', 'sha256', 'file', 'size', 'ref_count'),
+    }
+
+    def __init__(self):
+        self.buffers = {table: io.StringIO() for table in self.COLUMNS}
+
+    def add(self, table: str, *values) -> None:
+        self.buffers[table].write('\t'.join(
+            '\\N' if value is None else ('t' if value else 'f') if isinstance(value, bool) else str(value)
+            for value in values
+        ))
+        self.buffers[table].write('\n')
+
+    def flush(self) -> None:
+        with connection.cursor() as cursor:
+            for table, buffer in self.buffers.items():
+                if not buffer.tell():
+                    continue
+                buffer.seek(0)
+                cursor.copy_expert(f'COPY {table} ({", ".join(self.COLUMNS[table])}) FROM STDIN', buffer)
+                self.buffers[table] = io.StringIO()
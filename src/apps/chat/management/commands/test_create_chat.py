@@ -10,7 +10,7 @@ from apps.users.models import User
 class Command(BaseCommand):
 
     def handle(self, *args, **options):
-        Chat.objects.all().delete()
+        Chat.objects.delete_batched(Chat.objects.values_list('id', flat=True))
         client = User.objects.get(id=99)
         curator = User.objects.get(id=55)
         topics = ChatTopic.objects.all()
@@ -0,0 +1,31 @@
+# Generated by Django 5.0.14 on 2026-10-19 12:07
+
+from django.db import migrations, models
+
+from apps.chat.utils import get_file_sha256
+
+
+def fill_sha256(apps, schema_editor):
+    ChatMessageFile = apps.get_model('chat', 'ChatMessageFile')
+    for message_file in ChatMessageFile.objects.filter(sha256='').iterator(chunk_size=500):
+        try:
+            message_file.sha256 = get_file_sha256(message_file.file)
+        except (FileNotFoundError, ValueError):
+            continue
+        message_file.save(update_fields=('sha256',))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_remove_chat_closed_at_remove_chat_curator_note_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessagefile',
+            name='sha256',
+            field=models.CharField(blank=True, default='', max_length=64, verbose_name='SHA-256 содержимого'),
+        ),
+        migrations.RunPython(fill_sha256, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 5.0.14 on 2026-10-19 12:09
+
+import os
+
+import apps.chat.models
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def fill_chat_files(apps, schema_editor):
+    """
+    Существующие файлы сообщений переводятся на общий ChatFile по хэшу,
+    дубликаты в хранилище остаются сиротами и удаляются командой очистки
+    """
+    ChatFile = apps.get_model('chat', 'ChatFile')
+    ChatMessageFile = apps.get_model('chat', 'ChatMessageFile')
+
+    for message_file in ChatMessageFile.objects.filter(name='').iterator(chunk_size=500):
+        message_file.name = os.path.basename(message_file.file.name)
+        message_file.save(update_fields=('name',))
+
+    groups = ChatMessageFile.objects.exclude(sha256='').values('sha256').annotate(
+        ref_count=Count('id'), first_id=Min('id')
+    )
+    for group in groups.iterator(chunk_size=500):
+        first = ChatMessageFile.objects.get(id=group['first_id'])
+        try:
+            size = first.file.size
+        except (FileNotFoundError, ValueError):
+            size = 0
+        ChatFile.objects.create(
+            sha256=group['sha256'], file=first.file.name, size=size, ref_count=group['ref_count']
+        )
+        ChatMessageFile.objects.filter(sha256=group['sha256']).update(file=first.file.name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_chatmessagefile_sha256'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата обновления')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('sha256', models.CharField(max_length=64, unique=True, verbose_name='SHA-256 содержимого')),
+                ('file', models.FileField(max_length=255, upload_to=apps.chat.models.ChatFile._get_file_path, verbose_name='Файл')),
+                ('size', models.PositiveBigIntegerField(default=0, verbose_name='Размер')),
+                ('ref_count', models.PositiveIntegerField(default=0, verbose_name='Количество ссылок')),
+            ],
+            options={
+                'verbose_name': 'Файл',
+                'verbose_name_plural': 'Файлы',
+                'db_table': 'chat_files',
+            },
+        ),
+        migrations.AddField(
+            model_name='chatmessagefile',
+            name='name',
+            field=models.CharField(blank=True, default='', max_length=255, verbose_name='Имя файла'),
+        ),
+        migrations.RunPython(fill_chat_files, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,124 @@
+# Generated by Django 5.0.14 on 2026-10-19 12:12
+
+import datetime
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+from apps.chat.partitions import DEFAULT_PARTITION, MESSAGES_TABLE, create_message_partitions, next_month
+
+
+def partition_chat_messages(apps, schema_editor):
+    """
+    Перенос chat_messages в таблицу, партиционированную по created_at.
+    PK становится (id, created_at), id выдается из отдельной последовательности.
+    Все сообщения копируются одним INSERT в транзакции миграции, chat_messages заблокирована до конца
+    копирования - миграция выполняется в окно обслуживания (см. README), откат - unpartition_chat_messages
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE {MESSAGES_TABLE} RENAME TO {MESSAGES_TABLE}_old')
+        cursor.execute(
+            f"""
+            CREATE TABLE {MESSAGES_TABLE} (
+                id bigint NOT NULL,
+                updated_at timestamp with time zone NOT NULL,
+                created_at timestamp with time zone NOT NULL,
+                text text NULL,
+                message_type varchar(25) NOT NULL,
+                is_read boolean NOT NULL,
+                chat_id bigint NOT NULL REFERENCES chats (id) DEFERRABLE INITIALLY DEFERRED,
+                sender_id bigint NOT NULL REFERENCES users (id) DEFERRABLE INITIALLY DEFERRED,
+                PRIMARY KEY (id, created_at)
+            ) PARTITION BY RANGE (created_at)
+            """
+        )
+        cursor.execute(f'CREATE INDEX {MESSAGES_TABLE}_id_idx ON {MESSAGES_TABLE} (id)')
+        cursor.execute(f'CREATE INDEX {MESSAGES_TABLE}_chat_id_created_at_idx ON {MESSAGES_TABLE} (chat_id, created_at)')
+        cursor.execute(f'CREATE INDEX {MESSAGES_TABLE}_sender_id_idx ON {MESSAGES_TABLE} (sender_id)')
+        cursor.execute(f'CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {MESSAGES_TABLE} DEFAULT')
+
+        cursor.execute(f'SELECT min(created_at) FROM {MESSAGES_TABLE}_old')
+        start = cursor.fetchone()[0] or datetime.datetime.now(datetime.timezone.utc)
+        end = datetime.date.today()
+        for _ in range(settings.CHAT_MESSAGES_PARTITIONS_AHEAD):
+            end = next_month(end)
+        create_message_partitions(start.date(), end)
+
+        cursor.execute(
+            f"""
+            INSERT INTO {MESSAGES_TABLE} (id, updated_at, created_at, text, message_type, is_read, chat_id, sender_id)
+            SELECT id, updated_at, created_at, text, message_type, is_read, chat_id, sender_id
+            FROM {MESSAGES_TABLE}_old
+            """
+        )
+        # проверка отложенных внешних ключей до последующих ALTER TABLE
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        cursor.execute(f'SELECT coalesce(max(id), 0) + 1 FROM {MESSAGES_TABLE}_old')
+        next_id = cursor.fetchone()[0]
+        cursor.execute(f'DROP TABLE {MESSAGES_TABLE}_old')
+        cursor.execute(f'CREATE SEQUENCE {MESSAGES_TABLE}_id_seq OWNED BY {MESSAGES_TABLE}.id')
+        cursor.execute('SELECT setval(%s, %s, false)', [f'{MESSAGES_TABLE}_id_seq', next_id])
+        cursor.execute(
+            f"ALTER TABLE {MESSAGES_TABLE} ALTER COLUMN id SET DEFAULT nextval('{MESSAGES_TABLE}_id_seq')"
+        )
+
+
+def unpartition_chat_messages(apps, schema_editor):
+    """
+    Откат: сообщения присоединенных партиций копируются в обычную таблицу chat_messages с PK id,
+    как до миграции. Партиции, отсоединенные manage_message_partitions --detach-before, не возвращаются
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE {MESSAGES_TABLE} RENAME TO {MESSAGES_TABLE}_partitioned')
+        cursor.execute(
+            f"""
+            CREATE TABLE {MESSAGES_TABLE} (
+                id bigint NOT NULL PRIMARY KEY GENERATED BY DEFAULT AS IDENTITY,
+                updated_at timestamp with time zone NOT NULL,
+                created_at timestamp with time zone NOT NULL,
+                text text NULL,
+                message_type varchar(25) NOT NULL,
+                is_read boolean NOT NULL,
+                chat_id bigint NOT NULL REFERENCES chats (id) DEFERRABLE INITIALLY DEFERRED,
+                sender_id bigint NOT NULL REFERENCES users (id) DEFERRABLE INITIALLY DEFERRED
+            )
+            """
+        )
+        cursor.execute(
+            f"""
+            INSERT INTO {MESSAGES_TABLE} (id, updated_at, created_at, text, message_type, is_read, chat_id, sender_id)
+            SELECT id, updated_at, created_at, text, message_type, is_read, chat_id, sender_id
+            FROM {MESSAGES_TABLE}_partitioned
+            """
+        )
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        # вместе с партициями и последовательностью chat_messages_id_seq; имена индексов отличаются от индексов
+        # партиционированной таблицы, которые создаст повторная миграция
+        cursor.execute(f'DROP TABLE {MESSAGES_TABLE}_partitioned')
+        cursor.execute(f'CREATE INDEX {MESSAGES_TABLE}_chat_id_fk_idx ON {MESSAGES_TABLE} (chat_id)')
+        cursor.execute(f'CREATE INDEX {MESSAGES_TABLE}_sender_id_fk_idx ON {MESSAGES_TABLE} (sender_id)')
+        cursor.execute(
+            f"SELECT setval(pg_get_serial_sequence(%s, 'id'), coalesce(max(id), 0) + 1, false) FROM {MESSAGES_TABLE}",
+            [MESSAGES_TABLE]
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_filedeletion'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatmessagefile',
+            name='message',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='files', to='chat.chatmessage', verbose_name='Сообщение'),
+        ),
+        migrations.RunPython(partition_chat_messages, unpartition_chat_messages),
+    ]
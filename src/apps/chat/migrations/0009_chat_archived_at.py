@@ -0,0 +1,18 @@
+# Generated by Django 5.0.14 on 2026-10-19 12:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_partition_chat_messages'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='archived_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Дата архивации'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.0.14 on 2026-10-19 13:32
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_chat_archived_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chat_id', models.BigIntegerField(verbose_name='Чат')),
+                ('client_id', models.BigIntegerField(verbose_name='Клиент')),
+                ('topic_id', models.BigIntegerField(null=True, verbose_name='Тема')),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='Дата создания')),
+            ],
+            options={
+                'verbose_name': 'Удаленный из списка чат',
+                'verbose_name_plural': 'Удаленные из списка чаты',
+                'db_table': 'chat_tombstones',
+            },
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='summary_changed_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='Дата изменения в списке чатов'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.0.14 on 2026-10-19 14:40
+
+from django.db import migrations, models, transaction
+from django.db.models import Max, OuterRef, Subquery
+from django.db.models.functions import Greatest
+
+from apps.chat.utils import ChatStatus
+
+BATCH_SIZE = 1000
+
+
+def fill_closed_at(apps, schema_editor):
+    """
+    Дата закрытия уже закрытых чатов не сохранялась: берется последнее изменение чата или последнее
+    сообщение, что позже (GREATEST в PostgreSQL пропускает NULL, у чатов без сообщений - updated_at).
+    Чаты обновляются пачками по BATCH_SIZE, каждая своей транзакцией
+    """
+    Chat = apps.get_model('chat', 'Chat')
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    last_message_at = ChatMessage.objects.filter(
+        chat_id=OuterRef('pk')
+    ).order_by().values('chat_id').annotate(last=Max('created_at')).values('last')
+    chat_ids = Chat.objects.filter(status=ChatStatus.CLOSED, closed_at__isnull=True).order_by('id')
+    last_id = 0
+    while batch := list(chat_ids.filter(id__gt=last_id).values_list('id', flat=True)[:BATCH_SIZE]):
+        with transaction.atomic(using=schema_editor.connection.alias):
+            Chat.objects.filter(id__in=batch).update(
+                closed_at=Greatest('updated_at', Subquery(last_message_at))
+            )
+        last_id = batch[-1]
+
+
+class Migration(migrations.Migration):
+    # заполнение пачками без общей транзакции миграции
+    atomic = False
+
+    dependencies = [
+        ('chat', '0010_chat_summary_changed_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='closed_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Дата закрытия'),
+        ),
+        migrations.RunPython(fill_closed_at, migrations.RunPython.noop),
+    ]
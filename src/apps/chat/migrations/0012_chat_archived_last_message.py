@@ -0,0 +1,57 @@
+# Generated by Django 5.0.14 on 2026-10-19 14:21
+
+import gzip
+import json
+import os
+
+from django.conf import settings
+from django.db import migrations, models, transaction
+
+
+def fill_archived_last_message(apps, schema_editor):
+    """
+    Последнее сообщение и непрочитанные уже архивных чатов берутся из файлов архива
+    (chats/<chat_id>.json.gz в CHAT_ARCHIVE_ROOT), сообщения, оставшиеся в БД (прерванная архивация),
+    в непрочитанные архива не попадают. Каждый чат обновляется своей транзакцией
+    """
+    Chat = apps.get_model('chat', 'Chat')
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    for chat in Chat.objects.filter(archived_at__isnull=False).only('id').order_by('id').iterator():
+        path = os.path.join(settings.CHAT_ARCHIVE_ROOT, 'chats', f'{chat.pk}.json.gz')
+        if not os.path.exists(path):
+            continue
+        with open(path, 'rb') as f:
+            messages = json.loads(gzip.decompress(f.read()))['messages']
+        hot_ids = set(ChatMessage.objects.filter(chat_id=chat.pk).values_list('id', flat=True))
+        archived_unread = {}
+        for message in messages:
+            if not message['is_read'] and message['id'] not in hot_ids:
+                sender_id = str(message['sender_id'])
+                archived_unread[sender_id] = archived_unread.get(sender_id, 0) + 1
+        with transaction.atomic(using=schema_editor.connection.alias):
+            Chat.objects.filter(pk=chat.pk).update(
+                archived_last_message=messages[-1] if messages else None, archived_unread=archived_unread
+            )
+
+
+class Migration(migrations.Migration):
+    # заполнение по одному чату без общей транзакции миграции
+    atomic = False
+
+    dependencies = [
+        ('chat', '0011_chat_closed_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='archived_last_message',
+            field=models.JSONField(blank=True, null=True, verbose_name='Последнее сообщение архива'),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='archived_unread',
+            field=models.JSONField(blank=True, default=dict, verbose_name='Непрочитанные сообщения архива'),
+        ),
+        migrations.RunPython(fill_archived_last_message, migrations.RunPython.noop),
+    ]
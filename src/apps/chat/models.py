@@ -1,10 +1,20 @@
+import os
+from collections import Counter
 from typing import Optional
 
-from django.db import models
+from django.conf import settings
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, DateTimeField, F, Func, IntegerField, Min, OuterRef, Q, Subquery, TextField, Value
+from django.db.models.fields.json import KT
+from django.db.models.functions import Cast, Coalesce
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django_ckeditor_5.fields import CKEditor5Field
+from loguru import logger
 
-from apps.chat.utils import ChatStatus, ChatType, MessageType
+from apps.chat.utils import ChatStatus, ChatType, MessageType, get_file_sha256
 from apps.users.models import User
+from apps.users.utils import UserRole
 from core.generics.models import ModelWithDate
 
 
@@ -31,7 +41,65 @@ class ChatTopic(ModelWithDate):
         return self.title
 
 
-class ChatManager(models.Manager):
+class ArchivedUnreadCount(Func):
+    """Непрочитанные сообщения архива чата без сообщений пользователя:
+    сумма значений Chat.archived_unread ({sender_id: count}) без ключа пользователя"""
+    template = '(SELECT COALESCE(SUM(value::integer), 0) FROM jsonb_each_text(%(expressions)s))'
+    arg_joiner = ' - '
+    output_field = IntegerField()
+
+    def __init__(self, user: User):
+        super().__init__(F('archived_unread'), Cast(Value(str(user.pk)), TextField()))
+
+
+class ChatQuerySet(models.QuerySet):
+
+    def annotate_messages(self, user: User) -> 'ChatQuerySet':
+        """Последнее сообщение и количество непрочитанных для списка чатов.
+        Коррелированные подзапросы с created_at >= created_at чата, чтобы PostgreSQL
+        отсекал партиции chat_messages старше чата. Для архивных чатов последнее сообщение
+        и непрочитанные архива берутся из Chat.archived_last_message и Chat.archived_unread
+        :param user: User - текущий пользователь
+        :return: ChatQuerySet
+        """
+        messages = ChatMessage.objects.filter(
+            chat_id=OuterRef('pk'), created_at__gte=OuterRef('created_at')
+        ).order_by()
+        last_message = messages.order_by('-created_at')[:1]
+        unread_messages = messages.filter(
+            is_read=False
+        ).exclude(
+            sender_id=user.pk
+        ).values('chat_id').annotate(count=Count('id')).values('count')
+        return self.annotate(
+            last_message_id=Subquery(last_message.values('id')),
+            last_message_created_at=Coalesce(
+                Subquery(last_message.values('created_at')),
+                Cast(KT('archived_last_message__created_at'), DateTimeField()),
+                'created_at',
+            ),
+            unread_messages_count=Coalesce(Subquery(unread_messages), 0) + ArchivedUnreadCount(user),
+        )
+
+    def count_by_topic_and_type(self) -> dict:
+        """Количество чатов по темам и типам одним запросом, суммы по темам и по типам считаются из него
+        :return: {(topic_id, chat_type): count}
+        """
+        return {
+            (topic_id, chat_type): count
+            for topic_id, chat_type, count in self.order_by().values_list('topic_id', 'chat_type').annotate(
+                count=Count('id')
+            )
+        }
+
+    def mark_changed(self) -> int:
+        """Строка чатов в списке изменилась (сообщения, прочтение), см. Chat.summary_changed_at
+        :return: int - количество чатов
+        """
+        return self.update(summary_changed_at=timezone.now())
+
+
+class ChatManager(models.Manager.from_queryset(ChatQuerySet)):
 
     def create_client_chat(self, client: User, topic: ChatTopic) -> 'Chat':
         """Создание чата для клиента
@@ -59,6 +127,29 @@ class ChatManager(models.Manager):
             status=ChatStatus.OPEN
         )
 
+    def delete_batched(self, chat_ids, batch_size: Optional[int] = None) -> None:
+        """Удаление чатов пачками: сообщения (с файлами) удаляются отдельными транзакциями
+        не больше batch_size за раз, затем удаляется сам чат. Через этот метод удаляются чаты
+        при удалении темы в admin (ChatTopicAdmin, пачки внутри транзакции delete_view - память и размер
+        каждого DELETE ограничены, блокировки держатся до конца удаления); пользователи из admin не удаляются,
+        удаление User или ChatTopic из кода удаляет чаты каскадом одной транзакцией
+        :param chat_ids: список id чатов
+        :param batch_size: int - размер пачки, по умолчанию settings.CHAT_DELETE_BATCH_SIZE
+        :return: None
+        """
+        batch_size = batch_size or settings.CHAT_DELETE_BATCH_SIZE
+        for chat_id in list(chat_ids):
+            while True:
+                message_ids = list(
+                    ChatMessage.objects.filter(chat_id=chat_id).values_list('id', flat=True)[:batch_size]
+                )
+                if not message_ids:
+                    break
+                with transaction.atomic():
+                    ChatMessage.objects.filter(id__in=message_ids).delete()
+            with transaction.atomic():
+                self.filter(id=chat_id).delete()
+
 
 class Chat(ModelWithDate):
     client = models.ForeignKey(
@@ -76,6 +167,25 @@ class Chat(ModelWithDate):
     chat_type = models.CharField(
         max_length=25, choices=ChatType, verbose_name='Тип чата'
     )
+    archived_at = models.DateTimeField(
+        null=True, blank=True, verbose_name='Дата архивации'
+    )
+    # последнее сообщение и непрочитанные ({sender_id: count}) архива для списка чатов,
+    # ставятся при архивации (apps/chat/archive.py), сообщения архива в БД не хранятся
+    archived_last_message = models.JSONField(
+        null=True, blank=True, verbose_name='Последнее сообщение архива'
+    )
+    archived_unread = models.JSONField(
+        default=dict, blank=True, verbose_name='Непрочитанные сообщения архива'
+    )
+    # время разрешения чата для статистики lms-crm, ставится при закрытии и сбрасывается при переоткрытии
+    closed_at = models.DateTimeField(
+        null=True, blank=True, verbose_name='Дата закрытия'
+    )
+    # изменение строки чата в списке (статус, куратор, последнее сообщение, непрочитанные) для дельты списка
+    summary_changed_at = models.DateTimeField(
+        default=timezone.now, db_index=True, verbose_name='Дата изменения в списке чатов'
+    )
 
     objects = ChatManager()
 
@@ -84,13 +194,57 @@ class Chat(ModelWithDate):
         verbose_name = 'Чат'
         verbose_name_plural = 'Чаты'
 
+    def save(self, *args, **kwargs):
+        self.summary_changed_at = timezone.now()
+        if self.status != ChatStatus.CLOSED:
+            self.closed_at = None
+        elif self.closed_at is None:
+            self.closed_at = self.summary_changed_at
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'summary_changed_at', 'closed_at'}
+        super().save(*args, **kwargs)
+
     @property
     def last_message(self) -> Optional['ChatMessage']:
         if hasattr(self, 'last_messages'):
             if self.last_messages:
                 return self.last_messages[0]
             return None
-        return self.messages.first()
+        message = ChatMessage.objects.of_chat(self).first()
+        if message is None and self.archived_last_message:
+            return ChatMessage.from_archive(self.pk, self.archived_last_message)
+        return message
+
+    def read_archived_messages(self, user: User, message_id: int) -> None:
+        """Сообщения архива прочитаны пользователем до message_id включительно:
+        в archived_unread остаются только его собственные сообщения
+        :param user: User - пользователь, прочитавший сообщения
+        :param message_id: int - последнее прочитанное сообщение
+        :return: None
+        """
+        if not self.archived_last_message or self.archived_last_message['id'] > message_id:
+            return
+        with transaction.atomic():
+            # archived_unread меняется и при архивации (apps/chat/archive.py purge_chat)
+            archived_unread = Chat.objects.select_for_update().values_list(
+                'archived_unread', flat=True
+            ).get(pk=self.pk)
+            self.archived_unread = {
+                sender_id: count for sender_id, count in archived_unread.items() if sender_id == str(user.pk)
+            }
+            if self.archived_unread != archived_unread:
+                Chat.objects.filter(pk=self.pk).update(archived_unread=self.archived_unread)
+
+    def add_archived_unread(self, unread_by_sender: dict) -> None:
+        """Непрочитанные сообщения, перенесенные в архив, вызывается в транзакции удаления сообщений из БД
+        :param unread_by_sender: {sender_id: count}
+        :return: None
+        """
+        archived_unread = Chat.objects.select_for_update().values_list('archived_unread', flat=True).get(pk=self.pk)
+        for sender_id, count in unread_by_sender.items():
+            archived_unread[str(sender_id)] = archived_unread.get(str(sender_id), 0) + count
+        self.archived_unread = archived_unread
+        Chat.objects.filter(pk=self.pk).update(archived_unread=archived_unread)
 
     def close_chat(self) -> None:
         """Закрытие чата"""
@@ -107,6 +261,31 @@ class Chat(ModelWithDate):
         self.save(update_fields=('curator', 'status'))
 
 
+class ChatTombstone(models.Model):
+    """
+    Чат удален или перенесен в другую тему: дельта списка чатов (apps/chat/changes.py) возвращает его
+    как удаленный клиенту и кураторам прежней темы. Записи старше CHAT_CHANGES_RETENTION_SECONDS
+    удаляет archive_closed_chats
+    """
+    chat_id = models.BigIntegerField(
+        verbose_name='Чат'
+    )
+    client_id = models.BigIntegerField(
+        verbose_name='Клиент'
+    )
+    topic_id = models.BigIntegerField(
+        null=True, verbose_name='Тема'
+    )
+    created_at = models.DateTimeField(
+        default=timezone.now, db_index=True, verbose_name='Дата создания'
+    )
+
+    class Meta:
+        db_table = 'chat_tombstones'
+        verbose_name = 'Удаленный из списка чат'
+        verbose_name_plural = 'Удаленные из списка чаты'
+
+
 class ChatComment(ModelWithDate):
     curator = models.ForeignKey(
         User, on_delete=models.CASCADE, verbose_name='Куратор', related_name='chat_comments'
@@ -124,6 +303,94 @@ class ChatComment(ModelWithDate):
         verbose_name_plural = 'Комментарии к чатам'
 
 
+class ChatMessageQuerySet(models.QuerySet):
+
+    def of_chat(self, chat: Chat) -> 'ChatMessageQuerySet':
+        """Сообщения чата, сообщения не могут быть старше чата, поэтому
+        условие по created_at отсекает партиции на этапе планирования
+        :param chat: Chat
+        :return: ChatMessageQuerySet
+        """
+        return self.filter(chat_id=chat.pk, created_at__gte=chat.created_at)
+
+    def count_unread_by_sender(self, chat: Chat) -> dict:
+        """Непрочитанные сообщения чата по отправителям: непрочитанные пользователя - все, кроме его собственных.
+        Вместе с непрочитанными архива чата
+        :param chat: Chat
+        :return: {sender_id: count}
+        """
+        return self._add_archived_unread(chat, dict(self._unread_by_sender(chat)))
+
+    async def acount_unread_by_sender(self, chat: Chat) -> dict:
+        """Асинхронная версия count_unread_by_sender"""
+        return self._add_archived_unread(
+            chat, {sender_id: count async for sender_id, count in self._unread_by_sender(chat)}
+        )
+
+    @staticmethod
+    def _add_archived_unread(chat: Chat, unread: dict) -> dict:
+        for sender_id, count in chat.archived_unread.items():
+            unread[int(sender_id)] = unread.get(int(sender_id), 0) + count
+        return unread
+
+    def _unread_by_sender(self, chat: Chat) -> 'ChatMessageQuerySet':
+        return self.of_chat(chat).filter(is_read=False).order_by().values_list('sender_id').annotate(count=Count('id'))
+
+    def has_notifications(self, user: User) -> bool:
+        """Есть непрочитанные сообщения других пользователей в чатах пользователя
+        (у куратора - в назначенных ему чатах), в том числе в архивах чатов
+        :param user: User
+        :return: bool
+        """
+        if user.role == UserRole.CURATOR:
+            chats_q = Q(curator_id=user.pk)
+        else:
+            chats_q = Q(client_id=user.pk)
+        # сообщения не старше самого раннего чата пользователя, отсекает старые партиции
+        since = Chat.objects.filter(chats_q).aggregate(since=Min('created_at'))['since']
+        return since is not None and (self.filter(
+            Q(is_read=False) & ~Q(sender_id=user.pk) &
+            Q(created_at__gte=since) & Q(chat__in=Chat.objects.filter(chats_q))
+        ).exists() or Chat.objects.filter(chats_q).exclude(archived_unread={}).alias(
+            archived_unread_count=ArchivedUnreadCount(user)
+        ).filter(archived_unread_count__gt=0).exists())
+
+    def _last_messages(self, chats: list) -> 'ChatMessageQuerySet':
+        return self.filter(
+            id__in=[chat.last_message_id for chat in chats if chat.last_message_id],
+            created_at__in={chat.last_message_created_at for chat in chats}
+        ).prefetch_related('files')
+
+    @staticmethod
+    def _set_last_messages(chats: list, messages: dict) -> None:
+        for chat in chats:
+            if chat.pk in messages:
+                chat.last_messages = [messages[chat.pk]]
+            elif chat.archived_last_message:
+                chat.last_messages = [ChatMessage.from_archive(chat.pk, chat.archived_last_message)]
+            else:
+                chat.last_messages = []
+
+    def attach_last_messages(self, chats: list) -> None:
+        """Загрузка последних сообщений (с файлами) для страницы чатов,
+        аннотированных через ChatQuerySet.annotate_messages. Если сообщений в БД нет,
+        последнее сообщение архивного чата берется из Chat.archived_last_message
+        :param chats: list[Chat]
+        :return: None
+        """
+        messages = {}
+        if any(chat.last_message_id for chat in chats):
+            messages = {message.chat_id: message for message in self._last_messages(chats)}
+        self._set_last_messages(chats, messages)
+
+    async def aattach_last_messages(self, chats: list) -> None:
+        """Асинхронная версия attach_last_messages"""
+        messages = {}
+        if any(chat.last_message_id for chat in chats):
+            messages = {message.chat_id: message async for message in self._last_messages(chats)}
+        self._set_last_messages(chats, messages)
+
+
 class ChatMessage(ModelWithDate):
     chat = models.ForeignKey(
         Chat, on_delete=models.CASCADE, verbose_name='Чат', related_name='messages'
@@ -141,25 +408,215 @@ class ChatMessage(ModelWithDate):
         default=False, verbose_name='Прочитано'
     )
 
+    objects = ChatMessageQuerySet.as_manager()
+
     class Meta:
         db_table = 'chat_messages'
         verbose_name = 'Сообщение чата'
         verbose_name_plural = 'Сообщения чатов'
         ordering = ('-created_at',)
 
+    @classmethod
+    def from_archive(cls, chat_id: int, item: dict) -> 'ChatMessage':
+        """Несохраненное сообщение с файлами из строки архива чата (apps/chat/archive.py)
+        :param chat_id: int - id чата
+        :param item: dict - сообщение архива
+        :return: ChatMessage
+        """
+        message = cls(
+            id=item['id'],
+            chat_id=chat_id,
+            sender_id=item['sender_id'],
+            text=item['text'],
+            message_type=item['message_type'],
+            is_read=item['is_read'],
+            created_at=parse_datetime(item['created_at']),
+            updated_at=parse_datetime(item['updated_at']),
+        )
+        files = []
+        for file_item in item['files']:
+            message_file = ChatMessageFile(
+                id=file_item['id'],
+                message=message,
+                file=file_item['file'],
+                name=file_item['name'],
+                sha256=file_item['sha256'],
+                created_at=parse_datetime(file_item['created_at']),
+            )
+            message_file.archived_chat_id = chat_id
+            files.append(message_file)
+        message._prefetched_objects_cache = {'files': files}
+        return message
+
+
+class ChatFileManager(models.Manager):
+
+    def acquire(self, file) -> 'ChatFile':
+        """Получение файла по хэшу содержимого с увеличением счетчика ссылок,
+        в хранилище файл записывается только если такого содержимого еще нет
+        :param file: UploadedFile - загруженный файл
+        :return: ChatFile
+        """
+        sha256 = get_file_sha256(file)
+        try:
+            with transaction.atomic():
+                chat_file = self.select_for_update().filter(sha256=sha256).first()
+                if chat_file is None:
+                    chat_file = self.model(sha256=sha256, size=file.size, ref_count=0)
+                    name = chat_file._get_file_path(file.name)
+                    # файл мог стоять в очереди на удаление после освобождения последней ссылки
+                    FileDeletion.objects.filter(name=name).delete()
+                    if chat_file.file.storage.exists(name):
+                        chat_file.file.name = name
+                    else:
+                        chat_file.file.save(name, file, save=False)
+                chat_file.ref_count += 1
+                chat_file.save()
+        except IntegrityError:
+            # файл с таким хэшем параллельно создан другим запросом
+            return self.acquire(file)
+        return chat_file
+
+    def retain(self, sha256_list) -> None:
+        """Увеличение счетчиков ссылок на существующие файлы (ссылки архива чата)
+        :param sha256_list: хэши содержимого, по ссылке на каждое вхождение
+        :return: None
+        """
+        for sha256, count in Counter(sha256_list).items():
+            self.filter(sha256=sha256).update(ref_count=F('ref_count') + count)
+
+    def release(self, sha256: str) -> None:
+        """Уменьшение счетчика ссылок, файл удаляется из хранилища когда ссылок не осталось
+        :param sha256: str - хэш содержимого
+        :return: None
+        """
+        with transaction.atomic():
+            chat_file = self.select_for_update().filter(sha256=sha256).first()
+            if chat_file is None:
+                return
+            chat_file.ref_count -= 1
+            if chat_file.ref_count > 0:
+                chat_file.save(update_fields=('ref_count', 'updated_at'))
+                return
+            chat_file.delete()
+            FileDeletion.objects.create(name=chat_file.file.name)
+
+
+class FileDeletionManager(models.Manager):
+
+    def process_batch(self, batch_size: Optional[int] = None) -> int:
+        """Удаление из хранилища пачки файлов из очереди.
+        Файлы, на которые снова появились ссылки, не удаляются. Неудачная попытка увеличивает attempts,
+        записи с FILE_DELETION_MAX_ATTEMPTS попытками больше не выбираются
+        :param batch_size: int - размер пачки, по умолчанию settings.FILE_DELETION_BATCH_SIZE
+        :return: int - количество удаленных из очереди записей (файл удален или на него есть ссылки)
+        """
+        batch_size = batch_size or settings.FILE_DELETION_BATCH_SIZE
+        with transaction.atomic():
+            deletions = list(
+                self.filter(
+                    attempts__lt=settings.FILE_DELETION_MAX_ATTEMPTS
+                ).select_for_update(skip_locked=True).order_by('id')[:batch_size]
+            )
+            if not deletions:
+                return 0
+            names = {deletion.name for deletion in deletions}
+            referenced = set(ChatFile.objects.filter(file__in=names).values_list('file', flat=True))
+            referenced |= set(ChatMessageFile.objects.filter(file__in=names).values_list('file', flat=True))
+            storage = ChatFile._meta.get_field('file').storage
+            failed = []
+            for deletion in deletions:
+                if deletion.name in referenced:
+                    continue
+                try:
+                    storage.delete(deletion.name)
+                except OSError as e:
+                    deletion.attempts += 1
+                    failed.append(deletion)
+                    logger.warning(f'file deletion {deletion.name} failed, attempt {deletion.attempts}: {e}')
+            if failed:
+                self.bulk_update(failed, fields=('attempts',))
+            self.filter(id__in=[d.id for d in deletions if d not in failed]).delete()
+        return len(deletions) - len(failed)
+
+
+class FileDeletion(models.Model):
+    """Очередь на удаление файлов из хранилища, обрабатывается командой process_file_deletions"""
+    name = models.CharField(
+        max_length=255, db_index=True, verbose_name='Путь в хранилище'
+    )
+    attempts = models.PositiveSmallIntegerField(
+        default=0, verbose_name='Неудачных попыток'
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True, verbose_name='Дата создания'
+    )
+
+    objects = FileDeletionManager()
+
+    class Meta:
+        db_table = 'file_deletions'
+        verbose_name = 'Удаление файла'
+        verbose_name_plural = 'Очередь удаления файлов'
+
+
+class ChatFile(ModelWithDate):
+    """Содержимое файла, общее для всех сообщений с одинаковым SHA-256"""
+
+    def _get_file_path(self, filename):
+        return f'Chat/files/{self.sha256[:2]}/{self.sha256}'
+
+    sha256 = models.CharField(
+        max_length=64, unique=True, verbose_name='SHA-256 содержимого'
+    )
+    file = models.FileField(
+        upload_to=_get_file_path, max_length=255, verbose_name='Файл'
+    )
+    size = models.PositiveBigIntegerField(
+        default=0, verbose_name='Размер'
+    )
+    ref_count = models.PositiveIntegerField(
+        default=0, verbose_name='Количество ссылок'
+    )
+
+    objects = ChatFileManager()
+
+    class Meta:
+        db_table = 'chat_files'
+        verbose_name = 'Файл'
+        verbose_name_plural = 'Файлы'
+
 
 class ChatMessageFile(ModelWithDate):
     def _get_file_path(self, filename):
         return f'Chat/{self.message.chat_id}/{filename}'
 
+    # chat_messages партиционирована по created_at, внешний ключ на нее в БД невозможен
     message = models.ForeignKey(
-        ChatMessage, on_delete=models.CASCADE, verbose_name='Сообщение', related_name='files'
+        ChatMessage, on_delete=models.CASCADE, verbose_name='Сообщение', related_name='files', db_constraint=False
     )
     file = models.FileField(
         upload_to=_get_file_path, verbose_name='Файл'
     )
+    name = models.CharField(
+        max_length=255, blank=True, default='', verbose_name='Имя файла'
+    )
+    sha256 = models.CharField(
+        max_length=64, blank=True, default='', verbose_name='SHA-256 содержимого'
+    )
 
     class Meta:
         db_table = 'chat_message_files'
         verbose_name = 'Файл сообщения'
         verbose_name_plural = 'Файлы сообщений'
+
+    def save(self, *args, **kwargs):
+        if self.file and not self.file._committed:
+            with transaction.atomic():
+                chat_file = ChatFile.objects.acquire(self.file)
+                self.name = self.name or os.path.basename(self.file.name)
+                self.sha256 = chat_file.sha256
+                self.file = chat_file.file.name
+                super().save(*args, **kwargs)
+        else:
+            super().save(*args, **kwargs)
@@ -0,0 +1,133 @@
+"""
+Помесячные партиции таблицы chat_messages (PostgreSQL, PARTITION BY RANGE (created_at))
+"""
+import datetime
+import re
+from typing import Optional
+
+from django.db import connection, transaction
+
+MESSAGES_TABLE = 'chat_messages'
+DEFAULT_PARTITION = f'{MESSAGES_TABLE}_default'
+PARTITION_PREFIX = f'{MESSAGES_TABLE}_p'
+# имя схемы для отсоединенных партиций подставляется в DDL, допускаются только буквы, цифры и _
+SCHEMA_NAME_RE = re.compile(r'^\w+$')
+
+
+def month_start(value: datetime.date) -> datetime.date:
+    return value.replace(day=1)
+
+
+def next_month(value: datetime.date) -> datetime.date:
+    return (value.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+
+
+def partition_name(month: datetime.date) -> str:
+    """
+    Вернет имя партиции месяца
+    :param month: date - любой день месяца
+    :return: str - chat_messages_pYYYY_MM
+    """
+    return f'{PARTITION_PREFIX}{month.year:04d}_{month.month:02d}'
+
+
+def partition_month(name: str) -> Optional[datetime.date]:
+    """Вернет месяц партиции по имени, для default партиции None"""
+    if not name.startswith(PARTITION_PREFIX):
+        return None
+    year, month = name[len(PARTITION_PREFIX):].split('_')
+    return datetime.date(int(year), int(month), 1)
+
+
+def _bounds(month: datetime.date) -> tuple:
+    start = datetime.datetime.combine(month_start(month), datetime.time(), tzinfo=datetime.timezone.utc)
+    end = datetime.datetime.combine(next_month(month), datetime.time(), tzinfo=datetime.timezone.utc)
+    return start, end
+
+
+def get_message_partitions() -> list:
+    """
+    Вернет имена партиций chat_messages
+    :return: list[str]
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT child.relname
+            FROM pg_inherits
+            JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+            JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+            WHERE parent.relname = %s
+            ORDER BY child.relname
+            """,
+            [MESSAGES_TABLE]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def create_message_partition(cursor, month: datetime.date) -> bool:
+    """
+    Создание партиции месяца. Если в default партиции уже есть строки этого месяца,
+    они переносятся в новую партицию
+    :param cursor: курсор БД
+    :param month: date - любой день месяца
+    :return: bool - создана ли партиция
+    """
+    name = partition_name(month)
+    cursor.execute('SELECT to_regclass(%s) IS NOT NULL', [name])
+    if cursor.fetchone()[0]:
+        return False
+
+    start, end = _bounds(month)
+    cursor.execute(
+        f'SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE created_at >= %s AND created_at < %s)',
+        [start, end]
+    )
+    if not cursor.fetchone()[0]:
+        cursor.execute(
+            f'CREATE TABLE {name} PARTITION OF {MESSAGES_TABLE} FOR VALUES FROM (%s) TO (%s)', [start, end]
+        )
+        return True
+
+    cursor.execute(f'ALTER TABLE {MESSAGES_TABLE} DETACH PARTITION {DEFAULT_PARTITION}')
+    cursor.execute(f'CREATE TABLE {name} PARTITION OF {MESSAGES_TABLE} FOR VALUES FROM (%s) TO (%s)', [start, end])
+    cursor.execute(
+        f'INSERT INTO {name} SELECT * FROM {DEFAULT_PARTITION} WHERE created_at >= %s AND created_at < %s',
+        [start, end]
+    )
+    cursor.execute(f'DELETE FROM {DEFAULT_PARTITION} WHERE created_at >= %s AND created_at < %s', [start, end])
+    cursor.execute(f'ALTER TABLE {MESSAGES_TABLE} ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT')
+    return True
+
+
+def create_message_partitions(start: datetime.date, end: datetime.date) -> list:
+    """
+    Создание помесячных партиций с start по end включительно
+    :return: list[str] - имена созданных партиций
+    """
+    created = []
+    month = month_start(start)
+    while month <= end:
+        with transaction.atomic(), connection.cursor() as cursor:
+            if create_message_partition(cursor, month):
+                created.append(partition_name(month))
+        month = next_month(month)
+    return created
+
+
+def detach_message_partition(name: str, schema: Optional[str] = None) -> None:
+    """
+    Отсоединение партиции для архивации, таблица остается в БД
+    :param name: str - имя партиции
+    :param schema: str - схема, в которую перенести отсоединенную таблицу
+    :return: None
+    :raises ValueError: имя схемы не подходит под SCHEMA_NAME_RE
+    """
+    if schema and not SCHEMA_NAME_RE.match(schema):
+        raise ValueError(f'Недопустимое имя схемы: {schema!r}')
+    quote_name = connection.ops.quote_name
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE {MESSAGES_TABLE} DETACH PARTITION {quote_name(name)}')
+        if schema:
+            cursor.execute(f'CREATE SCHEMA IF NOT EXISTS {quote_name(schema)}')
+            cursor.execute(f'ALTER TABLE {quote_name(name)} SET SCHEMA {quote_name(schema)}')
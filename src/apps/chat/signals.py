@@ -0,0 +1,41 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from apps.chat.archive import release_chat_archive
+from apps.chat.changes import add_tombstone
+from apps.chat.models import Chat, ChatFile, ChatMessage, ChatMessageFile, ChatTopic
+from apps.chat.topics import invalidate_permission_topics
+
+
+@receiver(post_delete, sender=ChatMessageFile)
+def release_chat_message_file(sender, instance: ChatMessageFile, **kwargs):
+    """Освобождение ссылки на содержимое файла при удалении файла сообщения (в т.ч. каскадом)"""
+    if instance.sha256:
+        ChatFile.objects.release(instance.sha256)
+
+
+@receiver(post_delete, sender=Chat)
+def release_archived_chat(sender, instance: Chat, **kwargs):
+    """Удаление архива чата и освобождение ссылок архива на файлы"""
+    if instance.archived_at is not None:
+        release_chat_archive(instance.pk)
+
+
+@receiver(post_delete, sender=Chat)
+def add_chat_tombstone(sender, instance: Chat, **kwargs):
+    """Удаленный чат попадает в дельту списка чатов клиента и кураторов темы"""
+    add_tombstone(instance.pk, instance.client_id, instance.topic_id)
+
+
+@receiver(post_save, sender=ChatMessage)
+def mark_chat_changed(sender, instance: ChatMessage, **kwargs):
+    """Новое или измененное сообщение меняет последнее сообщение и непрочитанные в списке чатов"""
+    Chat.objects.filter(pk=instance.chat_id).mark_changed()
+
+
+@receiver(post_save, sender=ChatTopic)
+@receiver(post_delete, sender=ChatTopic)
+def invalidate_topics(sender, instance: ChatTopic, **kwargs):
+    """Сброс карты права -> темы во всех процессах после коммита"""
+    transaction.on_commit(invalidate_permission_topics)
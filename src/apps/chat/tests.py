@@ -1,3 +1,1156 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import gzip
+import importlib
+import json
+import shutil
+import tempfile
+import time
+import uuid
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.core.management import CommandError, call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import DatabaseError, connection
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from jwcrypto import jwk, jwt
+from rest_framework.exceptions import AuthenticationFailed
+
+from api.v1.authentication import KeyCloakAuthentication
+from api.v1.client import views as client_views
+from api.v1.curator import views as curator_views
+from api.v1.utils import ChatChangesMixin
+from apps.chat.changes import CHATS_VERSION_HEADER, get_chats_version
+from apps.chat import partitions
+from apps.chat.archive import archive_storage, get_archive_name, load_chat_archive, write_chat_archive
+from apps.chat.models import Chat, ChatComment, ChatFile, ChatMessage, ChatMessageFile, ChatTopic, FileDeletion
+from apps.chat.topics import invalidate_permission_topics
+from apps.chat.utils import ChatStatus, ChatType, MessageType
+from apps.users import presence
+from apps.users.models import User
+from apps.users.utils import UserRole
+from core import db_router
+from core.asgi import application
+from core.libs import keycloak, metrics
+from core.libs.metrics.testing import assert_query_budget, capture_queries
+from core.middleware import ReadReplicaMiddleware
+from ws.consumers import DRAIN_CLOSE_CODE, SLOW_CONSUMER_CLOSE_CODE, WsChatConsumer
+from ws.outbox import SendQueue, get_write_buffer_getter, get_write_buffer_size
+
+KEYCLOAK_KEY = jwk.JWK.generate(kty='RSA', size=2048)
+
+
+def make_token(user: User, roles: list) -> str:
+    """Токен KeyCloak пользователя, подписанный KEYCLOAK_KEY"""
+    token = jwt.JWT(
+        header={'alg': 'RS256', 'typ': 'JWT'},
+        claims={
+            'sub': str(user.pk),
+            'preferred_username': user.username,
+            'name': user.name,
+            'realm_access': {'roles': roles},
+            'exp': int((timezone.now() + datetime.timedelta(hours=1)).timestamp()),
+        }
+    )
+    token.make_signed_token(KEYCLOAK_KEY)
+    return token.serialize()
+
+
+class ChatTestMixin:
+    """Пользователи, темы и чаты для тестов API; токены KeyCloak подписываются тестовым ключом"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.media_root = tempfile.mkdtemp()
+        cls.settings_override = override_settings(
+            MEDIA_ROOT=cls.media_root,
+            CHAT_ARCHIVE_ROOT=cls.media_root,
+            KEYCLOAK_PUBLIC_KEY=KEYCLOAK_KEY.export_to_pem().decode(),
+            CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+        )
+        cls.settings_override.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.settings_override.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+        super().tearDownClass()
+
+    @classmethod
+    def create_chat_data(cls):
+        cls.topic = cls.create_topic('topic_a')
+        cls.other_topic = cls.create_topic('topic_b')
+        cls.client_user = User.objects.create_keycloak_user('client', UserRole.CLIENT, 'Клиент')
+        cls.other_client = User.objects.create_keycloak_user('other_client', UserRole.CLIENT, 'Клиент 2')
+        cls.curator = User.objects.create_keycloak_user('curator', UserRole.CURATOR, 'Куратор')
+        cls.chat = Chat.objects.create_client_chat(cls.client_user, cls.topic)
+
+    def setUp(self):
+        super().setUp()
+        invalidate_permission_topics()
+        for user in (self.client_user, self.other_client, self.curator):
+            presence.set_user_channels(user.pk, {})
+
+    @staticmethod
+    def create_topic(permission: str) -> ChatTopic:
+        return ChatTopic.objects.create(
+            title=permission, description='', logo='chat_topics/logos/logo.png', permission=permission
+        )
+
+    @staticmethod
+    def get_token(user: User, roles: list = None) -> str:
+        if roles is None:
+            roles = [settings.KEYCLOAK_CURATOR_ROLE if user.role == UserRole.CURATOR else settings.KEYCLOAK_CLIENT_ROLE]
+        return make_token(user, roles)
+
+    def get_curator_token(self, *permissions) -> str:
+        return self.get_token(self.curator, [settings.KEYCLOAK_CURATOR_ROLE, *permissions])
+
+    @staticmethod
+    def create_message(chat: Chat, sender: User, text: str = 'text', message_type: str = MessageType.TEXT,
+                       **kwargs) -> ChatMessage:
+        return ChatMessage.objects.create(chat=chat, sender=sender, text=text, message_type=message_type, **kwargs)
+
+    def create_message_file(self, chat: Chat, content: bytes = b'content') -> ChatMessageFile:
+        message = self.create_message(chat, chat.client, message_type=MessageType.FILE)
+        message_file = ChatMessageFile(message=message, file=SimpleUploadedFile('file.txt', content))
+        message_file.save()
+        return message_file
+
+
+class ChatTestCase(ChatTestMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.create_chat_data()
+
+
+class ChatMessageFileTestCase(ChatTestCase):
+
+    def get_file(self, message_file: ChatMessageFile, token: str, **headers):
+        return self.client.get(f'/api/v1/files/{message_file.pk}/', HTTP_AUTHORIZATION=token, **headers)
+
+    def test_chat_members_only(self):
+        message_file = self.create_message_file(self.chat)
+        self.assertEqual(self.get_file(message_file, self.get_token(self.client_user)).status_code, 200)
+        self.assertEqual(self.get_file(message_file, self.get_token(self.other_client)).status_code, 404)
+        self.assertEqual(self.get_file(message_file, self.get_curator_token('topic_a')).status_code, 200)
+        self.assertEqual(self.get_file(message_file, self.get_curator_token('topic_b')).status_code, 404)
+
+    def test_curator_chat_without_topic(self):
+        """Чат без темы доступен только назначенному куратору"""
+        chat = Chat.objects.create(client=self.client_user, chat_type=ChatType.ORDER, status=ChatStatus.OPEN)
+        message_file = self.create_message_file(chat)
+        self.assertEqual(self.get_file(message_file, self.get_curator_token('topic_a')).status_code, 404)
+        chat.assign_curator(self.curator)
+        self.assertEqual(self.get_file(message_file, self.get_curator_token('topic_a')).status_code, 200)
+
+    @override_settings(MEDIA_X_ACCEL_REDIRECT=False)
+    def test_file_response_without_ranges(self):
+        message_file = self.create_message_file(self.chat, b'0123456789')
+        response = self.get_file(message_file, self.get_token(self.client_user), HTTP_RANGE='bytes=0-3')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Accept-Ranges', response)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+
+    @override_settings(MEDIA_X_ACCEL_REDIRECT=True)
+    def test_x_accel_redirect(self):
+        message_file = self.create_message_file(self.chat)
+        token = self.get_token(self.client_user)
+        response = self.get_file(message_file, token)
+        self.assertEqual(
+            response['X-Accel-Redirect'], f'{settings.MEDIA_X_ACCEL_REDIRECT_LOCATION}{message_file.file.name}'
+        )
+        self.assertNotIn('Accept-Ranges', response)
+        self.assertEqual(self.get_file(message_file, token, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_if_none_match(self):
+        message_file = self.create_message_file(self.chat)
+        token = self.get_token(self.client_user)
+        etag = self.get_file(message_file, token)['ETag']
+        cases = (
+            (etag, 304),
+            (f'W/{etag}', 304),
+            (f'"other", {etag}', 304),
+            ('*', 304),
+            ('"other"', 200),
+            (etag[:-2] + '"', 200),
+            (f'"a{etag}"', 200),
+            ('', 200),
+        )
+        for if_none_match, status_code in cases:
+            with self.subTest(if_none_match=if_none_match):
+                response = self.get_file(message_file, token, HTTP_IF_NONE_MATCH=if_none_match)
+                self.assertEqual(response.status_code, status_code)
+
+
+@override_settings(CHAT_DELETE_BATCH_SIZE=2)
+class ChatDeleteBatchedTestCase(ChatTestMixin, TransactionTestCase):
+
+    def setUp(self):
+        self.create_chat_data()
+        super().setUp()
+
+    def test_file_deletions_queued(self):
+        shared = self.create_message_file(self.chat, b'shared')
+        own = [self.create_message_file(self.chat, f'own {i}'.encode()) for i in range(4)]
+        other_chat = Chat.objects.create_client_chat(self.other_client, self.topic)
+        self.create_message_file(other_chat, b'shared')
+
+        with CaptureQueriesContext(connection) as queries:
+            Chat.objects.delete_batched([self.chat.pk])
+
+        message_deletes = [q for q in queries if q['sql'].startswith('DELETE FROM "chat_messages"')]
+        self.assertEqual(len(message_deletes), 3)
+        self.assertFalse(Chat.objects.filter(pk=self.chat.pk).exists())
+        self.assertEqual(
+            set(FileDeletion.objects.values_list('name', flat=True)), {message_file.file.name for message_file in own}
+        )
+        self.assertEqual(ChatFile.objects.get(sha256=shared.sha256).ref_count, 1)
+
+        self.assertEqual(FileDeletion.objects.process_batch(), 4)
+        storage = ChatFile._meta.get_field('file').storage
+        self.assertFalse(any(storage.exists(message_file.file.name) for message_file in own))
+        self.assertTrue(storage.exists(shared.file.name))
+
+    @override_settings(FILE_DELETION_MAX_ATTEMPTS=2)
+    def test_failed_file_deletions(self):
+        FileDeletion.objects.bulk_create([FileDeletion(name='Chat/failed'), FileDeletion(name='Chat/deleted')])
+        storage = ChatFile._meta.get_field('file').storage
+
+        def delete(name):
+            if name == 'Chat/failed':
+                raise PermissionError(name)
+
+        with mock.patch.object(storage, 'delete', side_effect=delete):
+            self.assertEqual(FileDeletion.objects.process_batch(), 1)
+            self.assertEqual(FileDeletion.objects.process_batch(), 0)
+            # команда не выбирает запись после FILE_DELETION_MAX_ATTEMPTS ошибок и завершается
+            call_command('process_file_deletions')
+            self.assertEqual(FileDeletion.objects.process_batch(), 0)
+        self.assertEqual(list(FileDeletion.objects.values_list('name', 'attempts')), [('Chat/failed', 2)])
+
+    def test_admin_topic_delete(self):
+        for i in range(3):
+            self.create_message_file(self.chat, f'topic {i}'.encode())
+        admin_user = User.objects.create_superuser('admin', 'password')
+        self.client.force_login(admin_user)
+
+        response = self.client.get(f'/admin/chat/chattopic/{self.topic.pk}/delete/')
+        self.assertEqual(response.status_code, 200)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(f'/admin/chat/chattopic/{self.topic.pk}/delete/', {'post': 'yes'})
+        self.assertEqual(response.status_code, 302)
+
+        self.assertFalse(ChatTopic.objects.filter(pk=self.topic.pk).exists())
+        self.assertFalse(Chat.objects.filter(pk=self.chat.pk).exists())
+        self.assertEqual(FileDeletion.objects.count(), 3)
+        # сообщения удалены пачками до каскадного удаления темы
+        self.assertEqual(len([q for q in queries if q['sql'].startswith('DELETE FROM "chat_messages"')]), 2)
+
+
+class MessagePartitionTestCase(ChatTestCase):
+
+    @staticmethod
+    def get_partition(message: ChatMessage) -> str:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT tableoid::regclass::text FROM {partitions.MESSAGES_TABLE} WHERE id = %s', [message.pk]
+            )
+            return cursor.fetchone()[0]
+
+    def move_message(self, message: ChatMessage, created_at: datetime.datetime) -> None:
+        ChatMessage.objects.filter(pk=message.pk).update(created_at=created_at)
+        message.created_at = created_at
+
+    def test_message_in_month_partition(self):
+        message = self.create_message(self.chat, self.client_user)
+        self.assertEqual(self.get_partition(message), partitions.partition_name(timezone.now().date()))
+        self.assertIn(partitions.DEFAULT_PARTITION, partitions.get_message_partitions())
+        self.assertGreater(self.create_message(self.chat, self.client_user).pk, message.pk)
+
+    def test_default_partition_rows_moved(self):
+        message = self.create_message(self.chat, self.client_user)
+        self.move_message(message, datetime.datetime(2100, 1, 15, tzinfo=datetime.timezone.utc))
+        self.assertEqual(self.get_partition(message), partitions.DEFAULT_PARTITION)
+
+        created = partitions.create_message_partitions(datetime.date(2100, 1, 1), datetime.date(2100, 1, 31))
+
+        self.assertEqual(created, ['chat_messages_p2100_01'])
+        self.assertEqual(self.get_partition(message), 'chat_messages_p2100_01')
+        self.assertEqual(ChatMessage.objects.get(pk=message.pk).created_at, message.created_at)
+        self.assertEqual(partitions.create_message_partitions(datetime.date(2100, 1, 1), datetime.date(2100, 1, 1)), [])
+
+    def test_chat_messages_prune_old_partitions(self):
+        partitions.create_message_partitions(datetime.date(2000, 1, 1), datetime.date(2000, 1, 1))
+        plan = ChatMessage.objects.of_chat(self.chat).explain()
+        self.assertNotIn('chat_messages_p2000_01', plan)
+        self.assertIn(partitions.partition_name(self.chat.created_at.date()), plan)
+
+    def test_detach_old_partitions(self):
+        partitions.create_message_partitions(datetime.date(2000, 1, 1), datetime.date(2000, 1, 1))
+        old = self.create_message(self.chat, self.client_user)
+        self.move_message(old, datetime.datetime(2000, 1, 10, tzinfo=datetime.timezone.utc))
+        current = self.create_message(self.chat, self.client_user)
+
+        call_command('manage_message_partitions', detach_before='2000-02', schema='chat_archive', stdout=StringIO())
+
+        self.assertNotIn('chat_messages_p2000_01', partitions.get_message_partitions())
+        self.assertEqual(list(ChatMessage.objects.values_list('id', flat=True)), [current.pk])
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT id FROM chat_archive.chat_messages_p2000_01')
+            self.assertEqual(cursor.fetchall(), [(old.pk,)])
+
+    def test_detach_invalid_schema(self):
+        partitions.create_message_partitions(datetime.date(2000, 1, 1), datetime.date(2000, 1, 1))
+        with self.assertRaises(CommandError):
+            call_command('manage_message_partitions', detach_before='2000-02', schema='archive; DROP TABLE chats')
+        with self.assertRaises(ValueError):
+            partitions.detach_message_partition('chat_messages_p2000_01', 'archive"')
+        self.assertIn('chat_messages_p2000_01', partitions.get_message_partitions())
+
+
+class ChatArchiveTestCase(ChatTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # чат из setUpTestData общий для тестов класса, архив остается после предыдущего теста
+        archive_storage.delete(get_archive_name(self.chat.pk))
+        self.message_file = self.create_message_file(self.chat, b'archived')
+        self.create_message(self.chat, self.curator, 'curator')
+        ChatComment.objects.create(chat=self.chat, curator=self.curator, text='comment')
+        self.close_chat()
+
+    def close_chat(self):
+        self.chat.close_chat()
+        Chat.objects.filter(pk=self.chat.pk).update(
+            summary_changed_at=timezone.now() - datetime.timedelta(days=settings.CHAT_ARCHIVE_AFTER_DAYS + 1)
+        )
+
+    def archive(self):
+        call_command('archive_closed_chats', stdout=StringIO())
+        self.chat.refresh_from_db()
+
+    def get_messages(self) -> list:
+        response = self.client.get(
+            f'/api/v1/client/chats/{self.chat.pk}/messages/?limit=100',
+            HTTP_AUTHORIZATION=self.get_token(self.client_user)
+        )
+        self.assertEqual(response.status_code, 200)
+        return [message['text'] for message in response.json()['results']]
+
+    def assert_archived(self, texts: list, comments: list):
+        data = load_chat_archive(self.chat.pk)
+        self.assertEqual([message['text'] for message in data['messages']], texts)
+        self.assertEqual([comment['text'] for comment in data['comments']], comments)
+        self.assertEqual(len({message['id'] for message in data['messages']}), len(texts))
+        self.assertFalse(ChatMessage.objects.filter(chat=self.chat).exists())
+        self.assertFalse(ChatComment.objects.filter(chat=self.chat).exists())
+
+    def test_archive(self):
+        self.archive()
+
+        self.assertIsNotNone(self.chat.archived_at)
+        self.assert_archived(['text', 'curator'], ['comment'])
+        self.assertEqual(self.get_messages(), ['curator', 'text'])
+        # ссылка файла сообщения перешла к архиву
+        self.assertEqual(ChatFile.objects.get(sha256=self.message_file.sha256).ref_count, 1)
+
+    def test_reopened_chat(self):
+        self.archive()
+        response = self.client.put(
+            f'/api/v1/curator/chats/{self.chat.pk}/', {'status': ChatStatus.OPEN},
+            content_type='application/json', HTTP_AUTHORIZATION=self.get_curator_token('topic_a')
+        )
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(
+            '/api/v1/client/chats/messages/',
+            {'chat': self.chat.pk, 'text': 'reopened', 'message_type': MessageType.TEXT},
+            content_type='application/json', HTTP_AUTHORIZATION=self.get_token(self.client_user)
+        )
+        self.assertEqual(response.status_code, 201)
+        new_file = self.create_message_file(self.chat, b'reopened file')
+        ChatComment.objects.create(chat=self.chat, curator=self.curator, text='new comment')
+
+        # открытый чат не трогается
+        self.archive()
+        self.assertEqual(ChatMessage.objects.filter(chat=self.chat).count(), 2)
+        self.assertEqual(self.get_messages(), ['text', 'reopened', 'curator', 'text'])
+
+        self.close_chat()
+        self.archive()
+        self.assert_archived(['text', 'curator', 'reopened', 'text'], ['comment', 'new comment'])
+        self.assertEqual(self.get_messages(), ['text', 'reopened', 'curator', 'text'])
+        self.assertEqual(ChatFile.objects.get(sha256=new_file.sha256).ref_count, 1)
+
+        # при удалении чата архив освобождает все ссылки
+        self.chat.delete()
+        self.assertFalse(ChatFile.objects.exists())
+        self.assertEqual(FileDeletion.objects.count(), 2)
+
+    def test_interrupted_purge(self):
+        with mock.patch('apps.chat.archive.purge_chat', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.archive()
+        self.assertEqual(ChatMessage.objects.filter(chat=self.chat).count(), 2)
+
+        self.archive()
+        self.assert_archived(['text', 'curator'], ['comment'])
+        self.assertEqual(ChatFile.objects.get(sha256=self.message_file.sha256).ref_count, 1)
+        self.assertFalse(archive_storage.exists(f'{get_archive_name(self.chat.pk)}.tmp'))
+        # непрочитанные перенесены в архив один раз
+        self.assertEqual(self.chat.archived_unread, {str(self.client_user.pk): 1, str(self.curator.pk): 1})
+
+    def get_list_chat(self, url: str, token: str) -> dict:
+        response = self.client.get(url, HTTP_AUTHORIZATION=token)
+        self.assertEqual(response.status_code, 200)
+        return next(chat for chat in response.json()['results'] if chat['id'] == self.chat.pk)
+
+    def test_archived_chat_list(self):
+        last_message = ChatMessage.objects.of_chat(self.chat).first()
+        self.archive()
+
+        self.assertEqual(self.chat.archived_last_message['id'], last_message.pk)
+        client_token = self.get_token(self.client_user)
+        curator_token = self.get_curator_token('topic_a')
+        chat = self.get_list_chat('/api/v1/client/chats/', client_token)
+        self.assertEqual(chat['last_message']['text'], 'curator')
+        self.assertFalse(chat['last_message']['is_my_message'])
+        self.assertEqual(chat['unread_messages_count'], 1)
+        chat = self.get_list_chat('/api/v1/curator/chats/', curator_token)
+        self.assertEqual(chat['last_message']['id'], last_message.pk)
+        self.assertEqual(chat['unread_messages_count'], 1)
+        self.assertEqual(
+            Chat.objects.filter(pk=self.chat.pk).annotate_messages(self.client_user).get().last_message_created_at,
+            parse_datetime(self.chat.archived_last_message['created_at'])
+        )
+        self.assertTrue(ChatMessage.objects.has_notifications(self.client_user))
+
+        response = self.client.get(
+            f'/api/v1/client/chats/{self.chat.pk}/messages/{last_message.pk}/read/', HTTP_AUTHORIZATION=client_token
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_list_chat('/api/v1/client/chats/', client_token)['unread_messages_count'], 0)
+        self.assertFalse(ChatMessage.objects.has_notifications(self.client_user))
+        self.assertEqual(self.get_list_chat('/api/v1/curator/chats/', curator_token)['unread_messages_count'], 1)
+
+    def test_archive_cache(self):
+        self.archive()
+        with mock.patch('apps.chat.archive.gzip.decompress', wraps=gzip.decompress) as decompress_mock:
+            self.assertEqual(self.get_messages(), ['curator', 'text'])
+            self.assertEqual(self.get_messages(), ['curator', 'text'])
+            self.assertEqual(decompress_mock.call_count, 1)
+
+            # новый файл архива читается заново
+            self.create_message(self.chat, self.curator, 'new')
+            write_chat_archive(self.chat)
+            self.assertEqual(self.get_messages(), ['new', 'curator', 'text'])
+        self.assertEqual(decompress_mock.call_count, 2)
+
+    def test_fill_archived_last_message(self):
+        migration = importlib.import_module('apps.chat.migrations.0012_chat_archived_last_message')
+        self.archive()
+        Chat.objects.filter(pk=self.chat.pk).update(archived_last_message=None, archived_unread={})
+
+        migration.fill_archived_last_message(django_apps, SimpleNamespace(connection=connection))
+
+        chat = Chat.objects.get(pk=self.chat.pk)
+        self.assertEqual(chat.archived_last_message, self.chat.archived_last_message)
+        self.assertEqual(chat.archived_unread, self.chat.archived_unread)
+
+
+class KeycloakTokenCacheTestCase(ChatTestCase):
+
+    def test_verified_token_cached(self):
+        token = self.get_token(self.client_user)
+        keycloak._verified_tokens.clear()
+        with mock.patch('core.libs.keycloak.jwt.JWT', wraps=keycloak.jwt.JWT) as jwt_mock:
+            user_info = keycloak.get_keycloak_user_info(token)
+            self.assertEqual(keycloak.get_keycloak_user_info(token), user_info)
+            self.assertEqual(async_to_sync(keycloak.aget_keycloak_user_info)(token), user_info)
+        self.assertEqual(jwt_mock.call_count, 1)
+        self.assertEqual(user_info['username'], self.client_user.username)
+
+    def test_invalid_token(self):
+        token = self.get_token(self.client_user)
+        self.assertIsNone(keycloak.get_keycloak_user_info(f'{token[:-4]}AAAA'))
+        response = self.client.get('/api/v1/client/chats/', HTTP_AUTHORIZATION=f'{token[:-4]}AAAA')
+        self.assertIn(response.status_code, (401, 403))
+
+
+class WsAuthTestCase(ChatTestMixin, TransactionTestCase):
+
+    def setUp(self):
+        self.create_chat_data()
+        super().setUp()
+        self.communicators = []
+
+    async def connect(self, query: str):
+        communicator = WebsocketCommunicator(application, f'/connect/?{query}')
+        connected, _ = await communicator.connect()
+        if connected:
+            self.communicators.append(communicator)
+        return communicator, connected
+
+    async def disconnect(self) -> None:
+        for communicator in self.communicators:
+            await communicator.disconnect()
+
+    async def get_bootstrap_ws_token(self, url: str, token: str) -> str:
+        response = await sync_to_async(self.client.get)(url, HTTP_AUTHORIZATION=token)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['ws_token_expires_in'], settings.WS_TOKEN_MAX_AGE_SECONDS)
+        return response.json()['ws_token']
+
+    async def post_message(self) -> None:
+        # события отправляются через consumer отправителя
+        _, connected = await self.connect(f'token={self.get_token(self.client_user)}')
+        self.assertTrue(connected)
+        response = await sync_to_async(self.client.post)(
+            '/api/v1/client/chats/messages/',
+            {'chat': self.chat.pk, 'text': 'ws', 'message_type': MessageType.TEXT},
+            content_type='application/json', HTTP_AUTHORIZATION=self.get_token(self.client_user)
+        )
+        self.assertEqual(response.status_code, 201)
+
+    @staticmethod
+    async def receive_event_types(communicator) -> set:
+        event_types = set()
+        while not await communicator.receive_nothing(0.3):
+            event_types.add((await communicator.receive_json_from())['event_type'])
+        return event_types
+
+    async def test_keycloak_token(self):
+        _, connected = await self.connect(f'token={self.get_token(self.client_user)}')
+        self.assertTrue(connected)
+        _, connected = await self.connect(f'token={self.get_token(self.client_user)[:-4]}AAAA')
+        self.assertFalse(connected)
+        _, connected = await self.connect('')
+        self.assertFalse(connected)
+        await self.disconnect()
+
+    async def test_curator_topic_groups(self):
+        curator, connected = await self.connect(f'token={self.get_curator_token("topic_a")}')
+        self.assertTrue(connected)
+        other_curator, connected = await self.connect(f'token={self.get_curator_token("topic_b")}')
+        self.assertTrue(connected)
+        await self.receive_event_types(curator)
+        await self.receive_event_types(other_curator)
+
+        await self.post_message()
+
+        self.assertIn('new_message', await self.receive_event_types(curator))
+        self.assertNotIn('new_message', await self.receive_event_types(other_curator))
+        await self.disconnect()
+
+    async def test_ws_token(self):
+        ws_token = await self.get_bootstrap_ws_token('/api/v1/curator/bootstrap/', self.get_curator_token('topic_a'))
+        with mock.patch('ws.auth.aget_keycloak_user_info') as keycloak_mock:
+            curator, connected = await self.connect(f'ws_token={ws_token}')
+        self.assertTrue(connected)
+        keycloak_mock.assert_not_called()
+        await self.receive_event_types(curator)
+
+        await self.post_message()
+
+        self.assertIn('new_message', await self.receive_event_types(curator))
+        await self.disconnect()
+
+    async def test_ws_token_rejected(self):
+        ws_token = await self.get_bootstrap_ws_token('/api/v1/client/bootstrap/', self.get_token(self.client_user))
+        _, connected = await self.connect(f'ws_token={ws_token[:-2]}xx')
+        self.assertFalse(connected)
+        with override_settings(WS_TOKEN_MAX_AGE_SECONDS=-1):
+            _, connected = await self.connect(f'ws_token={ws_token}')
+        self.assertFalse(connected)
+        _, connected = await self.connect(f'ws_token={ws_token}')
+        self.assertTrue(connected)
+        await self.disconnect()
+
+
+class ReadReplicaTestCase(TestCase):
+    """Выбор БД для чтения: реплика настроена (is_replica_configured), вместо view - запись выбранной БД"""
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.token = f'Bearer {uuid.uuid4()}'
+        self.status = 200
+        for target in ('core.middleware.is_replica_configured', 'core.db_router.is_replica_configured'):
+            patcher = mock.patch(target, return_value=True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        replica_state = dict(db_router._replica_state)
+        self.addCleanup(db_router._replica_state.update, replica_state)
+        db_router._replica_state.update(available=True, checked_at=time.monotonic())
+
+    def get_response(self, request):
+        self.read_db = db_router.ReadReplicaRouter().db_for_read(ChatMessage)
+        return HttpResponse(status=self.status)
+
+    async def aget_response(self, request):
+        return self.get_response(request)
+
+    def request(self, method: str, path: str, token: str = None):
+        request = getattr(self.factory, method)(path, HTTP_AUTHORIZATION=token or self.token)
+        ReadReplicaMiddleware(self.get_response)(request)
+        return self.read_db
+
+    def test_replica_views(self):
+        self.assertEqual(self.request('get', '/api/v1/curator/chats/'), settings.DB_REPLICA_ALIAS)
+        self.assertIsNone(self.request('get', '/api/v1/curator/chats/info/'))
+        self.assertIsNone(self.request('post', '/api/v1/curator/chats/'))
+        self.assertIsNone(db_router.ReadReplicaRouter().db_for_read(ChatMessage))
+
+    def test_read_your_writes(self):
+        self.status = 400
+        self.request('post', '/api/v1/curator/chats/messages/')
+        self.assertEqual(self.request('get', '/api/v1/curator/chats/'), settings.DB_REPLICA_ALIAS)
+
+        self.status = 201
+        self.request('post', '/api/v1/curator/chats/messages/')
+        self.status = 200
+        self.assertIsNone(self.request('get', '/api/v1/curator/chats/'))
+        # закреплен только токен, сделавший запись
+        self.assertEqual(
+            self.request('get', '/api/v1/curator/chats/', token=f'Bearer {uuid.uuid4()}'), settings.DB_REPLICA_ALIAS
+        )
+
+    @override_settings(DB_REPLICA_PIN_SECONDS=1)
+    def test_pin_expires(self):
+        self.request('post', '/api/v1/curator/chats/messages/')
+        self.assertIsNone(self.request('get', '/api/v1/curator/chats/'))
+        time.sleep(1.1)
+        self.assertEqual(self.request('get', '/api/v1/curator/chats/'), settings.DB_REPLICA_ALIAS)
+
+    async def test_async_middleware(self):
+        middleware = ReadReplicaMiddleware(self.aget_response)
+        await middleware(self.factory.post('/api/v1/curator/chats/messages/', HTTP_AUTHORIZATION=self.token))
+        await middleware(self.factory.get('/api/v1/curator/chats/', HTTP_AUTHORIZATION=self.token))
+        self.assertIsNone(self.read_db)
+        await middleware(self.factory.get('/api/v1/curator/chats/', HTTP_AUTHORIZATION=f'Bearer {uuid.uuid4()}'))
+        self.assertEqual(self.read_db, settings.DB_REPLICA_ALIAS)
+
+    def test_replica_lag(self):
+        db_router._replica_state['checked_at'] = 0.0
+        with mock.patch('core.db_router.get_replica_lag', return_value=settings.DB_REPLICA_MAX_LAG + 1):
+            self.assertIsNone(self.request('get', '/api/v1/curator/chats/'))
+        # результат проверки кэшируется на DB_REPLICA_LAG_CHECK_INTERVAL
+        with mock.patch('core.db_router.get_replica_lag', return_value=0) as lag_mock:
+            self.assertIsNone(self.request('get', '/api/v1/curator/chats/'))
+        lag_mock.assert_not_called()
+
+        db_router._replica_state['checked_at'] = 0.0
+        with mock.patch('core.db_router.get_replica_lag', side_effect=DatabaseError('replica is down')):
+            self.assertIsNone(self.request('get', '/api/v1/curator/chats/'))
+        db_router._replica_state['checked_at'] = 0.0
+        with mock.patch('core.db_router.get_replica_lag', return_value=0):
+            self.assertEqual(self.request('get', '/api/v1/curator/chats/'), settings.DB_REPLICA_ALIAS)
+
+    async def test_lag_not_checked_in_event_loop(self):
+        db_router._replica_state.update(available=False, checked_at=0.0)
+        with mock.patch('core.db_router.get_replica_lag') as lag_mock, db_router.use_replica():
+            self.assertIsNone(db_router.ReadReplicaRouter().db_for_read(ChatMessage))
+        lag_mock.assert_not_called()
+
+
+class ChatClosedAtTestCase(ChatTestCase):
+    """Chat.closed_at для времени разрешения в статистике lms-crm"""
+
+    def test_close_and_reopen(self):
+        self.chat.close_chat()
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.closed_at, self.chat.summary_changed_at)
+        closed_at = self.chat.closed_at
+
+        self.chat.save()
+        self.chat.refresh_from_db()
+        self.assertEqual(self.chat.closed_at, closed_at)
+
+        self.chat.assign_curator(self.curator)
+        self.chat.refresh_from_db()
+        self.assertIsNone(self.chat.closed_at)
+
+    def test_fill_closed_at(self):
+        migration = importlib.import_module('apps.chat.migrations.0011_chat_closed_at')
+        message = self.create_message(self.chat, self.client_user)
+        empty_chat = Chat.objects.create_client_chat(self.other_client, self.topic)
+        open_chat = Chat.objects.create_client_chat(self.other_client, self.other_topic)
+        Chat.objects.filter(pk__in=(self.chat.pk, empty_chat.pk)).update(status=ChatStatus.CLOSED, closed_at=None)
+
+        with mock.patch.object(migration, 'BATCH_SIZE', 1):
+            migration.fill_closed_at(django_apps, SimpleNamespace(connection=connection))
+
+        self.assertEqual(Chat.objects.get(pk=self.chat.pk).closed_at, message.created_at)
+        empty_chat.refresh_from_db()
+        self.assertEqual(empty_chat.closed_at, empty_chat.updated_at)
+        self.assertIsNone(Chat.objects.get(pk=open_chat.pk).closed_at)
+
+        response = self.client.get(
+            '/api/v1/lms-crm/stats/chat-avg-time/', HTTP_AUTHORIZATION=self.get_curator_token('topic_a')
+        )
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(WS_TRACE_SAMPLE_RATE=0, WS_TRACE_TOKEN='trace-secret')
+class TraceTestCase(SimpleTestCase):
+
+    def get_trace_id(self, **headers):
+        token, trace_id = metrics.start_trace(RequestFactory().get('/', headers=headers))
+        metrics.stop_trace(token)
+        return trace_id
+
+    def test_trace_id_requires_token(self):
+        self.assertIsNone(self.get_trace_id(x_trace_id='abc'))
+        self.assertIsNone(self.get_trace_id(x_trace_id='abc', x_trace_token='wrong'))
+        self.assertEqual(self.get_trace_id(x_trace_id='abc', x_trace_token='trace-secret'), 'abc')
+        self.assertIsNone(self.get_trace_id(x_trace_id='a b\n', x_trace_token='trace-secret'))
+        with override_settings(WS_TRACE_TOKEN=''):
+            self.assertIsNone(self.get_trace_id(x_trace_id='abc', x_trace_token=''))
+
+    def test_sampled_without_token(self):
+        with override_settings(WS_TRACE_SAMPLE_RATE=1):
+            trace_id = self.get_trace_id(x_trace_id='abc')
+        self.assertIsNotNone(trace_id)
+        self.assertNotEqual(trace_id, 'abc')
+
+
+class QueryBudgetTestCase(ChatTestCase):
+    """Количество запросов в БД view с query_budget не зависит от количества чатов и сообщений"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        chats = [cls.chat, Chat.objects.create_client_chat(cls.other_client, cls.other_topic)]
+        for client in (cls.client_user, cls.other_client):
+            chat = Chat.objects.create_client_chat(client, cls.other_topic)
+            chat.curator = cls.curator
+            chat.status = ChatStatus.CLOSED
+            chat.save()
+            chats.append(chat)
+        for chat in chats:
+            for sender in (chat.client, cls.curator, chat.client):
+                cls.create_message(chat, sender)
+            ChatComment.objects.create(chat=chat, curator=cls.curator, text='comment')
+
+    def assert_budget(self, url: str, token: str):
+        response = self.client.get(url, HTTP_AUTHORIZATION=token)
+        self.assertEqual(response.status_code, 200, url)
+        assert_query_budget(response)
+
+    def test_client_views(self):
+        token = self.get_token(self.client_user)
+        for url in (
+            '/api/v1/client/topics/',
+            '/api/v1/client/chats/',
+            '/api/v1/client/bootstrap/',
+            f'/api/v1/client/chats/{self.chat.pk}/messages/',
+        ):
+            with self.subTest(url=url):
+                self.assert_budget(url, token)
+
+    def test_curator_views(self):
+        token = self.get_curator_token('topic_a', 'topic_b')
+        for url in (
+            '/api/v1/curator/chats/topics/',
+            '/api/v1/curator/chats/',
+            '/api/v1/curator/bootstrap/',
+            f'/api/v1/curator/chats/{self.chat.pk}/messages/',
+            f'/api/v1/curator/chats/{self.chat.pk}/comments/',
+        ):
+            with self.subTest(url=url):
+                self.assert_budget(url, token)
+
+    def test_lms_crm_views(self):
+        token = self.get_curator_token('topic_a', 'topic_b')
+        for url in (
+            '/api/v1/lms-crm/notifications/',
+            '/api/v1/lms-crm/stats/topics-popularity/',
+            '/api/v1/lms-crm/stats/chat-avg-time/',
+            '/api/v1/lms-crm/stats/topics-avg-time/',
+            '/api/v1/lms-crm/stats/topics-closed-chat-percentage/',
+            '/api/v1/lms-crm/stats/closed-chat-percentage/',
+            '/api/v1/lms-crm/stats/curator-chats-count/',
+            '/api/v1/lms-crm/stats/curator-chats-avg-time/',
+        ):
+            with self.subTest(url=url):
+                self.assert_budget(url, token)
+
+    def test_budget_exceeded(self):
+        with capture_queries() as queries:
+            for message in ChatMessage.objects.all():
+                message.sender
+        with self.assertRaisesMessage(AssertionError, 'repeated 1'):
+            assert_query_budget(queries, budget=20)
+        with self.assertRaisesMessage(AssertionError, 'budget 1'):
+            assert_query_budget(queries, budget=1)
+
+
+class WsSendQueueTestCase(SimpleTestCase):
+    """
+    Исходящая очередь сокета: замещение событий состояния, ожидание записи в сокет, отключение медленного сокета,
+    остановка
+    """
+
+    @staticmethod
+    def event(event_type: str, **data) -> dict:
+        return {'event_type': event_type, 'data': data}
+
+    def create_consumer(self, max_size: int) -> WsChatConsumer:
+        # отправка из очереди остановлена: события копятся, как у не успевающего получать их сокета
+        consumer = WsChatConsumer()
+        consumer.scope = {'user': User(id=1, role=UserRole.CLIENT)}
+        consumer.channel_name = 'test.channel'
+        consumer.connected_role = UserRole.CLIENT
+        consumer.send_queue = SendQueue(max_size)
+        consumer.send_task = asyncio.ensure_future(asyncio.Event().wait())
+        consumer.send_json = mock.AsyncMock()
+        consumer.close = mock.AsyncMock()
+        return consumer
+
+    async def get_event_types(self, send_queue: SendQueue) -> list:
+        event_types = []
+        while len(send_queue):
+            event_data, _, _ = await send_queue.get()
+            send_queue.task_done()
+            event_types.append(event_data['event_type'])
+        return event_types
+
+    async def test_coalesce(self):
+        send_queue = SendQueue(2)
+        self.assertFalse(send_queue.put(self.event('update_status', user_id=1, status='online'), None, time.time()))
+        self.assertFalse(send_queue.put(self.event('new_message', chat_id=1), None, time.time()))
+        # очередь полна, но событие состояния замещает неотправленное и встает в конец
+        self.assertTrue(send_queue.put(self.event('update_status', user_id=1, status='offline'), None, time.time()))
+        read = self.event('read_chat_message', chat_id=1, user_id=2)
+        self.assertFalse(send_queue.put(read, None, time.time(), force=True))
+        with self.assertRaises(asyncio.QueueFull):
+            send_queue.put(self.event('update_status', user_id=2, status='online'), None, time.time())
+
+        event_data, _, _ = await send_queue.get()
+        self.assertEqual(event_data['event_type'], 'new_message')
+        send_queue.task_done()
+        event_data, _, _ = await send_queue.get()
+        self.assertEqual(event_data['data']['status'], 'offline')
+        send_queue.task_done()
+        self.assertEqual(await self.get_event_types(send_queue), ['read_chat_message'])
+        await asyncio.wait_for(send_queue.join(), 1)
+
+    async def test_evict_full_queue(self):
+        consumer = self.create_consumer(max_size=2)
+        for chat_id in range(3):
+            await consumer.send_event({'event_type': 'new_message', 'data': {'chat_id': chat_id}})
+
+        self.assertIsNone(consumer.send_queue)
+        self.assertIsNone(consumer.send_task)
+        resync = consumer.send_json.await_args.args[0]
+        self.assertEqual(resync['event_type'], 'resync')
+        self.assertEqual(resync['data']['reason'], 'slow_consumer')
+        consumer.close.assert_awaited_once_with(code=SLOW_CONSUMER_CLOSE_CODE)
+        # после отключения события не ставятся
+        await consumer.send_event({'event_type': 'new_message', 'data': {'chat_id': 4}})
+        consumer.send_json.assert_awaited_once()
+
+    @override_settings(WS_SEND_QUEUE_HIGH_WATER=1, WS_SLOW_CONSUMER_SECONDS=0)
+    async def test_evict_over_high_water(self):
+        consumer = self.create_consumer(max_size=10)
+        await consumer.send_event({'event_type': 'new_message', 'data': {'chat_id': 1}})
+        await consumer.send_event({'event_type': 'new_message', 'data': {'chat_id': 2}})
+        self.assertIsNotNone(consumer.over_high_water_since)
+        consumer.close.assert_not_awaited()
+        await asyncio.sleep(0.01)
+        await consumer.send_event({'event_type': 'new_message', 'data': {'chat_id': 3}})
+        consumer.close.assert_awaited_once_with(code=SLOW_CONSUMER_CLOSE_CODE)
+
+    @override_settings(WS_DRAIN_SEND_TIMEOUT_SECONDS=0.01)
+    async def test_drain_full_queue(self):
+        consumer = self.create_consumer(max_size=2)
+        for chat_id in range(2):
+            await consumer.send_event({'event_type': 'new_message', 'data': {'chat_id': chat_id}})
+        send_queue = consumer.send_queue
+
+        await consumer.drain(0)
+
+        consumer.close.assert_awaited_once_with(code=DRAIN_CLOSE_CODE)
+        self.assertEqual(await self.get_event_types(send_queue), ['new_message', 'new_message', 'reconnect'])
+        consumer.send_task.cancel()
+
+    def test_write_buffer_size(self):
+        transport = SimpleNamespace(dataBuffer=b'written', offset=4, _tempDataLen=5)
+        self.assertEqual(get_write_buffer_size(transport), 8)
+        # TLS: буфер транспорта под оберткой
+        self.assertEqual(get_write_buffer_size(SimpleNamespace(transport=transport)), 8)
+        self.assertIsNone(get_write_buffer_size(SimpleNamespace(transport=None)))
+
+    async def test_server_write_buffer_extension(self):
+        from ws.server import DrainingServer
+
+        scopes = []
+
+        async def application(scope, receive, send):
+            scopes.append(scope)
+
+        server = DrainingServer(application, endpoints=['tcp:port=0'])
+        protocol = mock.Mock(transport=SimpleNamespace(dataBuffer=b'frame', offset=0))
+        server.connections = {protocol: {}}
+        server.create_application(protocol, {'type': 'websocket'})
+        await server.connections[protocol]['application_instance']
+        self.assertEqual(get_write_buffer_getter(scopes[0])(), 5)
+
+    def start_sending(self, consumer: WsChatConsumer, buffer: dict) -> None:
+        consumer.send_task.cancel()
+        consumer.write_buffer_size = lambda: buffer['size']
+        consumer.send_task = asyncio.ensure_future(consumer._send_queued_events())
+
+    @override_settings(WS_WRITE_BUFFER_HIGH_WATER=10, WS_WRITE_BUFFER_POLL_SECONDS=0.01)
+    async def test_write_buffer_backpressure(self):
+        consumer = self.create_consumer(max_size=10)
+        buffer = {'size': 11}
+        self.start_sending(consumer, buffer)
+        for chat_id in range(3):
+            await consumer.send_event({'event_type': 'new_message', 'data': {'chat_id': chat_id}})
+        await asyncio.sleep(0.05)
+        # клиент не принимает данные: события ждут в исходящей очереди, а не в буфере transport
+        consumer.send_json.assert_not_awaited()
+        self.assertEqual(len(consumer.send_queue), 2)
+
+        buffer['size'] = 10
+        await asyncio.wait_for(consumer.send_queue.join(), 1)
+        self.assertEqual([call.args[0]['data']['chat_id'] for call in consumer.send_json.await_args_list], [0, 1, 2])
+        consumer.close.assert_not_awaited()
+        consumer.send_task.cancel()
+
+    @override_settings(WS_WRITE_BUFFER_HIGH_WATER=10, WS_WRITE_BUFFER_POLL_SECONDS=0.01, WS_SLOW_CONSUMER_SECONDS=0.05)
+    async def test_evict_stalled_socket(self):
+        consumer = self.create_consumer(max_size=10)
+        self.start_sending(consumer, {'size': 11})
+        send_task = consumer.send_task
+        await consumer.send_event({'event_type': 'new_message', 'data': {'chat_id': 1}})
+        await asyncio.wait_for(send_task, 1)
+
+        self.assertIsNone(consumer.send_queue)
+        self.assertIsNone(consumer.send_task)
+        consumer.send_json.assert_awaited_once()
+        self.assertEqual(consumer.send_json.await_args.args[0]['event_type'], 'resync')
+        consumer.close.assert_awaited_once_with(code=SLOW_CONSUMER_CLOSE_CODE)
+
+
+class AsyncViewsTestCase(ChatTestCase):
+    """Асинхронные версии view отвечают так же, как синхронные"""
+
+    def setUp(self):
+        super().setUp()
+        self.create_message(self.chat, self.client_user, 'client')
+        self.create_message(self.chat, self.curator, 'curator')
+        self.client_token = self.get_token(self.client_user)
+        self.curator_token = self.get_curator_token('topic_a')
+
+    @staticmethod
+    def get_request(method: str, url: str, token: str, data=None):
+        if method == 'post':
+            return RequestFactory().post(url, data, content_type='application/json', HTTP_AUTHORIZATION=token)
+        return RequestFactory().get(url, data, HTTP_AUTHORIZATION=token)
+
+    async def get_responses(self, sync_view, async_view, url: str, token: str, data=None, method='get', **kwargs):
+        sync_response = await sync_to_async(
+            lambda: sync_view.as_view()(self.get_request(method, url, token, data), **kwargs).render()
+        )()
+        async_response = (await async_view.as_view()(self.get_request(method, url, token, data), **kwargs)).render()
+        self.assertEqual(async_response.status_code, sync_response.status_code)
+        return json.loads(sync_response.content), json.loads(async_response.content)
+
+    async def assert_same(self, sync_view, async_view, url: str, token: str, data=None, **kwargs) -> dict:
+        sync_data, async_data = await self.get_responses(sync_view, async_view, url, token, data, **kwargs)
+        # версия списка - время запроса
+        if isinstance(sync_data, dict) and 'version' in sync_data:
+            sync_data.pop('version'), async_data.pop('version')
+        self.assertEqual(async_data, sync_data)
+        return async_data
+
+    async def test_chat_lists(self):
+        data = await self.assert_same(
+            client_views.ChatListCreateAPIView, client_views.ChatListCreateAsyncAPIView,
+            '/api/v1/client/chats/', self.client_token
+        )
+        self.assertEqual(data['results'][0]['last_message']['text'], 'curator')
+        data = await self.assert_same(
+            curator_views.ChatCreateListAPIView, curator_views.ChatCreateListAsyncAPIView,
+            '/api/v1/curator/chats/', self.curator_token
+        )
+        self.assertEqual([chat['id'] for chat in data['results']], [self.chat.pk])
+        # темы куратора - из токена
+        data = await self.assert_same(
+            curator_views.ChatCreateListAPIView, curator_views.ChatCreateListAsyncAPIView,
+            '/api/v1/curator/chats/', self.get_curator_token('topic_b')
+        )
+        self.assertEqual(data['results'], [])
+
+    async def test_chat_changes(self):
+        since = get_chats_version()
+        await asyncio.sleep(0.002)
+        await ChatMessage.objects.acreate(
+            chat=self.chat, sender=self.client_user, text='new', message_type=MessageType.TEXT
+        )
+        for sync_view, async_view, url, token in (
+            (client_views.ChatChangesAPIView, client_views.ChatChangesAsyncAPIView,
+             '/api/v1/client/chats/changes/', self.client_token),
+            (curator_views.ChatChangesAPIView, curator_views.ChatChangesAsyncAPIView,
+             '/api/v1/curator/chats/changes/', self.curator_token),
+        ):
+            with self.subTest(url=url):
+                data = await self.assert_same(sync_view, async_view, url, token, {'since': since})
+                self.assertEqual([chat['id'] for chat in data['changed']], [self.chat.pk])
+
+    async def test_message_lists(self):
+        url = f'/api/v1/client/chats/{self.chat.pk}/messages/'
+        data = await self.assert_same(
+            client_views.ChatMessageListAPIView, client_views.ChatMessageListAsyncAPIView,
+            url, self.client_token, pk=self.chat.pk
+        )
+        self.assertEqual([message['text'] for message in data['results']], ['curator', 'client'])
+        await self.assert_same(
+            client_views.ChatMessageListAPIView, client_views.ChatMessageListAsyncAPIView,
+            url, self.get_token(self.other_client), pk=self.chat.pk
+        )
+        await self.assert_same(
+            curator_views.ChatMessageListAPIView, curator_views.ChatMessageListAsyncAPIView,
+            f'/api/v1/curator/chats/{self.chat.pk}/messages/', self.curator_token, pk=self.chat.pk
+        )
+
+    async def test_message_create(self):
+        for sync_view, async_view, url, token in (
+            (client_views.ChatMessageCreateAPIView, client_views.ChatMessageCreateAsyncAPIView,
+             '/api/v1/client/chats/messages/', self.client_token),
+            (curator_views.ChatMessageCreateAPIView, curator_views.ChatMessageCreateAsyncAPIView,
+             '/api/v1/curator/chats/messages/', self.curator_token),
+        ):
+            with self.subTest(url=url):
+                sync_data, async_data = await self.get_responses(
+                    sync_view, async_view, url, token,
+                    {'chat': self.chat.pk, 'text': 'created', 'message_type': MessageType.TEXT}, method='post'
+                )
+                self.assertEqual({**async_data, 'id': None, 'created_at': None}, {
+                    **sync_data, 'id': None, 'created_at': None
+                })
+                self.assertEqual(async_data['text'], 'created')
+                await self.assert_same(
+                    sync_view, async_view, url, token, {'chat': self.chat.pk, 'message_type': MessageType.TEXT},
+                    method='post'
+                )
+
+    async def test_authentication(self):
+        user = User(username='new_client', role=UserRole.CLIENT, name='Новый клиент')
+        request = RequestFactory().get('/', HTTP_AUTHORIZATION=self.get_token(user))
+        authentication = KeyCloakAuthentication()
+        new_user, _ = await authentication.aauthenticate(request)
+        self.assertEqual((new_user.username, new_user.role), ('new_client', UserRole.CLIENT))
+        self.assertEqual((await sync_to_async(authentication.authenticate)(request))[0], new_user)
+        # без токена, без роли чата у нового пользователя, неверная подпись
+        no_role_user = User(username='no_role', role=UserRole.CLIENT, name='Без роли')
+        for token in (None, make_token(no_role_user, []), f'{self.get_token(user)[:-4]}AAAA'):
+            with self.subTest(token=token and token[-4:]):
+                request = RequestFactory().get('/', **({'HTTP_AUTHORIZATION': token} if token else {}))
+                with self.assertRaises(AuthenticationFailed):
+                    await authentication.aauthenticate(request)
+                with self.assertRaises(AuthenticationFailed):
+                    await sync_to_async(authentication.authenticate)(request)
+
+
+@override_settings(CHAT_CHANGES_OVERLAP_SECONDS=0)
+class ChatChangesTestCase(ChatTestCase):
+    """Дельта списка чатов chats/changes/ после версии из заголовка X-Chats-Version"""
+
+    def setUp(self):
+        super().setUp()
+        # чаты из setUpTestData изменены до версии списка
+        Chat.objects.update(summary_changed_at=timezone.now() - datetime.timedelta(hours=1))
+        self.other_chat = Chat.objects.create_client_chat(self.other_client, self.topic)
+        Chat.objects.filter(pk=self.other_chat.pk).update(summary_changed_at=self.chat.summary_changed_at)
+
+    def get_version(self, url: str, token: str) -> str:
+        response = self.client.get(url, HTTP_AUTHORIZATION=token)
+        self.assertEqual(response.status_code, 200)
+        time.sleep(0.002)
+        return response[CHATS_VERSION_HEADER]
+
+    def get_changes(self, url: str, token: str, since: str) -> dict:
+        response = self.client.get(url, {'since': since}, HTTP_AUTHORIZATION=token)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_client_changes(self):
+        token = self.get_token(self.client_user)
+        version = self.get_version('/api/v1/client/chats/', token)
+        changes = self.get_changes('/api/v1/client/chats/changes/', token, version)
+        self.assertEqual((changes['reset'], changes['changed'], changes['removed']), (False, [], []))
+
+        self.create_message(self.chat, self.client_user)
+        self.create_message(self.other_chat, self.other_client)
+        new_chat = Chat.objects.create_client_chat(self.client_user, self.other_topic)
+        changes = self.get_changes('/api/v1/client/chats/changes/', token, version)
+        self.assertCountEqual([chat['id'] for chat in changes['changed']], [self.chat.pk, new_chat.pk])
+        self.assertEqual(changes['removed'], [])
+
+        version = changes['version']
+        time.sleep(0.002)
+        new_chat_id = new_chat.pk
+        new_chat.delete()
+        changes = self.get_changes('/api/v1/client/chats/changes/', token, version)
+        self.assertEqual((changes['changed'], changes['removed']), ([], [new_chat_id]))
+
+    def test_curator_topic_move(self):
+        token = self.get_curator_token('topic_a')
+        version = self.get_version('/api/v1/curator/chats/', token)
+        response = self.client.put(
+            f'/api/v1/curator/chats/{self.chat.pk}/', {'topic': self.other_topic.pk},
+            content_type='application/json', HTTP_AUTHORIZATION=self.get_curator_token('topic_a', 'topic_b')
+        )
+        self.assertEqual(response.status_code, 200)
+
+        changes = self.get_changes('/api/v1/curator/chats/changes/', token, version)
+        self.assertEqual((changes['changed'], changes['removed']), ([], [self.chat.pk]))
+        changes = self.get_changes('/api/v1/curator/chats/changes/', self.get_curator_token('topic_b'), version)
+        self.assertEqual([chat['id'] for chat in changes['changed']], [self.chat.pk])
+        self.assertEqual(changes['removed'], [])
+
+    def test_reset(self):
+        token = self.get_token(self.client_user)
+        expired = timezone.now() - datetime.timedelta(seconds=settings.CHAT_CHANGES_RETENTION_SECONDS + 1)
+        for since in ('', 'version', str(int(expired.timestamp() * 1000))):
+            with self.subTest(since=since):
+                self.assertTrue(self.get_changes('/api/v1/client/chats/changes/', token, since)['reset'])
+
+        version = self.get_version('/api/v1/client/chats/', token)
+        Chat.objects.create_client_chat(self.client_user, self.other_topic)
+        self.create_message(self.chat, self.client_user)
+        with self.settings(CHAT_CHANGES_MAX_SIZE=1):
+            changes = self.get_changes('/api/v1/client/chats/changes/', token, version)
+        self.assertEqual((changes['reset'], changes['changed']), (True, []))
+
+    async def test_async_view(self):
+        token = self.get_token(self.client_user)
+        view = client_views.ChatChangesAsyncAPIView.as_view()
+        version = get_chats_version()
+        await asyncio.sleep(0.002)
+        await ChatMessage.objects.acreate(
+            chat=self.chat, sender=self.client_user, text='text', message_type=MessageType.TEXT
+        )
+        response = await view(RequestFactory().get(
+            '/api/v1/client/chats/changes/', {'since': version}, HTTP_AUTHORIZATION=token
+        ))
+        self.assertEqual([chat['id'] for chat in response.data['changed']], [self.chat.pk])
+        self.assertEqual(response.data['removed'], [])
+
+    def test_default_tombstones(self):
+        Chat.objects.create_client_chat(self.client_user, self.other_topic).delete()
+        self.assertFalse(ChatChangesMixin().get_tombstones().exists())
@@ -0,0 +1,90 @@
+"""
+Кэш процесса: права доступа -> id тем чатов.
+Версия карты хранится в Redis и увеличивается при сохранении/удалении ChatTopic,
+процессы перечитывают карту, когда видят новую версию
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from apps.chat.models import ChatTopic
+
+_permission_topics = {'version': None, 'checked_at': 0.0, 'data': {}}
+
+
+def _build(rows) -> dict:
+    data = {}
+    for topic_id, permission in rows:
+        data.setdefault(permission, []).append(topic_id)
+    return data
+
+
+def _store(version, data: dict) -> dict:
+    _permission_topics['version'] = version
+    _permission_topics['checked_at'] = time.monotonic()
+    _permission_topics['data'] = data
+    return data
+
+
+def _is_fresh() -> bool:
+    return (
+        _permission_topics['version'] is not None and
+        _permission_topics['checked_at'] + settings.CHAT_TOPICS_VERSION_CHECK_INTERVAL > time.monotonic()
+    )
+
+
+def get_permission_topics() -> dict:
+    """
+    Вернет словарь {permission: [topic_id, ...]}
+    :return: dict
+    """
+    if _is_fresh():
+        return _permission_topics['data']
+    version = cache.get_or_set(settings.CHAT_TOPICS_VERSION_CACHE_KEY, 1, timeout=None)
+    if version == _permission_topics['version']:
+        return _store(version, _permission_topics['data'])
+    return _store(version, _build(ChatTopic.objects.values_list('id', 'permission')))
+
+
+async def aget_permission_topics() -> dict:
+    """Асинхронная версия get_permission_topics"""
+    if _is_fresh():
+        return _permission_topics['data']
+    version = await cache.aget_or_set(settings.CHAT_TOPICS_VERSION_CACHE_KEY, 1, timeout=None)
+    if version == _permission_topics['version']:
+        return _store(version, _permission_topics['data'])
+    return _store(version, _build([row async for row in ChatTopic.objects.values_list('id', 'permission')]))
+
+
+def invalidate_permission_topics() -> None:
+    """Новая версия карты для всех процессов"""
+    cache.add(settings.CHAT_TOPICS_VERSION_CACHE_KEY, 1, timeout=None)
+    cache.incr(settings.CHAT_TOPICS_VERSION_CACHE_KEY)
+    _permission_topics['version'] = None
+
+
+def get_user_topic_ids(roles: list) -> list:
+    """
+    Вернет id тем, доступных по ролям пользователя
+    :param roles: роли пользователя из KeyCloak
+    :return: list[int]
+    """
+    permission_topics = get_permission_topics()
+    return [topic_id for role in set(roles) for topic_id in permission_topics.get(role, [])]
+
+
+async def aget_user_topic_ids(roles: list) -> list:
+    """Асинхронная версия get_user_topic_ids"""
+    permission_topics = await aget_permission_topics()
+    return [topic_id for role in set(roles) for topic_id in permission_topics.get(role, [])]
+
+
+def get_user_topic_permissions(roles: list, permission_topics: dict) -> list:
+    """
+    Вернет права пользователя, по которым есть темы (имена групп curator-вебсокетов)
+    :param roles: роли пользователя из KeyCloak
+    :param permission_topics: результат get_permission_topics
+    :return: list[str]
+    """
+    return [role for role in dict.fromkeys(roles) if role in permission_topics]
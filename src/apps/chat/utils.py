@@ -1,3 +1,5 @@
+import hashlib
+
 from django.db import models
 
 
@@ -17,3 +19,16 @@ class MessageType(models.TextChoices):
     EMOJI = 'emoji', 'Эмодзи'
     TEXT = 'text', 'Текст'
     FILE = 'file', 'Файл'
+
+
+def get_file_sha256(file) -> str:
+    """
+    Вернет SHA-256 содержимого файла
+    :param file: File - файл (UploadedFile или FieldFile)
+    :return: str - hex digest
+    """
+    sha256 = hashlib.sha256()
+    for chunk in file.chunks():
+        sha256.update(chunk)
+    file.seek(0)
+    return sha256.hexdigest()
@@ -4,9 +4,9 @@ from typing import Optional
 from django.conf import settings
 from django.contrib.auth.base_user import AbstractBaseUser, BaseUserManager
 from django.contrib.auth.models import PermissionsMixin, AbstractUser
-from django.core.cache import cache
 from django.db import models
 
+from apps.users import presence
 from apps.users.utils import UserRole
 
 
@@ -44,6 +44,29 @@ class UserManager(BaseUserManager):
         )
         return user
 
+    async def acreate_keycloak_user(self, username: str, role: str, name: str | None, **kwargs):
+        user = self.model(
+            username=username,
+            role=role,
+            name=name
+        )
+        await user.asave(using=self._db)
+        return user
+
+    async def aget_online_ids(self, user_ids) -> set:
+        """
+        Вернет id пользователей онлайн одним запросом в кэш
+        :param user_ids: id пользователей
+        :return: set[int]
+        """
+        if not user_ids:
+            return set()
+        tm = int(datetime.datetime.now().timestamp())
+        return {
+            user_id for user_id, data in (await presence.aget_many_user_channels(user_ids)).items()
+            if any(v + settings.USER_CHANNELS_CACHE_TIMEOUT >= tm for v in data.values())
+        }
+
 
 class User(AbstractBaseUser, PermissionsMixin):
     username = models.CharField(
@@ -72,18 +95,38 @@ class User(AbstractBaseUser, PermissionsMixin):
         return bool(self.get_ws_connections())
 
     def get_ws_connections(self) -> dict:
-        user_key = settings.USER_CHANNELS_CACHE_KEY.format(user_id=self.pk)
-        data = cache.get(user_key, dict())
+        data = presence.get_user_channels(self.pk)
         if data:
             tm = int(datetime.datetime.now().timestamp())
             data = {k: v for k, v in data.items() if v + settings.USER_CHANNELS_CACHE_TIMEOUT >= tm}
-            cache.set(user_key, data, settings.USER_CHANNELS_CACHE_TIMEOUT)
+            presence.set_user_channels(self.pk, data)
         return data
 
     def get_ws_channels(self) -> list:
         return list(self.get_ws_connections().keys())
 
+    async def aget_ws_connections(self) -> dict:
+        data = await presence.aget_user_channels(self.pk)
+        if data:
+            tm = int(datetime.datetime.now().timestamp())
+            data = {k: v for k, v in data.items() if v + settings.USER_CHANNELS_CACHE_TIMEOUT >= tm}
+            await presence.aset_user_channels(self.pk, data)
+        return data
+
+    async def aget_ws_channels(self) -> list:
+        return list((await self.aget_ws_connections()).keys())
+
     def check_keycloak_update(self, keycloak_user_data: dict) -> None:
+        update_fields = self._keycloak_update_fields(keycloak_user_data)
+        if update_fields:
+            self.save(update_fields=update_fields)
+
+    async def acheck_keycloak_update(self, keycloak_user_data: dict) -> None:
+        update_fields = self._keycloak_update_fields(keycloak_user_data)
+        if update_fields:
+            await self.asave(update_fields=update_fields)
+
+    def _keycloak_update_fields(self, keycloak_user_data: dict) -> list:
         update_fields = []
 
         if self.name != keycloak_user_data['name']:
@@ -94,6 +137,4 @@ class User(AbstractBaseUser, PermissionsMixin):
         if role and self.role != role:
             self.role = role
             update_fields.append('role')
-
-        if update_fields:
-            self.save(update_fields=update_fields)
+        return update_fields
@@ -0,0 +1,98 @@
+"""
+Каналы вебсокетов пользователя (присутствие) в кэше: {channel_name: timestamp обновления}.
+Пользователь закреплен за кэшем из PRESENCE_CACHES (get_shard). На время решардинга чтение объединяет
+каналы из нового и прежнего (PRESENCE_PREVIOUS_CACHES) кэша без устаревших записей, запись идет в оба кэша -
+процессы со старым списком видят каналы сокетов процессов с новым
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from core.libs.redis_shards import get_shard
+
+
+def get_caches(user_id: int) -> list:
+    """
+    Кэш пользователя, вторым - прежний кэш пользователя на время решардинга
+    :return: list[BaseCache]
+    """
+    aliases = [get_shard(str(user_id), settings.PRESENCE_CACHES)]
+    if settings.PRESENCE_PREVIOUS_CACHES:
+        previous = get_shard(str(user_id), settings.PRESENCE_PREVIOUS_CACHES)
+        if previous not in aliases:
+            aliases.append(previous)
+    return [caches[alias] for alias in aliases]
+
+
+def get_key(user_id: int) -> str:
+    return settings.USER_CHANNELS_CACHE_KEY.format(user_id=user_id)
+
+
+def merge_channels(data: dict, other: dict) -> None:
+    """
+    Каналы other добавляются в data, у канала из обоих кэшей - последнее обновление.
+    Каналы без обновления дольше USER_CHANNELS_CACHE_TIMEOUT пропускаются: закрытый сокет остается
+    в кэше, который не обновил процесс, закрывший его
+    """
+    expired = int(time.time()) - settings.USER_CHANNELS_CACHE_TIMEOUT
+    for channel_name, timestamp in other.items():
+        if timestamp >= expired:
+            data[channel_name] = max(timestamp, data.get(channel_name, timestamp))
+
+
+def get_user_channels(user_id: int) -> dict:
+    """
+    Каналы пользователя
+    :return: {channel_name: timestamp}
+    """
+    user_caches = get_caches(user_id)
+    if len(user_caches) == 1:
+        return user_caches[0].get(get_key(user_id), dict())
+    data = {}
+    for cache in user_caches:
+        merge_channels(data, cache.get(get_key(user_id), dict()))
+    return data
+
+
+async def aget_user_channels(user_id: int) -> dict:
+    """Асинхронная версия get_user_channels"""
+    user_caches = get_caches(user_id)
+    if len(user_caches) == 1:
+        return await user_caches[0].aget(get_key(user_id), dict())
+    data = {}
+    for cache in user_caches:
+        merge_channels(data, await cache.aget(get_key(user_id), dict()))
+    return data
+
+
+def set_user_channels(user_id: int, data: dict) -> None:
+    for cache in get_caches(user_id):
+        cache.set(get_key(user_id), data, settings.USER_CHANNELS_CACHE_TIMEOUT)
+
+
+async def aset_user_channels(user_id: int, data: dict) -> None:
+    """Асинхронная версия set_user_channels"""
+    for cache in get_caches(user_id):
+        await cache.aset(get_key(user_id), data, settings.USER_CHANNELS_CACHE_TIMEOUT)
+
+
+async def aget_many_user_channels(user_ids) -> dict:
+    """
+    Каналы пользователей, один запрос get_many на кэш
+    :return: {user_id: {channel_name: timestamp}}, пользователи без каналов не возвращаются
+    """
+    users_by_cache = {}
+    for user_id in user_ids:
+        for cache in get_caches(user_id):
+            users_by_cache.setdefault(cache, []).append(user_id)
+    if len(users_by_cache) == 1:
+        cache, cache_user_ids = users_by_cache.popitem()
+        keys = {get_key(user_id): user_id for user_id in cache_user_ids}
+        return {keys[key]: data for key, data in (await cache.aget_many(keys)).items()}
+    result = {}
+    for cache, cache_user_ids in users_by_cache.items():
+        keys = {get_key(user_id): user_id for user_id in cache_user_ids}
+        for key, data in (await cache.aget_many(keys)).items():
+            merge_channels(result.setdefault(keys[key], {}), data)
+    return result
@@ -0,0 +1,96 @@
+"""
+Чтение с реплики для view с read_replica = True, см. core.middleware.ReadReplicaMiddleware.
+Запись всегда в основную БД, при отставании или недоступности реплики чтение тоже с основной
+"""
+import asyncio
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DatabaseError, connections
+from loguru import logger
+
+_use_replica = ContextVar('use_replica', default=False)
+_replica_state = {'available': True, 'checked_at': 0.0}
+
+REPLICA_LAG_SQL = '''
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+'''
+
+
+def is_replica_configured() -> bool:
+    return settings.DB_REPLICA_ALIAS in settings.DATABASES
+
+
+@contextmanager
+def use_replica(enabled: bool = True):
+    """Чтение с реплики внутри блока (в т.ч. в sync_to_async, контекст копируется в поток)"""
+    token = _use_replica.set(enabled)
+    try:
+        yield
+    finally:
+        _use_replica.reset(token)
+
+
+def get_replica_lag() -> float:
+    """
+    Отставание реплики в секундах
+    :return: float
+    """
+    connection = connections[settings.DB_REPLICA_ALIAS]
+    if connection.vendor != 'postgresql':
+        return 0.0
+    with connection.cursor() as cursor:
+        cursor.execute(REPLICA_LAG_SQL)
+        return float(cursor.fetchone()[0])
+
+
+def is_replica_available() -> bool:
+    """
+    Реплика отвечает и отстает не больше DB_REPLICA_MAX_LAG. Результат проверки кэшируется
+    в процессе на DB_REPLICA_LAG_CHECK_INTERVAL, в event loop используется последний результат
+    :return: bool
+    """
+    if _replica_state['checked_at'] + settings.DB_REPLICA_LAG_CHECK_INTERVAL > time.monotonic():
+        return _replica_state['available']
+    try:
+        asyncio.get_running_loop()
+        return _replica_state['available']
+    except RuntimeError:
+        pass
+
+    _replica_state['checked_at'] = time.monotonic()
+    try:
+        lag = get_replica_lag()
+    except DatabaseError as e:
+        logger.warning(f'DB replica unavailable: {e}')
+        _replica_state['available'] = False
+        return False
+    available = lag <= settings.DB_REPLICA_MAX_LAG
+    if not available:
+        logger.warning(f'DB replica lag {lag:.1f}s, reads go to primary')
+    _replica_state['available'] = available
+    return available
+
+
+class ReadReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        if _use_replica.get() and is_replica_configured() and is_replica_available():
+            return settings.DB_REPLICA_ALIAS
+        return None
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == settings.DB_REPLICA_ALIAS:
+            return False
+        return None
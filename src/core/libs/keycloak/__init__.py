@@ -1,17 +1,162 @@
 import datetime
+import json
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 from typing import Optional
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.core.cache import cache
-from keycloak.keycloak_openid import KeycloakOpenID
+from jwcrypto import jwk, jwt
+from jwcrypto.common import base64url_decode
 from loguru import logger
 
-keycloak_openid = KeycloakOpenID(
-    server_url=settings.KEYCLOAK_SERVER_URL,
-    client_id=settings.KEYCLOAK_CLIENT_ID,
-    realm_name=settings.KEYCLOAK_REALM_NAME,
-    client_secret_key=settings.KEYCLOAK_CLIENT_SECRET_KEY
-)
+from core.libs.metrics import KEYCLOAK_DECODE_SECONDS
+
+PUBLIC_KEY_CACHE_KEY = 'KEYCLOAK_PUBLIC_SECRET_KEY'
+PUBLIC_KEY_CACHE_TIMEOUT = 60 * 60 * 24
+
+# проверенные токены процесса: token -> (exp, user_info)
+_verified_tokens = OrderedDict()
+_verified_tokens_lock = threading.Lock()
+
+
+def _format_public_key(public_key: str) -> str:
+    if public_key.startswith('-----BEGIN'):
+        return public_key
+    return f'-----BEGIN PUBLIC KEY-----\n{public_key}\n-----END PUBLIC KEY-----'
+
+
+@lru_cache(maxsize=1)
+def get_keycloak_openid():
+    """
+    Клиент KeyCloak, создается при первом запросе публичного ключа: импорт python-keycloak и настройки
+    KeyCloak не нужны процессу, пока ключ задан в KEYCLOAK_PUBLIC_KEY / KEYCLOAK_PUBLIC_KEY_FILE или в кэше
+    :return: KeycloakOpenID
+    """
+    from keycloak.keycloak_openid import KeycloakOpenID
+
+    return KeycloakOpenID(
+        server_url=settings.KEYCLOAK_SERVER_URL,
+        client_id=settings.KEYCLOAK_CLIENT_ID,
+        realm_name=settings.KEYCLOAK_REALM_NAME,
+        client_secret_key=settings.KEYCLOAK_CLIENT_SECRET_KEY
+    )
+
+
+@lru_cache(maxsize=4)
+def _read_public_key_file(path: str) -> str:
+    """Файл читается один раз на процесс"""
+    with open(path) as f:
+        return _format_public_key(f.read().strip())
+
+
+def _get_configured_public_key() -> Optional[str]:
+    """
+    Публичный ключ из KEYCLOAK_PUBLIC_KEY или файла KEYCLOAK_PUBLIC_KEY_FILE
+    :return: PEM или None - ключ запрашивается из KeyCloak
+    """
+    if settings.KEYCLOAK_PUBLIC_KEY:
+        return _format_public_key(settings.KEYCLOAK_PUBLIC_KEY)
+    if settings.KEYCLOAK_PUBLIC_KEY_FILE:
+        return _read_public_key_file(settings.KEYCLOAK_PUBLIC_KEY_FILE)
+    return None
+
+
+@lru_cache(maxsize=4)
+def _get_jwk(public_key: str) -> jwk.JWK:
+    """Разобранный публичный ключ, PEM разбирается один раз на процесс"""
+    return jwk.JWK.from_pem(public_key.encode('utf-8'))
+
+
+def _get_test_public_key(keycloak_token: str) -> Optional[str]:
+    """
+    Ключ стенда нагрузочного теста для токенов с kid KEYCLOAK_TEST_KEY_ID
+    :return: PEM или None - токен проверяется ключом KeyCloak
+    """
+    if not settings.KEYCLOAK_TEST_PUBLIC_KEY:
+        return None
+    try:
+        header = json.loads(base64url_decode(keycloak_token.split('.', 1)[0]))
+    except ValueError:
+        return None
+    if header.get('kid') != settings.KEYCLOAK_TEST_KEY_ID:
+        return None
+    return _format_public_key(settings.KEYCLOAK_TEST_PUBLIC_KEY)
+
+
+def _get_cached_user_info(token: str) -> Optional[dict]:
+    with _verified_tokens_lock:
+        item = _verified_tokens.get(token)
+        if item is None:
+            return None
+        exp, user_info = item
+        if exp < int(datetime.datetime.now().timestamp()):
+            _verified_tokens.pop(token, None)
+            return None
+        _verified_tokens.move_to_end(token)
+        return user_info
+
+
+def _set_cached_user_info(token: str, exp: int, user_info: dict) -> None:
+    with _verified_tokens_lock:
+        _verified_tokens[token] = (exp, user_info)
+        _verified_tokens.move_to_end(token)
+        while len(_verified_tokens) > settings.KEYCLOAK_TOKEN_CACHE_SIZE:
+            _verified_tokens.popitem(last=False)
+
+
+def _decode_user_info(keycloak_token: str, public_key: str) -> Optional[dict]:
+    """
+    Проверка подписи токена и разбор данных пользователя
+    :param keycloak_token: access token из KeyCloak
+    :param public_key: публичный ключ в формате PEM
+    :return: dict or None
+    """
+    with KEYCLOAK_DECODE_SECONDS.time():
+        data = jwt.json_decode(
+            jwt.JWT(jwt=keycloak_token, key=_get_jwk(public_key), algs=['RS256'], check_claims={}).claims
+        )
+    if data['exp'] < int(datetime.datetime.now().timestamp()):
+        return None
+
+    user_info = {
+        'id': data['sub'],
+        'roles': data['realm_access']['roles'],
+        'username': data['preferred_username'],
+        'name': data.get('name', None),
+
+    }
+    _set_cached_user_info(keycloak_token, data['exp'], user_info)
+    return user_info
+
+
+def _get_local_public_key(keycloak_token: str) -> Optional[str]:
+    """
+    Ключ проверки токена без запроса в кэш и KeyCloak: ключ стенда нагрузочного теста
+    или ключ из настроек
+    :return: PEM или None - ключ KeyCloak из кэша (_get_remote_public_key)
+    """
+    return _get_test_public_key(keycloak_token) or _get_configured_public_key()
+
+
+def _get_remote_public_key() -> str:
+    """Публичный ключ KeyCloak из кэша, при пустом кэше - запрос в KeyCloak"""
+    public_key = cache.get(PUBLIC_KEY_CACHE_KEY, None)
+    if public_key is None:
+        public_key = _format_public_key(get_keycloak_openid().public_key())
+        cache.set(PUBLIC_KEY_CACHE_KEY, public_key, timeout=PUBLIC_KEY_CACHE_TIMEOUT)
+    return public_key
+
+
+async def _aget_remote_public_key() -> str:
+    """Асинхронная версия _get_remote_public_key"""
+    public_key = await cache.aget(PUBLIC_KEY_CACHE_KEY, None)
+    if public_key is None:
+        public_key = _format_public_key(await sync_to_async(get_keycloak_openid().public_key)())
+        await cache.aset(PUBLIC_KEY_CACHE_KEY, public_key, timeout=PUBLIC_KEY_CACHE_TIMEOUT)
+    return public_key
 
 
 def get_keycloak_user_info(keycloak_token: str) -> dict | None:
@@ -26,36 +171,49 @@ def get_keycloak_user_info(keycloak_token: str) -> dict | None:
     } or None
     """
     try:
-        public_key = cache.get('KEYCLOAK_PUBLIC_SECRET_KEY', None)
-        if public_key is None:
-            public_key = f'-----BEGIN PUBLIC KEY-----\n{keycloak_openid.public_key()}\n-----END PUBLIC KEY-----'
-            cache.set('KEYCLOAK_PUBLIC_SECRET_KEY', public_key, timeout=60 * 60 * 24)
-        data = keycloak_openid.decode_token(
-            keycloak_token,
-            key=public_key
-        )
-        if data['exp'] < int(datetime.datetime.now().timestamp()):
-            return None
+        user_info = _get_cached_user_info(keycloak_token)
+        if user_info is not None:
+            return user_info
+        public_key = _get_local_public_key(keycloak_token) or _get_remote_public_key()
+        return _decode_user_info(keycloak_token, public_key)
+    except Exception as e:
+        logger.error(f'Error get_keycloak_user_info: {e}')
+        return None
 
-        return {
-            'id': data['sub'],
-            'roles': data['realm_access']['roles'],
-            'username': data['preferred_username'],
-            'name': data.get('name', None),
 
-        }
+async def aget_keycloak_user_info(keycloak_token: str) -> dict | None:
+    """
+    Асинхронная версия get_keycloak_user_info: кэш через async API,
+    запрос публичного ключа в KeyCloak только при пустом кэше
+    :param keycloak_token: access token из KeyCloak
+    :return: dict or None
+    """
+    try:
+        user_info = _get_cached_user_info(keycloak_token)
+        if user_info is not None:
+            return user_info
+        public_key = _get_local_public_key(keycloak_token) or await _aget_remote_public_key()
+        return _decode_user_info(keycloak_token, public_key)
     except Exception as e:
-        logger.error(f'Error get_keycloak_user_info: {e}')
+        logger.error(f'Error aget_keycloak_user_info: {e}')
         return None
 
 
+def _get_roles(user_info: Optional[dict]) -> list:
+    if user_info is None:
+        return []
+    return user_info.get('roles', [])
+
+
 def get_keycloak_user_roles(token: str) -> list:
     """
     Получение списка ролей пользователя из токена
     :param token: токен
     :return: список ролей
     """
-    user_info = get_keycloak_user_info(token)
-    if user_info is None:
-        return []
-    return user_info.get('roles', [])
+    return _get_roles(get_keycloak_user_info(token))
+
+
+async def aget_keycloak_user_roles(token: str) -> list:
+    """Асинхронная версия get_keycloak_user_roles"""
+    return _get_roles(await aget_keycloak_user_info(token))
@@ -0,0 +1,326 @@
+"""
+Метрики Prometheus процесса. В gunicorn с несколькими воркерами значения пишутся в
+PROMETHEUS_MULTIPROC_DIR и собираются со всех воркеров при запросе /metrics/
+"""
+import hmac
+import os
+import random
+import re
+import time
+import uuid
+from collections import Counter as CounterDict
+from contextvars import ContextVar
+from typing import Optional
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from loguru import logger
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
+
+from core.libs.postgresql_pool import get_pools_stats
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+# trace id из заголовка попадает в логи и в заголовок ответа
+TRACE_ID_RE = re.compile(r'^[\w.-]{1,64}$')
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'crm_http_request_seconds', 'Время обработки HTTP запроса', ['view', 'method', 'status'],
+    buckets=LATENCY_BUCKETS
+)
+HTTP_DB_QUERIES = Histogram(
+    'crm_http_db_queries', 'Запросов в БД за HTTP запрос', ['view'], buckets=QUERY_COUNT_BUCKETS
+)
+HTTP_DB_QUERY_SECONDS = Histogram(
+    'crm_http_db_query_seconds', 'Суммарное время запросов в БД за HTTP запрос', ['view'], buckets=LATENCY_BUCKETS
+)
+
+WS_CONNECTIONS = Gauge(
+    'crm_ws_connections', 'Открытые вебсокеты', ['role'], multiprocess_mode='livesum'
+)
+WS_HANDLER_SECONDS = Histogram(
+    'crm_ws_handler_seconds', 'Время обработчика WsChatConsumer', ['handler'], buckets=LATENCY_BUCKETS
+)
+WS_EVENT_EMIT_SECONDS = Histogram(
+    'crm_ws_event_emit_seconds', 'Время отправки события из ws/utils.py', ['event'], buckets=LATENCY_BUCKETS
+)
+WS_EVENTS_DROPPED = Counter(
+    'crm_ws_events_dropped', 'Неотправленные события', ['event', 'reason']
+)
+WS_SLOW_CONSUMER_EVICTIONS = Counter(
+    'crm_ws_slow_consumer_evictions', 'Сокеты, отключенные из-за переполнения исходящей очереди', ['role']
+)
+WS_IDLE_DISCONNECTS = Counter(
+    'crm_ws_idle_disconnects', 'Сокеты, закрытые без сообщений клиента дольше WS_IDLE_TIMEOUT_SECONDS', ['role']
+)
+WS_DRAIN_DISCONNECTS = Counter(
+    'crm_ws_drain_disconnects', 'Сокеты, закрытые с reconnect при остановке процесса ws', ['role']
+)
+WS_EVENT_HOP_SECONDS = Histogram(
+    'crm_ws_event_hop_seconds',
+    'Задержка события: relay - от создания до consumer отправителя, fanout - до consumer получателя, '
+    'send - send_json получателя, total - от создания до отправки в сокет',
+    ['event', 'hop'], buckets=LATENCY_BUCKETS
+)
+CHANNEL_LAYER_SECONDS = Histogram(
+    'crm_channel_layer_seconds', 'Время операции channel layer', ['operation'], buckets=LATENCY_BUCKETS
+)
+CHANNEL_LAYER_QUEUE_DEPTH = Gauge(
+    'crm_channel_layer_queue_depth', 'Сообщения в буфере приема channel layer процесса',
+    multiprocess_mode='livesum'
+)
+
+KEYCLOAK_DECODE_SECONDS = Histogram(
+    'crm_keycloak_decode_seconds', 'Время проверки подписи токена KeyCloak', buckets=LATENCY_BUCKETS
+)
+
+DB_POOL_CONNECTIONS = Gauge(
+    'crm_db_pool_connections', 'Соединения пула', ['alias', 'state'], multiprocess_mode='livesum'
+)
+DB_POOL_MAX_SIZE = Gauge(
+    'crm_db_pool_max_size', 'Размер пула', ['alias'], multiprocess_mode='livesum'
+)
+DB_POOL_WAITING = Gauge(
+    'crm_db_pool_waiting', 'Потоки, ожидающие соединение', ['alias'], multiprocess_mode='livesum'
+)
+DB_POOL_WAITS = Gauge(
+    'crm_db_pool_waits', 'Ожидания соединения с запуска процесса', ['alias'], multiprocess_mode='livesum'
+)
+DB_POOL_WAIT_SECONDS = Gauge(
+    'crm_db_pool_wait_seconds', 'Время ожидания соединения с запуска процесса', ['alias'],
+    multiprocess_mode='livesum'
+)
+DB_POOL_TIMEOUTS = Gauge(
+    'crm_db_pool_timeouts', 'Таймауты ожидания соединения с запуска процесса', ['alias'],
+    multiprocess_mode='livesum'
+)
+
+# счетчики запросов в БД текущего HTTP запроса, контекст копируется в sync_to_async
+_request_queries = ContextVar('request_queries', default=None)
+# trace id текущего HTTP запроса, если запрос попал в выборку
+_trace_id = ContextVar('trace_id', default=None)
+
+
+def is_multiprocess() -> bool:
+    return bool(os.getenv('PROMETHEUS_MULTIPROC_DIR'))
+
+
+_IN_LIST = re.compile(r'IN \(%s(?:, %s)+\)')
+
+
+def get_query_fingerprint(sql: str) -> str:
+    """Текст запроса без значений: параметры передаются отдельно, списки IN (%s, ...) схлопываются"""
+    if ', %s' in sql:
+        return _IN_LIST.sub('IN (%s, ...)', sql)
+    return sql
+
+
+def start_request_queries() -> tuple:
+    """
+    Начало подсчета запросов в БД
+    :return: (token, {'count': int, 'duration': float, 'fingerprints': Counter})
+    """
+    queries = {'count': 0, 'duration': 0.0, 'fingerprints': CounterDict()}
+    return _request_queries.set(queries), queries
+
+
+def stop_request_queries(token) -> None:
+    _request_queries.reset(token)
+
+
+def get_request_queries():
+    """Счетчики запросов в БД текущего HTTP запроса или None вне запроса"""
+    return _request_queries.get()
+
+
+def query_observer(execute, sql, params, many, context):
+    """execute_wrapper соединения: время и количество запросов текущего HTTP запроса"""
+    queries = _request_queries.get()
+    if queries is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        queries['count'] += 1
+        queries['duration'] += time.perf_counter() - started
+        queries['fingerprints'][get_query_fingerprint(sql)] += 1
+
+
+def install_query_observer(sender, connection, **kwargs) -> None:
+    """Обработчик connection_created"""
+    if query_observer not in connection.execute_wrappers:
+        connection.execute_wrappers.append(query_observer)
+
+
+def enable_query_observer() -> None:
+    """Подсчет запросов для новых и уже открытых соединений"""
+    connection_created.connect(install_query_observer, dispatch_uid='metrics_query_observer')
+    for connection in connections.all(initialized_only=True):
+        install_query_observer(None, connection)
+
+
+def get_query_budget(view_class) -> int:
+    """
+    Допустимое количество запросов в БД за запрос: query_budget view или DB_QUERY_BUDGET
+    :return: int
+    """
+    return getattr(view_class, 'query_budget', None) or settings.DB_QUERY_BUDGET
+
+
+def get_repeated_queries(queries: dict) -> list:
+    """
+    Запросы, повторенные не меньше DB_N_PLUS_ONE_THRESHOLD раз (вероятный N+1)
+    :return: list[(fingerprint, count)]
+    """
+    return [
+        (fingerprint, count) for fingerprint, count in queries['fingerprints'].most_common()
+        if count >= settings.DB_N_PLUS_ONE_THRESHOLD
+    ]
+
+
+def check_query_budget(view: str, view_class, queries: dict) -> list:
+    """
+    Логирует превышение бюджета запросов и повторяющиеся запросы
+    :param view: имя view для лога
+    :param view_class: класс view с query_budget или None
+    :param queries: результат start_request_queries
+    :return: list[str] - найденные проблемы
+    """
+    problems = []
+    budget = get_query_budget(view_class)
+    if queries['count'] > budget:
+        problems.append(
+            f'{queries["count"]} queries ({queries["duration"] * 1000:.1f}ms) exceed budget {budget}'
+        )
+    for fingerprint, count in get_repeated_queries(queries):
+        problems.append(f'possible N+1, {count} x {fingerprint[:300]}')
+    if problems:
+        logger.warning(f'DB queries of {view}: ' + '; '.join(problems))
+    return problems
+
+
+def is_trace_trusted(value: Optional[str]) -> bool:
+    """Значение заголовка X-Trace-Token совпадает с WS_TRACE_TOKEN"""
+    return bool(settings.WS_TRACE_TOKEN and value) and hmac.compare_digest(value, settings.WS_TRACE_TOKEN)
+
+
+def start_trace(request) -> tuple:
+    """
+    trace id запроса: из заголовка X-Trace-Id, если запрос передал X-Trace-Token: <WS_TRACE_TOKEN>,
+    иначе новый для доли WS_TRACE_SAMPLE_RATE запросов. Без токена клиент не может включить трассировку
+    и логирование своих событий
+    :return: (token, trace_id or None)
+    """
+    trace_id = ''
+    if is_trace_trusted(request.headers.get('X-Trace-Token')):
+        trace_id = request.headers.get('X-Trace-Id', '')
+        if not TRACE_ID_RE.match(trace_id):
+            trace_id = ''
+    if not trace_id and random.random() < settings.WS_TRACE_SAMPLE_RATE:
+        trace_id = uuid.uuid4().hex
+    trace_id = trace_id or None
+    return _trace_id.set(trace_id), trace_id
+
+
+def stop_trace(token) -> None:
+    _trace_id.reset(token)
+
+
+def get_trace_id():
+    """trace id текущего HTTP запроса или None"""
+    return _trace_id.get()
+
+
+def new_event_trace(event: str) -> dict:
+    """
+    Метка события WS при создании, дополняется на каждом участке доставки
+    :param event: тип сообщения channel layer
+    :return: dict
+    """
+    return {'id': _trace_id.get(), 'event': event, 'created': time.time()}
+
+
+def observe_event_relay(trace: dict) -> dict:
+    """
+    Событие получено consumer отправителя
+    :return: метка для рассылки получателям
+    """
+    now = time.time()
+    WS_EVENT_HOP_SECONDS.labels(event=trace['event'], hop='relay').observe(max(now - trace['created'], 0))
+    return {**trace, 'relayed': now}
+
+
+def observe_event_delivery(trace: dict, received: float) -> None:
+    """
+    Событие отправлено в сокет получателя
+    :param trace: метка события
+    :param received: time.time() получения события consumer получателя
+    """
+    now = time.time()
+    event = trace['event']
+    hops = {
+        'fanout': received - trace.get('relayed', trace['created']),
+        'send': now - received,
+        'total': now - trace['created'],
+    }
+    for hop, seconds in hops.items():
+        WS_EVENT_HOP_SECONDS.labels(event=event, hop=hop).observe(max(seconds, 0))
+    if hops['total'] > settings.WS_EVENT_SLOW_SECONDS:
+        logger.warning(f'ws event {event} slow delivery, trace {trace["id"]}: ' + ', '.join(
+            f'{hop} {seconds * 1000:.1f}ms' for hop, seconds in hops.items()
+        ))
+    elif trace['id']:
+        logger.info(f'ws event {event} trace {trace["id"]}: ' + ', '.join(
+            f'{hop} {seconds * 1000:.1f}ms' for hop, seconds in hops.items()
+        ))
+
+
+def observe_db_pools() -> None:
+    """Метрики пулов соединений из core.libs.postgresql_pool"""
+    for stats in get_pools_stats():
+        alias = stats['name']
+        DB_POOL_CONNECTIONS.labels(alias=alias, state='in_use').set(stats['in_use'])
+        DB_POOL_CONNECTIONS.labels(alias=alias, state='idle').set(stats['idle'])
+        DB_POOL_MAX_SIZE.labels(alias=alias).set(stats['max_size'])
+        DB_POOL_WAITING.labels(alias=alias).set(stats['waiting'])
+        DB_POOL_WAITS.labels(alias=alias).set(stats['waits'])
+        DB_POOL_WAIT_SECONDS.labels(alias=alias).set(stats['wait_time'])
+        DB_POOL_TIMEOUTS.labels(alias=alias).set(stats['timeouts'])
+
+
+def observe_channel_layer(channel_layer) -> None:
+    """
+    Глубина буфера приема channel layer процесса ws: receive_buffer RedisChannelLayer
+    или очереди каналов RedisPubSubChannelLayer (по слою на event loop)
+    """
+    # RedisPubSubChannelLayer проксирует атрибуты в слой текущего event loop, getattr вне loop падает
+    loop_layers = vars(channel_layer).get('_layers')
+    if loop_layers is not None:
+        buffers = [layer.channels for layer in list(loop_layers.values())]
+    else:
+        buffers = [getattr(channel_layer, 'receive_buffer', None)]
+    buffers = [buffer for buffer in buffers if buffer is not None]
+    if not buffers:
+        return
+    try:
+        CHANNEL_LAYER_QUEUE_DEPTH.set(sum(queue.qsize() for buffer in buffers for queue in list(buffer.values())))
+    except RuntimeError:
+        # буфер изменился во время обхода в event loop
+        pass
+
+
+def generate_metrics() -> tuple:
+    """
+    Текст метрик для Prometheus
+    :return: (bytes, content_type)
+    """
+    if is_multiprocess():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,52 @@
+"""
+Проверка бюджета запросов в тестах:
+
+    response = client.get('/api/v1/client/chats/', headers={'authorization': token})
+    assert_query_budget(response)
+
+    with capture_queries() as queries:
+        serializer.data
+    assert_query_budget(queries, budget=3)
+"""
+from contextlib import contextmanager
+from typing import Optional
+
+from core.libs import metrics
+
+
+@contextmanager
+def capture_queries():
+    """
+    Подсчет запросов в БД внутри блока
+    :return: {'count': int, 'duration': float, 'fingerprints': Counter}
+    """
+    metrics.enable_query_observer()
+    token, queries = metrics.start_request_queries()
+    try:
+        yield queries
+    finally:
+        metrics.stop_request_queries(token)
+
+
+def assert_query_budget(response_or_queries, budget: Optional[int] = None) -> None:
+    """
+    Ошибка теста, если запросов в БД больше бюджета или есть повторяющиеся запросы (N+1)
+    :param response_or_queries: ответ тестового клиента (MetricsMiddleware) или результат capture_queries
+    :param budget: бюджет, по умолчанию query_budget view ответа или DB_QUERY_BUDGET
+    """
+    if isinstance(response_or_queries, dict):
+        queries, view_class = response_or_queries, None
+    else:
+        queries = response_or_queries.db_queries
+        match = response_or_queries.resolver_match
+        view_class = getattr(match.func, 'view_class', None) if match else None
+
+    limit = budget or metrics.get_query_budget(view_class)
+    repeated = metrics.get_repeated_queries(queries)
+    if queries['count'] > limit or repeated:
+        details = '\n'.join(
+            f'{count} x {fingerprint}' for fingerprint, count in queries['fingerprints'].most_common()
+        )
+        raise AssertionError(
+            f'{queries["count"]} queries, budget {limit}, repeated {len(repeated)}:\n{details}'
+        )
@@ -0,0 +1,3 @@
+from core.libs.postgresql_pool.pool import ConnectionPool, PoolTimeout, get_pools_stats
+
+__all__ = ['ConnectionPool', 'PoolTimeout', 'get_pools_stats']
@@ -0,0 +1,52 @@
+from django.db.backends.base.base import NO_DB_ALIAS
+from django.db.backends.postgresql import base, creation
+
+from core.libs.postgresql_pool.pool import close_idle_connections, get_pool
+
+
+class DatabaseCreation(creation.DatabaseCreation):
+
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # свободные соединения пула к тестовой БД не дают ее удалить
+        close_idle_connections()
+        super()._destroy_test_db(test_database_name, verbosity)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    PostgreSQL с пулом соединений процесса (DATABASES[alias]['POOL']).
+    close() возвращает соединение в пул, поэтому с CONN_MAX_AGE = 0 соединение
+    освобождается в конце каждого запроса и каждого вызова database_sync_to_async
+    """
+    creation_class = DatabaseCreation
+
+    @property
+    def pool(self):
+        options = self.settings_dict.get('POOL') or {}
+        if self.alias == NO_DB_ALIAS or not options.get('MAX_SIZE'):
+            return None
+        conn_params = self.get_connection_params()
+        key = (self.alias, repr(sorted(conn_params.items())))
+        return get_pool(key, self.alias, options)
+
+    def get_new_connection(self, conn_params):
+        pool = self.pool
+        if pool is None:
+            return super().get_new_connection(conn_params)
+        connection = pool.getconn(lambda: super(DatabaseWrapper, self).get_new_connection(conn_params))
+        # для соединения из пула уровень изоляции выставляется так же, как при подключении
+        self.isolation_level = base.IsolationLevel(
+            self.settings_dict['OPTIONS'].get('isolation_level', base.IsolationLevel.READ_COMMITTED)
+        )
+        return connection
+
+    def _close(self):
+        pool = self.pool
+        if pool is None or self.connection is None:
+            return super()._close()
+        with self.wrap_database_errors:
+            if self.in_atomic_block:
+                # Django оставляет ссылку на соединение до выхода из atomic, в пул его вернуть нельзя
+                pool.discard(self.connection)
+            else:
+                pool.putconn(self.connection)
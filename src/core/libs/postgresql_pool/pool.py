@@ -0,0 +1,269 @@
+import os
+import threading
+import time
+from collections import deque
+
+import psycopg2
+from psycopg2 import extensions
+from loguru import logger
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    pass
+
+
+class ConnectionPool:
+    """
+    Пул соединений psycopg2 процесса, общий для всех потоков.
+    Свободные соединения выдаются в порядке LIFO, соединения, простоявшие дольше check_interval,
+    проверяются запросом SELECT 1, старше max_lifetime закрываются
+    """
+
+    def __init__(self, name: str, min_size: int, max_size: int, timeout: float,
+                 max_idle: float, max_lifetime: float, check_interval: float):
+        self.name = name
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.check_interval = check_interval
+
+        self._pid = os.getpid()
+        self._condition = threading.Condition()
+        self._idle = deque()  # (connection, created_at, released_at)
+        self._created_at = {}  # id(connection) -> created_at выданных соединений
+        self._size = 0
+        self._waiting = 0
+        self._stats = {
+            'requests': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'timeouts': 0,
+            'connections_created': 0,
+            'connections_closed': 0,
+            'health_check_failures': 0,
+        }
+
+    def getconn(self, connect):
+        """
+        Вернет соединение из пула или новое соединение
+        :param connect: callable - открытие нового соединения
+        :return: connection
+        """
+        while True:
+            item = self._acquire()
+            if item is None:
+                return self._open(connect)
+            connection, created_at, released_at = item
+            if self._is_alive(connection, created_at, released_at):
+                with self._condition:
+                    self._created_at[id(connection)] = created_at
+                return connection
+            self._discard(connection)
+
+    def putconn(self, connection) -> None:
+        """
+        Возврат соединения в пул. Открытая транзакция откатывается,
+        сломанные и старые соединения закрываются
+        """
+        with self._condition:
+            created_at = self._created_at.pop(id(connection), None)
+        if created_at is None or os.getpid() != self._pid:
+            self._close(connection)
+            return
+        if not self._reset(connection) or time.monotonic() - created_at > self.max_lifetime:
+            self._discard(connection)
+            return
+        with self._condition:
+            self._idle.append((connection, created_at, time.monotonic()))
+            self._trim()
+            self._condition.notify()
+
+    def discard(self, connection) -> None:
+        """Закрытие выданного соединения без возврата в пул"""
+        with self._condition:
+            self._created_at.pop(id(connection), None)
+        self._discard(connection)
+
+    def close_idle(self) -> None:
+        """Закрытие всех свободных соединений, выданные соединения закрываются при возврате"""
+        with self._condition:
+            idle, self._idle = self._idle, deque()
+            self._size -= len(idle)
+            self._stats['connections_closed'] += len(idle)
+            self._condition.notify_all()
+        for connection, _, _ in idle:
+            try:
+                connection.close()
+            except psycopg2.Error:
+                pass
+
+    def stats(self) -> dict:
+        """
+        Метрики пула: размер, занятые и свободные соединения, ожидания свободного соединения
+        :return: dict
+        """
+        with self._condition:
+            idle = len(self._idle)
+            return {
+                'name': self.name,
+                'max_size': self.max_size,
+                'size': self._size,
+                'in_use': self._size - idle,
+                'idle': idle,
+                'waiting': self._waiting,
+                'saturation': round((self._size - idle) / self.max_size, 3),
+                **self._stats,
+                'wait_time': round(self._stats['wait_time'], 3),
+            }
+
+    def _acquire(self):
+        deadline = time.monotonic() + self.timeout
+        with self._condition:
+            self._check_fork()
+            self._stats['requests'] += 1
+            waited = None
+            try:
+                while True:
+                    if self._idle:
+                        return self._idle.pop()
+                    if self._size < self.max_size:
+                        self._size += 1
+                        return None
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        logger.warning(f'DB pool {self.name} exhausted: {self._size} in use, {self._waiting} waiting')
+                        raise PoolTimeout(f'connection pool {self.name} timeout after {self.timeout}s')
+                    if waited is None:
+                        waited = time.monotonic()
+                        self._stats['waits'] += 1
+                        self._waiting += 1
+                    self._condition.wait(remaining)
+            finally:
+                if waited is not None:
+                    self._waiting -= 1
+                    self._stats['wait_time'] += time.monotonic() - waited
+
+    def _open(self, connect):
+        try:
+            connection = connect()
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._created_at[id(connection)] = time.monotonic()
+            self._stats['connections_created'] += 1
+        return connection
+
+    def _is_alive(self, connection, created_at: float, released_at: float) -> bool:
+        now = time.monotonic()
+        if connection.closed or now - created_at > self.max_lifetime:
+            return False
+        if now - released_at < self.check_interval:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            if not connection.autocommit:
+                connection.rollback()
+            return True
+        except psycopg2.Error:
+            with self._condition:
+                self._stats['health_check_failures'] += 1
+            return False
+
+    @staticmethod
+    def _reset(connection) -> bool:
+        if connection.closed:
+            return False
+        status = connection.info.transaction_status
+        if status == extensions.TRANSACTION_STATUS_IDLE:
+            return True
+        if status in (extensions.TRANSACTION_STATUS_INTRANS, extensions.TRANSACTION_STATUS_INERROR):
+            try:
+                connection.rollback()
+                return True
+            except psycopg2.Error:
+                return False
+        return False
+
+    def _discard(self, connection) -> None:
+        self._close(connection)
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def _close(self, connection) -> None:
+        with self._condition:
+            self._stats['connections_closed'] += 1
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    def _trim(self) -> None:
+        """Закрытие соединений, простаивающих дольше max_idle, сверх min_size. Вызывается под блокировкой"""
+        now = time.monotonic()
+        while len(self._idle) > self.min_size and now - self._idle[0][2] > self.max_idle:
+            connection, _, _ = self._idle.popleft()
+            self._size -= 1
+            self._stats['connections_closed'] += 1
+            try:
+                connection.close()
+            except psycopg2.Error:
+                pass
+
+    def _check_fork(self) -> None:
+        """После fork соединения родителя не используются и не закрываются. Вызывается под блокировкой"""
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self._idle.clear()
+            self._created_at.clear()
+            self._size = 0
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(key, name: str, options: dict) -> ConnectionPool:
+    """
+    Пул процесса для параметров подключения
+    :param key: ключ пула (alias и параметры подключения)
+    :param name: имя пула для метрик
+    :param options: DATABASES[alias]['POOL']
+    :return: ConnectionPool
+    """
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = ConnectionPool(
+                    name=name,
+                    min_size=options.get('MIN_SIZE', 1),
+                    max_size=options['MAX_SIZE'],
+                    timeout=options.get('TIMEOUT', 10),
+                    max_idle=options.get('MAX_IDLE', 300),
+                    max_lifetime=options.get('MAX_LIFETIME', 3600),
+                    check_interval=options.get('CHECK_INTERVAL', 30),
+                )
+    return pool
+
+
+def get_pools_stats() -> list:
+    """
+    Метрики всех пулов процесса
+    :return: list[dict]
+    """
+    return [pool.stats() for pool in list(_pools.values())]
+
+
+def close_idle_connections() -> None:
+    """Закрытие свободных соединений всех пулов процесса"""
+    for pool in list(_pools.values()):
+        pool.close_idle()
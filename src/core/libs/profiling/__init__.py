@@ -0,0 +1,206 @@
+"""
+Сэмплирующий профилировщик медленных HTTP запросов и обработчиков WsChatConsumer.
+Общий поток процесса раз в PROFILING_INTERVAL снимает стеки потоков (sys._current_frames),
+пока идет профилируемая обработка. Профиль сохраняется в PROFILING_DIR, если обработка длилась
+дольше PROFILING_SLOW_SECONDS или профилирование запрошено заголовком X-Profile: <PROFILING_TOKEN>.
+Синхронная обработка профилирует свой поток, асинхронная - все потоки процесса: работа
+sync_to_async идет в других потоках, в профиль попадают и одновременные запросы
+"""
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from functools import lru_cache
+from typing import Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from loguru import logger
+
+PROFILE_HEADER = 'X-Profile'
+MAX_STACK_DEPTH = 128
+# последний кадр потока, ожидающего работу: такие сэмплы асинхронного профиля считаются простоем
+IDLE_FRAMES = (
+    'selectors.py', 'threading.py', 'queue.py', 'concurrent/futures/thread.py',
+)
+
+
+class Capture:
+    """Профиль одной обработки: сэмплы стеков {"frame;frame;...": count}"""
+
+    def __init__(self, kind: str, name: str, forced: bool, all_threads: bool):
+        self.kind = kind
+        self.name = name
+        self.forced = forced
+        self.thread_id = None if all_threads else threading.get_ident()
+        self.samples = Counter()
+        self.idle_samples = 0
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.duration = None
+
+
+class Sampler:
+    """Поток сэмплирования процесса, работает, пока есть активные профили"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._active = threading.Event()
+        self._captures = []
+        self._thread = None
+        self._pid = None
+
+    def add(self, capture: Capture) -> None:
+        with self._lock:
+            if self._pid != os.getpid():
+                # после fork поток родителя не существует
+                self._captures = []
+                self._thread = threading.Thread(target=self._run, name='profiling-sampler', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+            self._captures.append(capture)
+            self._active.set()
+
+    def remove(self, capture: Capture) -> None:
+        with self._lock:
+            if capture in self._captures:
+                self._captures.remove(capture)
+            if not self._captures:
+                self._active.clear()
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        while True:
+            self._active.wait()
+            time.sleep(settings.PROFILING_INTERVAL)
+            frames = sys._current_frames()
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = {}
+            with self._lock:
+                for capture in self._captures:
+                    for thread_id, frame in frames.items():
+                        if thread_id == own_id or capture.thread_id not in (None, thread_id):
+                            continue
+                        if thread_id not in stacks:
+                            stacks[thread_id] = get_stack(frame)
+                        stack, idle = stacks[thread_id]
+                        if capture.thread_id is None:
+                            if idle:
+                                capture.idle_samples += 1
+                                continue
+                            stack = f'thread:{names.get(thread_id, thread_id)};{stack}'
+                        capture.samples[stack] += 1
+            del frames
+
+
+_sampler = Sampler()
+
+
+@lru_cache(maxsize=8192)
+def get_frame_label(code) -> str:
+    """Кадр в виде path:line(function), путь относительно sys.path"""
+    filename = code.co_filename
+    for path in sorted(sys.path, key=len, reverse=True):
+        if path and filename.startswith(path + os.sep):
+            filename = filename[len(path) + 1:]
+            break
+    return f'{filename}:{code.co_firstlineno}({code.co_name})'
+
+
+def get_stack(frame) -> tuple:
+    """
+    Стек потока от внешнего кадра к внутреннему
+    :return: (str - кадры через ";", bool - поток ожидает работу)
+    """
+    labels = []
+    while frame is not None and len(labels) < MAX_STACK_DEPTH:
+        labels.append(get_frame_label(frame.f_code))
+        frame = frame.f_back
+    idle = bool(labels) and labels[0].split(':', 1)[0].endswith(IDLE_FRAMES)
+    return ';'.join(reversed(labels)), idle
+
+
+def is_forced(value: Optional[str]) -> bool:
+    """Значение заголовка X-Profile совпадает с PROFILING_TOKEN"""
+    return bool(settings.PROFILING_TOKEN and value) and hmac.compare_digest(value, settings.PROFILING_TOKEN)
+
+
+def start_profiling(kind: str, name: str, forced: bool = False, all_threads: bool = False) -> Optional[Capture]:
+    """
+    Начало профилирования обработки
+    :param kind: http или ws
+    :param name: путь запроса или обработчик consumer
+    :param forced: сохранить профиль независимо от времени обработки
+    :param all_threads: сэмплировать все потоки (асинхронная обработка)
+    :return: Capture or None, если профилирование выключено
+    """
+    if not (settings.PROFILING_ENABLED or forced):
+        return None
+    capture = Capture(kind, name, forced, all_threads)
+    _sampler.add(capture)
+    return capture
+
+
+def finish_profiling(capture: Capture) -> bool:
+    """
+    Остановка сэмплирования
+    :return: bool - профиль нужно сохранить
+    """
+    _sampler.remove(capture)
+    capture.duration = time.perf_counter() - capture.started
+    return capture.forced or capture.duration >= settings.PROFILING_SLOW_SECONDS
+
+
+def save_profile(capture: Capture, **meta) -> Optional[str]:
+    """
+    Запись профиля в PROFILING_DIR
+    :param capture: завершенный Capture
+    :param meta: метаданные запроса (метод, статус, пользователь, trace id)
+    :return: путь файла или None, если превышен PROFILING_MAX_FILES
+    """
+    os.makedirs(settings.PROFILING_DIR, exist_ok=True)
+    if len(os.listdir(settings.PROFILING_DIR)) >= settings.PROFILING_MAX_FILES:
+        logger.warning(f'profile of {capture.kind} {capture.name} skipped: PROFILING_MAX_FILES reached')
+        return None
+    started_at = time.strftime('%Y%m%d-%H%M%S', time.localtime(capture.started_at))
+    path = os.path.join(
+        settings.PROFILING_DIR, f'{capture.kind}-{started_at}-{os.getpid()}-{uuid.uuid4().hex[:8]}.json'
+    )
+    data = {
+        'kind': capture.kind,
+        'name': capture.name,
+        'forced': capture.forced,
+        'pid': os.getpid(),
+        'started_at': capture.started_at,
+        'duration': capture.duration,
+        'interval': settings.PROFILING_INTERVAL,
+        'all_threads': capture.thread_id is None,
+        'idle_samples': capture.idle_samples,
+        'meta': meta,
+        'samples': dict(capture.samples),
+    }
+    with open(path, 'w') as f:
+        json.dump(data, f)
+    logger.info(f'profile of {capture.kind} {capture.name} ({capture.duration * 1000:.0f}ms) saved to {path}')
+    return path
+
+
+def stop_profiling(capture: Optional[Capture], **meta) -> Optional[str]:
+    """
+    Завершение профилирования, профиль медленной или запрошенной обработки сохраняется
+    :return: путь файла или None
+    """
+    if capture is None or not finish_profiling(capture):
+        return None
+    return save_profile(capture, **meta)
+
+
+async def astop_profiling(capture: Optional[Capture], **meta) -> Optional[str]:
+    """Асинхронная версия stop_profiling, файл пишется в потоке"""
+    if capture is None or not finish_profiling(capture):
+        return None
+    return await sync_to_async(save_profile, thread_sensitive=False)(capture, **meta)
@@ -0,0 +1,27 @@
+"""
+Шардирование Redis по нескольким хостам: ключ (группа, пользователь, процесс) закрепляется за хостом
+рандеву-хешированием (highest random weight), при добавлении хоста переезжает только ~1/N ключей
+"""
+import hashlib
+from typing import Sequence
+
+
+def get_shard(key: str, shards: Sequence[str]) -> str:
+    """
+    Хост ключа: с наибольшим весом hash(хост, ключ)
+    :param key: ключ (имя группы, id пользователя)
+    :param shards: идентификаторы хостов
+    :return: str - идентификатор хоста
+    """
+    if len(shards) == 1:
+        return shards[0]
+    return max(shards, key=lambda shard: hashlib.blake2b(f'{shard}|{key}'.encode(), digest_size=8).digest())
+
+
+def get_host_id(host: dict) -> str:
+    """
+    Короткий id хоста Redis channels_redis (decode_hosts), допустим в имени канала и не меняется
+    при изменении списка хостов
+    """
+    address = host.get('address') or f'{host.get("host")}:{host.get("port")}'
+    return hashlib.blake2b(address.encode(), digest_size=4).hexdigest()
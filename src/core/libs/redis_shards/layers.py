@@ -0,0 +1,160 @@
+"""
+Channel layers channels_redis с шардированием по get_shard и решардингом без отключения сокетов.
+Канал процесса закреплен за хостом: id хоста - часть имени канала, отправители с любым списком хостов
+пишут в тот же хост, пока он есть в hosts или previous_hosts.
+previous_hosts - список хостов до решардинга, задается на время перезапуска процессов с новым hosts.
+Пока он задан, каналы закрепляются только за хостами из обоих списков - их знают процессы со старым и новым hosts
+"""
+import asyncio
+import time
+import uuid
+
+from channels.exceptions import ChannelFull
+from channels_redis.core import RedisChannelLayer
+from channels_redis.pubsub import RedisPubSubChannelLayer, RedisPubSubLoopLayer
+from channels_redis.utils import _wrap_close, decode_hosts
+from loguru import logger
+
+from core.libs.redis_shards import get_host_id, get_shard
+
+
+def get_hosts(hosts, previous_hosts) -> tuple:
+    """
+    :return: (все хосты для подключений - текущие и прежние, id текущих, id прежних, id хостов для новых каналов)
+    """
+    current = decode_hosts(hosts)
+    previous = decode_hosts(previous_hosts) if previous_hosts else []
+    current_ids = [get_host_id(host) for host in current]
+    previous_ids = [get_host_id(host) for host in previous]
+    extra = [host for host, host_id in zip(previous, previous_ids) if host_id not in current_ids]
+    stable_ids = [host_id for host_id in current_ids if host_id in previous_ids] if previous_ids else current_ids
+    return current + extra, current_ids, previous_ids, stable_ids or current_ids
+
+
+def get_channel_shard(channel: str) -> str:
+    """id хоста из имени канала процесса: specific.<prefix>.<id хоста>!... или specific.<uuid>.<id хоста>"""
+    return channel.split('!', 1)[0].rsplit('.', 1)[-1]
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    """
+    RedisChannelLayer: группа хранится на хосте get_shard(group, hosts). С previous_hosts участник
+    добавляется и на прежний хост группы, group_send рассылает участникам с обоих хостов
+    """
+
+    def __init__(self, hosts=None, previous_hosts=None, **kwargs):
+        hosts, self.current_shards, self.previous_shards, stable_shards = get_hosts(hosts, previous_hosts)
+        super().__init__(hosts=hosts, **kwargs)
+        self.host_indexes = {get_host_id(host): index for index, host in enumerate(self.hosts)}
+        self.client_prefix = f'{self.client_prefix}.{get_shard(self.client_prefix, stable_shards)}'
+
+    def consistent_hash(self, value):
+        if isinstance(value, bytes):
+            value = value.decode()
+        if '!' in value:
+            index = self.host_indexes.get(get_channel_shard(value))
+            if index is None:
+                raise ValueError(f'Хост канала {value} не задан в hosts и previous_hosts')
+            return index
+        return self.host_indexes[get_shard(value, self.current_shards)]
+
+    def get_group_indexes(self, group: str) -> list:
+        """Хост группы и прежний хост группы на время решардинга"""
+        indexes = [self.consistent_hash(group)]
+        if self.previous_shards:
+            previous = self.host_indexes[get_shard(group, self.previous_shards)]
+            if previous not in indexes:
+                indexes.append(previous)
+        return indexes
+
+    async def group_add(self, group, channel):
+        await super().group_add(group, channel)
+        group_key = self._group_key(group)
+        for index in self.get_group_indexes(group)[1:]:
+            connection = self.connection(index)
+            await connection.zadd(group_key, {channel: time.time()})
+            await connection.expire(group_key, self.group_expiry)
+
+    async def group_discard(self, group, channel):
+        await super().group_discard(group, channel)
+        for index in self.get_group_indexes(group)[1:]:
+            await self.connection(index).zrem(self._group_key(group), channel)
+
+    async def group_send(self, group, message):
+        indexes = self.get_group_indexes(group)
+        if len(indexes) == 1:
+            await super().group_send(group, message)
+            return
+
+        # решардинг: участники обоих хостов группы, отправка по каналу
+        group_key = self._group_key(group)
+        channel_names = set()
+        for index in indexes:
+            connection = self.connection(index)
+            await connection.zremrangebyscore(group_key, min=0, max=int(time.time()) - self.group_expiry)
+            channel_names.update(name.decode() for name in await connection.zrange(group_key, 0, -1))
+        results = await asyncio.gather(
+            *(self.send(channel, message) for channel in channel_names), return_exceptions=True
+        )
+        over_capacity = 0
+        for result in results:
+            if isinstance(result, ChannelFull):
+                over_capacity += 1
+            elif isinstance(result, BaseException):
+                raise result
+        if over_capacity:
+            logger.info(f'{over_capacity} of {len(channel_names)} channels over capacity in group {group}')
+
+
+class ShardedRedisPubSubLoopLayer(RedisPubSubLoopLayer):
+    """
+    Слой RedisPubSubChannelLayer одного event loop: процесс подписан на группу на всех хостах,
+    сообщение группы публикуется на один хост. Во время решардинга каналы и группы закрепляются
+    за хостами из обоих списков - на них подписаны процессы со старым и новым hosts
+    """
+
+    def __init__(self, hosts=None, previous_hosts=None, **kwargs):
+        hosts, self.current_shards, _, self.stable_shards = get_hosts(hosts, previous_hosts)
+        super().__init__(hosts=hosts, **kwargs)
+        self.shard_indexes = {get_host_id(host): index for index, host in enumerate(decode_hosts(hosts))}
+
+    def _get_shard(self, channel_or_group_name):
+        if '__group__' in channel_or_group_name:
+            shard = get_shard(channel_or_group_name, self.stable_shards)
+        else:
+            shard = get_channel_shard(channel_or_group_name)
+            if shard not in self.shard_indexes:
+                shard = get_shard(channel_or_group_name, self.current_shards)
+        return self._shards[self.shard_indexes[shard]]
+
+    async def new_channel(self, prefix='specific.'):
+        name = uuid.uuid4().hex
+        channel = f'{self.prefix}{prefix}{name}.{get_shard(name, self.stable_shards)}'
+        await self._subscribe_to_channel(channel)
+        return channel
+
+    async def group_add(self, group, channel):
+        await super().group_add(group, channel)
+        group_channel = self._get_group_channel_name(group)
+        await asyncio.gather(*(shard.subscribe(group_channel) for shard in self._shards))
+
+    async def group_discard(self, group, channel):
+        group_channel = self._get_group_channel_name(group)
+        subscribed = group_channel in self.groups
+        await super().group_discard(group, channel)
+        if subscribed and group_channel not in self.groups:
+            await asyncio.gather(*(shard.unsubscribe(group_channel) for shard in self._shards))
+
+
+class ShardedRedisPubSubChannelLayer(RedisPubSubChannelLayer):
+    """RedisPubSubChannelLayer со слоями ShardedRedisPubSubLoopLayer"""
+
+    def _get_layer(self):
+        loop = asyncio.get_running_loop()
+        try:
+            layer = self._layers[loop]
+        except KeyError:
+            layer = ShardedRedisPubSubLoopLayer(*self._args, **self._kwargs, channel_layer=self)
+            self._layers[loop] = layer
+            _wrap_close(self, loop)
+        return layer
@@ -0,0 +1,198 @@
+import hashlib
+import time
+from typing import Optional
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.urls import Resolver404, resolve
+
+from core.db_router import is_replica_configured, use_replica
+from core.libs import metrics, profiling
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def get_pin_key(request) -> Optional[str]:
+    """
+    Ключ закрепления за основной БД: по токену, пользователь до аутентификации в DRF неизвестен
+    :return: str or None
+    """
+    token = request.headers.get('Authorization')
+    if not token:
+        return None
+    return settings.DB_REPLICA_PIN_CACHE_KEY.format(token_hash=hashlib.sha1(token.encode()).hexdigest())
+
+
+def is_replica_view(request) -> bool:
+    try:
+        match = resolve(request.path_info)
+    except Resolver404:
+        return False
+    return getattr(getattr(match.func, 'view_class', None), 'read_replica', False)
+
+
+class ReadReplicaMiddleware:
+    """
+    GET/HEAD/OPTIONS view с read_replica = True читают с реплики.
+    После успешного изменяющего запроса токен на DB_REPLICA_PIN_SECONDS читает с основной БД
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not is_replica_configured():
+            return self.get_response(request)
+
+        pin_key = get_pin_key(request)
+        if request.method in SAFE_METHODS:
+            replica = is_replica_view(request) and not (pin_key and cache.get(pin_key))
+            with use_replica(replica):
+                return self.get_response(request)
+
+        response = self.get_response(request)
+        if pin_key and response.status_code < 400:
+            cache.set(pin_key, 1, timeout=settings.DB_REPLICA_PIN_SECONDS)
+        return response
+
+    async def __acall__(self, request):
+        if not is_replica_configured():
+            return await self.get_response(request)
+
+        pin_key = get_pin_key(request)
+        if request.method in SAFE_METHODS:
+            replica = is_replica_view(request) and not (pin_key and await cache.aget(pin_key))
+            with use_replica(replica):
+                return await self.get_response(request)
+
+        response = await self.get_response(request)
+        if pin_key and response.status_code < 400:
+            await cache.aset(pin_key, 1, timeout=settings.DB_REPLICA_PIN_SECONDS)
+        return response
+
+
+class MetricsMiddleware:
+    """
+    Время запроса, количество и время запросов в БД по view (маршруту URL), метрики пулов соединений.
+    Превышение бюджета запросов view (query_budget) и повторяющиеся запросы логируются.
+    trace id запроса (X-Trace-Id) передается в события WS, созданные во время запроса
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+        metrics.enable_query_observer()
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        started = time.perf_counter()
+        token, queries = metrics.start_request_queries()
+        trace_token, trace_id = metrics.start_trace(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.stop_request_queries(token)
+            metrics.stop_trace(trace_token)
+        self.observe(request, response, time.perf_counter() - started, queries, trace_id)
+        return response
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        token, queries = metrics.start_request_queries()
+        trace_token, trace_id = metrics.start_trace(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.stop_request_queries(token)
+            metrics.stop_trace(trace_token)
+        self.observe(request, response, time.perf_counter() - started, queries, trace_id)
+        return response
+
+    @staticmethod
+    def observe(request, response, duration: float, queries: dict, trace_id) -> None:
+        if trace_id:
+            response['X-Trace-Id'] = trace_id
+        match = request.resolver_match
+        view = match.route if match else 'unresolved'
+        # статистика запросов для core.libs.metrics.testing.assert_query_budget
+        response.db_queries = queries
+        metrics.check_query_budget(view, getattr(match.func, 'view_class', None) if match else None, queries)
+        metrics.HTTP_REQUEST_SECONDS.labels(
+            view=view, method=request.method, status=response.status_code
+        ).observe(duration)
+        metrics.HTTP_DB_QUERIES.labels(view=view).observe(queries['count'])
+        metrics.HTTP_DB_QUERY_SECONDS.labels(view=view).observe(queries['duration'])
+        metrics.observe_db_pools()
+
+
+class ProfilingMiddleware:
+    """
+    Профиль медленных запросов (PROFILING_ENABLED) и запросов с заголовком X-Profile: <PROFILING_TOKEN>,
+    профили сохраняются в PROFILING_DIR, сводка - команда profile_summary
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        capture = profiling.start_profiling(
+            'http', request.path, forced=profiling.is_forced(request.headers.get(profiling.PROFILE_HEADER))
+        )
+        if capture is None:
+            return self.get_response(request)
+        response = None
+        try:
+            response = self.get_response(request)
+        finally:
+            profiling.stop_profiling(capture, **self.get_meta(request, response))
+        return response
+
+    async def __acall__(self, request):
+        capture = profiling.start_profiling(
+            'http', request.path, forced=profiling.is_forced(request.headers.get(profiling.PROFILE_HEADER)),
+            all_threads=True
+        )
+        if capture is None:
+            return await self.get_response(request)
+        response = None
+        try:
+            response = await self.get_response(request)
+        finally:
+            await profiling.astop_profiling(capture, **self.get_meta(request, response))
+        return response
+
+    @staticmethod
+    def get_meta(request, response) -> dict:
+        match = request.resolver_match
+        queries = metrics.get_request_queries()
+        user = getattr(request, 'user', None)
+        return {
+            'method': request.method,
+            'path': request.get_full_path(),
+            'view': match.route if match else None,
+            'status': response.status_code if response is not None else None,
+            'user_id': user.pk if user is not None and user.is_authenticated else None,
+            'trace_id': metrics.get_trace_id(),
+            'db_queries': queries['count'] if queries else None,
+            'db_query_seconds': queries['duration'] if queries else None,
+        }
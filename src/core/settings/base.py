@@ -30,6 +30,8 @@ WSGI_APPLICATION = 'core.wsgi.application'
 ROOT_URLCONF = 'core.urls'
 
 MIDDLEWARE = [
+    'core.middleware.MetricsMiddleware',
+    'core.middleware.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     "corsheaders.middleware.CorsMiddleware",
@@ -38,6 +40,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'core.middleware.ReadReplicaMiddleware',
 ]
 
 TEMPLATES = [
@@ -75,6 +78,7 @@ AUTH_PASSWORD_VALIDATORS = [
 # region CORS headers
 CORS_ORIGIN_ALLOW_ALL = True
 CORS_ALLOW_CREDENTIALS = True
+CORS_EXPOSE_HEADERS = ('X-Chats-Version',)
 CSRF_TRUSTED_ORIGINS = os.getenv(
     'CSRF_TRUSTED_ORIGINS', 'http://localhost'
 ).split(' ')
@@ -84,16 +88,65 @@ CSRF_TRUSTED_ORIGINS = os.getenv(
 # region DATABASES
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        'ENGINE': 'core.libs.postgresql_pool',
         'NAME': os.getenv('DB_NAME'),
         'USER': os.getenv('DB_USER'),
         'PASSWORD': os.getenv('DB_PASSWORD'),
         'HOST': os.getenv('DB_HOST'),
         'PORT': os.getenv('DB_PORT'),
+        # соединение возвращается в пул в конце запроса и после database_sync_to_async
+        'CONN_MAX_AGE': 0,
+        'POOL': {
+            # размер пула на процесс, 0 - без пула
+            'MAX_SIZE': int(os.getenv('DB_POOL_MAX_SIZE', 4)),
+            # свободные соединения, которые не закрываются по MAX_IDLE
+            'MIN_SIZE': int(os.getenv('DB_POOL_MIN_SIZE', 1)),
+            # секунды ожидания свободного соединения
+            'TIMEOUT': float(os.getenv('DB_POOL_TIMEOUT', 10)),
+            'MAX_IDLE': int(os.getenv('DB_POOL_MAX_IDLE', 300)),
+            'MAX_LIFETIME': int(os.getenv('DB_POOL_MAX_LIFETIME', 3600)),
+            # соединение, простоявшее дольше, проверяется SELECT 1 перед выдачей
+            'CHECK_INTERVAL': int(os.getenv('DB_POOL_CHECK_INTERVAL', 30)),
+        },
     }
 }
+# реплика для чтения, используется view с read_replica = True
+DB_REPLICA_ALIAS = 'replica'
+if os.getenv('DB_REPLICA_HOST'):
+    DATABASES[DB_REPLICA_ALIAS] = {
+        **DATABASES['default'],
+        'HOST': os.getenv('DB_REPLICA_HOST'),
+        'PORT': os.getenv('DB_REPLICA_PORT', DATABASES['default']['PORT']),
+        'TEST': {'MIRROR': 'default'},
+    }
+DATABASE_ROUTERS = ['core.db_router.ReadReplicaRouter']
+DB_REPLICA_PIN_SECONDS = int(os.getenv('DB_REPLICA_PIN_SECONDS', 5))  # чтение с основной БД после записи
+DB_REPLICA_MAX_LAG = float(os.getenv('DB_REPLICA_MAX_LAG', 2))  # секунды, при большем отставании чтение с основной БД
+DB_REPLICA_LAG_CHECK_INTERVAL = 5  # секунды между проверками отставания реплики
+# запросов в БД за HTTP запрос, если у view не задан query_budget; превышение логируется
+DB_QUERY_BUDGET = int(os.getenv('DB_QUERY_BUDGET', 30))
+# одинаковый запрос за HTTP запрос столько раз и больше логируется как вероятный N+1
+DB_N_PLUS_ONE_THRESHOLD = int(os.getenv('DB_N_PLUS_ONE_THRESHOLD', 5))
 REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
 REDIS_PORT = os.getenv('REDIS_PORT', 6379)
+
+
+def get_redis_hosts(name: str, default: str = '') -> list:
+    """Хосты Redis из переменной окружения вида host:port,host:port"""
+    value = os.getenv(name, default)
+    return [(host, int(port)) for host, port in (item.strip().rsplit(':', 1) for item in value.split(',') if item)]
+
+
+# Redis по назначению, по умолчанию все - REDIS_HOST:REDIS_PORT.
+# Кэш (ключ KeyCloak, кэши ответов) - один хост
+CACHE_REDIS_HOST, CACHE_REDIS_PORT = get_redis_hosts('CACHE_REDIS_HOST', f'{REDIS_HOST}:{REDIS_PORT}')[0]
+# channel layer и присутствие (каналы пользователей) шардируются по хостам (core.libs.redis_shards).
+# Решардинг: *_PREVIOUS_HOSTS = прежний список, *_HOSTS = новый, перезапуск всех сервисов;
+# после перезапуска всех процессов ws - перезапуск без *_PREVIOUS_HOSTS
+CHANNEL_LAYER_REDIS_HOSTS = get_redis_hosts('CHANNEL_LAYER_REDIS_HOSTS', f'{REDIS_HOST}:{REDIS_PORT}')
+CHANNEL_LAYER_REDIS_PREVIOUS_HOSTS = get_redis_hosts('CHANNEL_LAYER_REDIS_PREVIOUS_HOSTS')
+PRESENCE_REDIS_HOSTS = get_redis_hosts('PRESENCE_REDIS_HOSTS', f'{REDIS_HOST}:{REDIS_PORT}')
+PRESENCE_REDIS_PREVIOUS_HOSTS = get_redis_hosts('PRESENCE_REDIS_PREVIOUS_HOSTS')
 # endregion
 
 # region CACHE
@@ -101,12 +154,28 @@ REDIS_PORT = os.getenv('REDIS_PORT', 6379)
 CACHES = {
     "default": {
         "BACKEND": "django.core.cache.backends.redis.RedisCache",
-        "LOCATION": f'redis://{REDIS_HOST}:{REDIS_PORT}/1',
+        "LOCATION": f'redis://{CACHE_REDIS_HOST}:{CACHE_REDIS_PORT}/1',
         "KEY_PREFIX": "lms_chat_cache"
-    }
+    },
+    # кэш на каждый хост присутствия, ключи совпадают с ключами default на том же хосте
+    **{
+        f'presence_{host}_{port}': {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": f'redis://{host}:{port}/1',
+            "KEY_PREFIX": "lms_chat_cache"
+        }
+        for host, port in PRESENCE_REDIS_HOSTS + PRESENCE_REDIS_PREVIOUS_HOSTS
+    },
 }
+PRESENCE_CACHES = [f'presence_{host}_{port}' for host, port in PRESENCE_REDIS_HOSTS]
+PRESENCE_PREVIOUS_CACHES = [f'presence_{host}_{port}' for host, port in PRESENCE_REDIS_PREVIOUS_HOSTS]
 USER_CHANNELS_CACHE_KEY = "user_channels_names_{user_id}"
-USER_CHANNELS_CACHE_TIMEOUT = 60
+# каналы пользователя в кэше, consumer обновляет их раз в WS_PRESENCE_REFRESH_SECONDS, пока сокет открыт;
+# истечение - только для каналов процесса ws, завершившегося без disconnect
+USER_CHANNELS_CACHE_TIMEOUT = int(os.getenv('USER_CHANNELS_CACHE_TIMEOUT', 60))
+CHAT_TOPICS_VERSION_CACHE_KEY = 'chat_topics_version'
+CHAT_TOPICS_VERSION_CHECK_INTERVAL = 5  # секунды между проверками версии карты права -> темы
+DB_REPLICA_PIN_CACHE_KEY = 'db_primary_pin_{token_hash}'
 # endregion
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
@@ -134,6 +203,8 @@ REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
     'PAGE_SIZE': 10
 }
+# асинхронные view нагруженных эндпоинтов, включается в ASGI процессе (app_async)
+API_ASYNC_VIEWS = os.getenv('API_ASYNC_VIEWS', 'False') == 'True'
 # endregion
 
 CKEDITOR_5_CONFIGS = {
@@ -149,29 +220,112 @@ CHAT_MESSAGE_FILE_MAX_SIZE = int(os.getenv('CHAT_MESSAGE_FILE_MAX_SIZE', 50))  #
 CHAT_MESSAGE_ALLOWED_FILE_EXTENSIONS = os.getenv(
     'CHAT_MESSAGE_ALLOWED_FILE_EXTENSIONS', 'xls,xlsx,doc,docx,pdf,jpg,png,pptx,mp4,avi,3gpp'
 ).split(',')
+CHAT_DELETE_BATCH_SIZE = int(os.getenv('CHAT_DELETE_BATCH_SIZE', 1000))  # сообщений за одну транзакцию
+CHAT_MESSAGES_PARTITIONS_AHEAD = int(os.getenv('CHAT_MESSAGES_PARTITIONS_AHEAD', 3))  # месяцев вперед
+CHAT_ARCHIVE_AFTER_DAYS = int(os.getenv('CHAT_ARCHIVE_AFTER_DAYS', 180))  # закрытые чаты старше уходят в архив
+CHAT_ARCHIVE_ROOT = os.getenv('CHAT_ARCHIVE_ROOT', BASE_DIR.joinpath('archive'))
+CHAT_ARCHIVE_CACHE_SIZE = int(os.getenv('CHAT_ARCHIVE_CACHE_SIZE', 32))  # разобранных архивов в памяти процесса
+# дельта списка чатов: версия старше RETENTION требует полного списка, изменения за OVERLAP секунд до версии
+# возвращаются повторно (больше отставания реплики), больше MAX_SIZE изменений - полный список
+CHAT_CHANGES_RETENTION_SECONDS = int(os.getenv('CHAT_CHANGES_RETENTION_SECONDS', 24 * 60 * 60))
+CHAT_CHANGES_OVERLAP_SECONDS = int(os.getenv('CHAT_CHANGES_OVERLAP_SECONDS', 10))
+CHAT_CHANGES_MAX_SIZE = int(os.getenv('CHAT_CHANGES_MAX_SIZE', 200))
+# endregion
+
+# region MEDIA
+MEDIA_X_ACCEL_REDIRECT_LOCATION = os.getenv('MEDIA_X_ACCEL_REDIRECT_LOCATION', '/protected-media/')
+CHAT_MESSAGE_FILE_CACHE_TIMEOUT = 60 * 60 * 24 * 365  # файл по хэшу не меняется
+FILE_DELETION_BATCH_SIZE = int(os.getenv('FILE_DELETION_BATCH_SIZE', 500))
+FILE_DELETION_INTERVAL = int(os.getenv('FILE_DELETION_INTERVAL', 10))  # секунды между проходами очереди
+# после стольких ошибок удаления (например, нет прав) запись остается в очереди, но не выбирается
+FILE_DELETION_MAX_ATTEMPTS = int(os.getenv('FILE_DELETION_MAX_ATTEMPTS', 5))
+ORPHAN_FILES_GRACE_PERIOD = 60 * 60  # секунды, файлы моложе не считаются сиротами (идет загрузка)
 # endregion
 
 
 # region CHANNELS_SETTINGS
 ASGI_APPLICATION = "core.asgi.application"
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
-        'CONFIG': {
-            'hosts': [(REDIS_HOST, REDIS_PORT), ]
+# queue - RedisChannelLayer: group_send записывает сообщение в канал каждого участника группы (O(сокетов) в Redis);
+# pubsub - RedisPubSubChannelLayer: процесс ws подписан на группу один раз и раздает сообщение своим сокетам
+# (O(процессов ws) в Redis), сообщения не буферизуются в Redis - при переподключении процесса к Redis теряются.
+# Режим должен совпадать во всех сервисах (app, app_async, ws)
+CHANNEL_LAYER_MODE = os.getenv('CHANNEL_LAYER_MODE', 'queue')
+if CHANNEL_LAYER_MODE == 'pubsub':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'core.libs.redis_shards.layers.ShardedRedisPubSubChannelLayer',
+            'CONFIG': {
+                'hosts': CHANNEL_LAYER_REDIS_HOSTS,
+                'previous_hosts': CHANNEL_LAYER_REDIS_PREVIOUS_HOSTS,
+            },
         },
-    },
-}
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'core.libs.redis_shards.layers.ShardedRedisChannelLayer',
+            'CONFIG': {
+                'hosts': CHANNEL_LAYER_REDIS_HOSTS,
+                'previous_hosts': CHANNEL_LAYER_REDIS_PREVIOUS_HOSTS,
+                # consumer сразу забирает события в исходящую очередь, в Redis копится только необработанное
+                'capacity': int(os.getenv('WS_CHANNEL_CAPACITY', 100)),
+            },
+        },
+    }
+# доля HTTP запросов, trace id которых передается в события WS
+WS_TRACE_SAMPLE_RATE = float(os.getenv('WS_TRACE_SAMPLE_RATE', 0.01))
+# запрос с заголовками X-Trace-Token: <WS_TRACE_TOKEN> и X-Trace-Id трассируется всегда с этим trace id,
+# пустой - X-Trace-Id не принимается
+WS_TRACE_TOKEN = os.getenv('WS_TRACE_TOKEN', '')
+WS_EVENT_SLOW_SECONDS = float(os.getenv('WS_EVENT_SLOW_SECONDS', 1))  # доставка дольше логируется
+# исходящая очередь сокета: событий максимум и порог, выше которого сокет считается медленным
+WS_SEND_QUEUE_MAX_SIZE = int(os.getenv('WS_SEND_QUEUE_MAX_SIZE', 1000))
+WS_SEND_QUEUE_HIGH_WATER = int(os.getenv('WS_SEND_QUEUE_HIGH_WATER', 200))
+# буфер записи сокета в transport daphne (ws/server.py), байт: выше порога события ждут в исходящей очереди
+WS_WRITE_BUFFER_HIGH_WATER = int(os.getenv('WS_WRITE_BUFFER_HIGH_WATER', 256 * 1024))
+WS_WRITE_BUFFER_POLL_SECONDS = 0.1  # проверка буфера записи, пока он выше порога
+# сокет дольше стольких секунд выше порога очереди или буфера записи (или с полной очередью) отключается с resync
+WS_SLOW_CONSUMER_SECONDS = float(os.getenv('WS_SLOW_CONSUMER_SECONDS', 10))
+WS_SLOW_CONSUMER_RECONNECT_SECONDS = 5  # подсказка клиенту в resync
+# присутствие обновляется раз в столько секунд на сокет, должно быть заметно меньше USER_CHANNELS_CACHE_TIMEOUT
+WS_PRESENCE_REFRESH_SECONDS = float(os.getenv('WS_PRESENCE_REFRESH_SECONDS', 20))
+# сокет без сообщений клиента (ping) дольше стольких секунд закрывается
+WS_IDLE_TIMEOUT_SECONDS = float(os.getenv('WS_IDLE_TIMEOUT_SECONDS', 90))
+# остановка процесса ws (ws/server.py): сокеты закрываются в случайный момент окна WS_DRAIN_SECONDS,
+# клиент переподключается через случайные 0..WS_DRAIN_RECONNECT_SECONDS; stop_grace_period контейнера больше
+# WS_DRAIN_SECONDS + 2 * WS_DRAIN_SEND_TIMEOUT_SECONDS
+WS_DRAIN_SECONDS = float(os.getenv('WS_DRAIN_SECONDS', 20))
+WS_DRAIN_RECONNECT_SECONDS = float(os.getenv('WS_DRAIN_RECONNECT_SECONDS', 3))
+WS_DRAIN_SEND_TIMEOUT_SECONDS = float(os.getenv('WS_DRAIN_SEND_TIMEOUT_SECONDS', 5))
+# срок действия токена ws_token из bootstrap, проверяется только при подключении
+WS_TOKEN_MAX_AGE_SECONDS = int(os.getenv('WS_TOKEN_MAX_AGE_SECONDS', 60))
+
+# endregion
 
+# region PROFILING
+# профилирование всех HTTP запросов и обработчиков WS, сохраняются профили медленнее PROFILING_SLOW_SECONDS
+PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', 'False') == 'True'
+# запрос с заголовком X-Profile: <PROFILING_TOKEN> профилируется и сохраняется всегда, пустой - выключено
+PROFILING_TOKEN = os.getenv('PROFILING_TOKEN', '')
+PROFILING_SLOW_SECONDS = float(os.getenv('PROFILING_SLOW_SECONDS', 1))
+PROFILING_INTERVAL = float(os.getenv('PROFILING_INTERVAL', 0.005))  # секунды между сэмплами стеков
+PROFILING_DIR = os.getenv('PROFILING_DIR', BASE_DIR.joinpath('profiles'))
+PROFILING_MAX_FILES = int(os.getenv('PROFILING_MAX_FILES', 1000))  # при превышении профили не пишутся
 # endregion
 
 # region KEYCLOAK_SETTINGS
 KEYCLOAK_SERVER_URL = os.getenv('KEYCLOAK_SERVER_URL')
 KEYCLOAK_CLIENT_ID = os.getenv('KEYCLOAK_CLIENT_ID')
 KEYCLOAK_PUBLIC_KEY = os.getenv('KEYCLOAK_PUBLIC_KEY')
+# файл с публичным ключом realm (PEM или base64), читается при первой проверке токена вместо запроса в KeyCloak
+KEYCLOAK_PUBLIC_KEY_FILE = os.getenv('KEYCLOAK_PUBLIC_KEY_FILE')
 KEYCLOAK_REALM_NAME = os.getenv('KEYCLOAK_REALM_NAME')
 KEYCLOAK_CLIENT_SECRET_KEY = os.getenv('KEYCLOAK_CLIENT_SECRET_KEY')
 
 KEYCLOAK_CLIENT_ROLE = os.getenv('KEYCLOAK_CLIENT_ROLE', 'chat_user')
 KEYCLOAK_CURATOR_ROLE = os.getenv('KEYCLOAK_CURATOR_ROLE', 'chat_manager')
+KEYCLOAK_TOKEN_CACHE_SIZE = int(os.getenv('KEYCLOAK_TOKEN_CACHE_SIZE', 10000))  # проверенных токенов в памяти процесса
+# стенд нагрузочного теста: токены с kid KEYCLOAK_TEST_KEY_ID проверяются этим ключом, в production не задавать
+KEYCLOAK_TEST_PUBLIC_KEY = os.getenv('KEYCLOAK_TEST_PUBLIC_KEY')
+KEYCLOAK_TEST_KEY_ID = 'crm-load-test'
 # endregion
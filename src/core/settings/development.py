@@ -9,6 +9,7 @@ ALLOWED_HOSTS = ['*']
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = Path(BASE_DIR).joinpath('media')
+MEDIA_X_ACCEL_REDIRECT = False  # отдача файлов чата через nginx
 STATIC_URL = '/static/'
 STATIC_ROOT = Path(BASE_DIR).joinpath('static')
 
@@ -8,6 +8,7 @@ ALLOWED_HOSTS = os.environ.get('ALLOWED_HOSTS').split(' ')
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = Path(BASE_DIR).joinpath('media')
+MEDIA_X_ACCEL_REDIRECT = True  # отдача файлов чата через nginx
 STATIC_URL = '/static/'
 STATIC_ROOT = Path(BASE_DIR).joinpath('static')
 
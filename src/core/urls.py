@@ -5,11 +5,14 @@ from django.contrib.auth.models import Group
 from django.urls import include, path, re_path
 
 from api.v1.docs.swagger_config import lms_scheme
+from core.views import health, metrics_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('ckeditor5/', include('django_ckeditor_5.urls')),
     path('api/', include('api.urls')),
+    path('health/', health),
+    path('metrics/', metrics_view),
 ]
 # SWAGGER
 urlpatterns += [
@@ -0,0 +1,25 @@
+from channels.layers import get_channel_layer
+from django.db import connection
+from django.http import HttpResponse, JsonResponse
+
+from core.libs import metrics
+from core.libs.postgresql_pool import get_pools_stats
+
+
+def health(request):
+    """
+    Проверка БД и метрики пула соединений процесса (занятые, свободные, ожидания, таймауты)
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1')
+    return JsonResponse({'status': 'ok', 'db_pools': get_pools_stats()})
+
+
+def metrics_view(request):
+    """
+    Метрики Prometheus процесса (app, app_async - всех воркеров gunicorn, ws)
+    """
+    metrics.observe_db_pools()
+    metrics.observe_channel_layer(get_channel_layer())
+    data, content_type = metrics.generate_metrics()
+    return HttpResponse(data, content_type=content_type)
@@ -0,0 +1,27 @@
+import multiprocessing
+import os
+import shutil
+
+wsgi_app = "core.asgi:application"
+worker_class = "uvicorn.workers.UvicornWorker"
+raw_env = ["API_ASYNC_VIEWS=True", "PROMETHEUS_MULTIPROC_DIR=/tmp/prometheus"]
+chdir = "/src/"
+bind = "0.0.0.0:8002"
+workers = multiprocessing.cpu_count()
+max_requests = 1000
+max_requests_jitter = 10
+timeout = 900
+
+
+def on_starting(server):
+    """Метрики прошлого запуска удаляются, каталог общий для воркеров"""
+    directory = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+
+def child_exit(server, worker):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -1,6 +1,9 @@
 import multiprocessing
+import os
+import shutil
 
 wsgi_app = "core.wsgi"
+raw_env = ["PROMETHEUS_MULTIPROC_DIR=/tmp/prometheus"]
 limit_request_line = 0
 chdir = "/src/"
 bind = "0.0.0.0:8000"
@@ -8,3 +11,17 @@ workers = multiprocessing.cpu_count() * 2 + 1
 max_requests = 1000
 max_requests_jitter = 10
 timeout = 900
+
+
+def on_starting(server):
+    """Метрики прошлого запуска удаляются, каталог общий для воркеров"""
+    directory = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+
+def child_exit(server, worker):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -1,45 +1,88 @@
+from urllib.parse import parse_qs
+
 from channels.db import database_sync_to_async
 from channels.middleware import BaseMiddleware
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
+from django.core import signing
 
-from apps.chat.models import ChatTopic
+from apps.chat.topics import get_permission_topics, get_user_topic_permissions
 from apps.users.models import User
-from core.libs.keycloak import get_keycloak_user_info
+from core.libs.keycloak import aget_keycloak_user_info
+
+WS_TOKEN_SALT = 'ws.auth.ws_token'
+
+
+def create_ws_token(user_id: int, topics: list) -> str:
+    """
+    Короткоживущий токен подключения к вебсокету (параметр ws_token) вместо токена KeyCloak:
+    подписан SECRET_KEY, действует WS_TOKEN_MAX_AGE_SECONDS, при подключении не проверяется в KeyCloak
+    :param user_id: id пользователя
+    :param topics: права пользователя, по которым есть темы (get_user_topic_permissions)
+    :return: str
+    """
+    return signing.dumps({'user_id': user_id, 'topics': topics}, salt=WS_TOKEN_SALT, compress=True)
 
 
 @database_sync_to_async
-def get_user(token) -> tuple:
+def get_user_and_topics(username: str, roles: list) -> tuple:
+    """
+    Запросы к БД вне цикла запроса Django: database_sync_to_async возвращает соединение в пул
+    :param username: логин пользователя
+    :param roles: роли пользователя из KeyCloak
+    :return: (User | None, list[str])
+    """
+    user = User.objects.filter(username=username).first()
+    return user, get_user_topic_permissions(roles, get_permission_topics())
+
+
+async def get_user(token) -> tuple:
     """
     Вернет пользователя по токену
     :param token: токен кейклока
     :return: User | None
     """
-    user_info = get_keycloak_user_info(token)
+    user_info = await aget_keycloak_user_info(token)
     if user_info:
-        user = User.objects.filter(username=user_info['username']).first()
-        user_topics = list(
-            ChatTopic.objects.filter(permission__in=user_info['roles']).values_list('permission', flat=True)
-        )
+        user, user_topics = await get_user_and_topics(user_info['username'], user_info['roles'])
     else:
         user = None
         user_topics = []
     return user, user_topics
 
 
+@database_sync_to_async
+def get_user_by_id(user_id: int):
+    return User.objects.filter(pk=user_id).first()
+
+
+async def get_ws_token_user(ws_token: str) -> tuple:
+    """
+    Вернет пользователя по токену create_ws_token
+    :param ws_token: токен
+    :return: (User | None, list[str])
+    """
+    try:
+        data = signing.loads(ws_token, salt=WS_TOKEN_SALT, max_age=settings.WS_TOKEN_MAX_AGE_SECONDS)
+    except signing.BadSignature:
+        return None, []
+    return await get_user_by_id(data['user_id']), data['topics']
+
+
 class TokenAuthMiddleware(BaseMiddleware):
     def __init__(self, inner):
         super().__init__(inner)
 
     async def __call__(self, scope, receive, send):
-        try:
-            token_key = (dict((x.split('=') for x in scope['query_string'].decode().split("&")))).get('token', None)
-        except ValueError:
-            token_key = None
-        if token_key:
+        query = parse_qs(scope['query_string'].decode())
+        ws_token = query.get('ws_token', [None])[0]
+        token_key = query.get('token', [None])[0]
+        if ws_token:
+            user, topics = await get_ws_token_user(ws_token)
+        elif token_key:
             user, topics = await get_user(token_key)
-            scope['user'] = AnonymousUser() if user is None else user
-            scope['topics'] = topics
         else:
-            scope['user'] = AnonymousUser()
-            scope['topics'] = []
+            user, topics = None, []
+        scope['user'] = AnonymousUser() if user is None else user
+        scope['topics'] = topics
         return await super().__call__(scope, receive, send)
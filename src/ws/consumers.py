@@ -1,21 +1,73 @@
+import asyncio
 import datetime
+import random
+import time
 
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
 from django.conf import settings
-from django.core.cache import cache
 from loguru import logger
 
+from apps.users import presence
 from apps.users.models import UserRole
+from core.libs.metrics import (
+    CHANNEL_LAYER_SECONDS, WS_CONNECTIONS, WS_DRAIN_DISCONNECTS, WS_EVENTS_DROPPED, WS_HANDLER_SECONDS,
+    WS_IDLE_DISCONNECTS, WS_SLOW_CONSUMER_EVICTIONS, observe_event_delivery, observe_event_relay
+)
+from core.libs.profiling import astop_profiling, is_forced, start_profiling
+from ws import drain
+from ws.outbox import SendQueue, get_write_buffer_getter
 
 CURATOR_GROUP_NAME = 'curators'
+# код закрытия сокета, не успевающего получать события, клиент переподключается после resync
+SLOW_CONSUMER_CLOSE_CODE = 4008
+# код закрытия сокета без сообщений клиента дольше WS_IDLE_TIMEOUT_SECONDS
+IDLE_CLOSE_CODE = 4009
+# код закрытия сокета при остановке процесса ws, клиент переподключается после reconnect
+DRAIN_CLOSE_CODE = 4010
 
 
 class WsChatConsumer(AsyncJsonWebsocketConsumer):
+    connected_role = None
+    # метка события из ws/utils.py, которое сейчас рассылает consumer отправителя
+    relay_trace = None
+    # при подключении передан заголовок X-Profile: <PROFILING_TOKEN>, профили обработчиков сохраняются всегда
+    profiling_forced = None
+    # исходящая очередь сокета и задача отправки из нее, создаются при подключении
+    send_queue = None
+    send_task = None
+    # с какого момента в очереди больше WS_SEND_QUEUE_HIGH_WATER событий
+    over_high_water_since = None
+    # размер буфера записи сокета от ws/server.py, None - сервер ASGI его не передает
+    write_buffer_size = None
+    # задача обновления присутствия и проверки простоя, time.monotonic() последнего сообщения клиента
+    heartbeat_task = None
+    last_received = None
+
+    async def dispatch(self, message):
+        trace = message.get('trace')
+        if trace is not None and not message['type'].startswith('send.'):
+            self.relay_trace = observe_event_relay(trace)
+        if self.profiling_forced is None:
+            self.profiling_forced = is_forced(dict(self.scope['headers']).get(b'x-profile', b'').decode())
+        capture = start_profiling('ws', message['type'], forced=self.profiling_forced, all_threads=True)
+        try:
+            with WS_HANDLER_SECONDS.labels(handler=message['type']).time():
+                await super().dispatch(message)
+        finally:
+            self.relay_trace = None
+            if capture is not None:
+                user = self.scope.get('user')
+                await astop_profiling(
+                    capture,
+                    user_id=user.pk if user is not None and user.is_authenticated else None,
+                    channel_name=self.channel_name,
+                    trace_id=trace['id'] if trace else None,
+                )
 
     async def connect(self):
         """Соединение с вебсокетом"""
         user = self.scope['user']
-        if user.is_anonymous:
+        if user.is_anonymous or drain.draining:
             await self.close()
         else:
             await self.update_user_status(is_connect=True)
@@ -24,8 +76,31 @@ class WsChatConsumer(AsyncJsonWebsocketConsumer):
                 for topic in self.scope['topics']:
                     await self.channel_layer.group_add(topic, self.channel_name)
             await self.accept()
+            self.send_queue = SendQueue(settings.WS_SEND_QUEUE_MAX_SIZE)
+            self.write_buffer_size = get_write_buffer_getter(self.scope)
+            self.send_task = asyncio.create_task(self._send_queued_events())
+            self.last_received = time.monotonic()
+            self.heartbeat_task = asyncio.create_task(self._heartbeat())
+            self.connected_role = user.role
+            WS_CONNECTIONS.labels(role=user.role).inc()
+            drain.consumers.add(self)
 
     async def disconnect(self, code):
+        try:
+            await self._disconnect()
+        finally:
+            drain.consumers.discard(self)
+
+    async def _disconnect(self):
+        if self.send_task is not None:
+            self.send_task.cancel()
+            self.send_task = None
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+            self.heartbeat_task = None
+        if self.connected_role is not None:
+            WS_CONNECTIONS.labels(role=self.connected_role).dec()
+            self.connected_role = None
         user = self.scope['user']
         if user.is_anonymous:
             pass
@@ -37,28 +112,156 @@ class WsChatConsumer(AsyncJsonWebsocketConsumer):
                     await self.channel_layer.group_discard(topic, self.channel_name)
 
     async def receive_json(self, content, **kwargs):
-        """Получение данных от клиента"""
+        """
+        Получение данных от клиента: любое сообщение продлевает соединение, на ping отправляется pong.
+        Присутствие в кэше обновляет _heartbeat, а не каждое сообщение
+        """
+        self.last_received = time.monotonic()
+        if isinstance(content, dict) and content.get('event_type') == 'ping':
+            await self.send_json({'event_type': 'pong', 'data': {}})
+
+    async def _heartbeat(self) -> None:
+        """
+        Раз в WS_PRESENCE_REFRESH_SECONDS (с разбросом, чтобы переподключившиеся разом сокеты не писали в кэш
+        одновременно) обновляет присутствие пользователя, сокет без сообщений клиента дольше
+        WS_IDLE_TIMEOUT_SECONDS закрывается
+        """
         try:
-            await self.update_user_connection()
-            await self.send_json(content)
+            while True:
+                await asyncio.sleep(settings.WS_PRESENCE_REFRESH_SECONDS * random.uniform(0.8, 1.2))
+                if time.monotonic() - self.last_received > settings.WS_IDLE_TIMEOUT_SECONDS:
+                    WS_IDLE_DISCONNECTS.labels(role=self.connected_role).inc()
+                    await self.close(code=IDLE_CLOSE_CODE)
+                    return
+                await self.update_user_connection()
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             logger.exception(e)
 
     async def send_event(self, event):
-        """Отправка события по вебсокету"""
+        """Событие для вебсокета ставится в исходящую очередь"""
+        if self.send_queue is None:
+            return
+        received = time.time()
         event_data = {
             'event_type': event['event_type'],
             'data': event['data']
         }
-        await self.send_json(event_data)
+        trace = event.get('trace')
+        if trace is not None and trace['id']:
+            event_data['trace_id'] = trace['id']
+        try:
+            if self.send_queue.put(event_data, trace, received):
+                WS_EVENTS_DROPPED.labels(event=event['event_type'], reason='coalesced').inc()
+        except asyncio.QueueFull:
+            await self._evict_slow_consumer()
+            return
+
+        if len(self.send_queue) <= settings.WS_SEND_QUEUE_HIGH_WATER:
+            self.over_high_water_since = None
+        elif self.over_high_water_since is None:
+            self.over_high_water_since = received
+        elif received - self.over_high_water_since > settings.WS_SLOW_CONSUMER_SECONDS:
+            await self._evict_slow_consumer()
+
+    async def _send_queued_events(self) -> None:
+        """Отправка событий исходящей очереди в сокет"""
+        send_queue = self.send_queue
+        try:
+            while True:
+                event_data, trace, received = await send_queue.get()
+                try:
+                    if not await self._wait_writable():
+                        return
+                    await self.send_json(event_data)
+                finally:
+                    send_queue.task_done()
+                if trace is not None:
+                    observe_event_delivery(trace, received)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception(e)
+
+    async def _wait_writable(self) -> bool:
+        """
+        Ждет, пока в буфере записи сокета не больше WS_WRITE_BUFFER_HIGH_WATER байт: до тех пор события копятся
+        в исходящей очереди, где замещаются и ограничены, а не в памяти transport. Сокет, буфер которого
+        не опускается до порога дольше WS_SLOW_CONSUMER_SECONDS, отключается
+        :return: bool - можно отправлять, False - сокет отключен как медленный
+        """
+        if self.write_buffer_size is None:
+            return True
+        since = None
+        while (self.write_buffer_size() or 0) > settings.WS_WRITE_BUFFER_HIGH_WATER:
+            now = time.time()
+            if since is None:
+                since = now
+            elif now - since > settings.WS_SLOW_CONSUMER_SECONDS:
+                await self._evict_slow_consumer()
+                return False
+            await asyncio.sleep(settings.WS_WRITE_BUFFER_POLL_SECONDS)
+        return True
+
+    async def _evict_slow_consumer(self) -> None:
+        """
+        Отключение сокета, который не успевает получать события (очередь или буфер записи выше порога):
+        очередь очищается, клиенту отправляется resync с временем первого недоставленного события
+        """
+        since = self.send_queue.oldest()
+        for event_type, count in self.send_queue.clear().items():
+            WS_EVENTS_DROPPED.labels(event=event_type, reason='slow_consumer').inc(count)
+        self.send_queue = None
+        if self.send_task is not asyncio.current_task():
+            self.send_task.cancel()
+        self.send_task = None
+        WS_SLOW_CONSUMER_EVICTIONS.labels(role=self.connected_role).inc()
+        logger.warning(f'ws slow consumer {self.channel_name} of user {self.scope["user"].id} disconnected')
+        await self.send_json({
+            'event_type': 'resync',
+            'data': {
+                'reason': 'slow_consumer',
+                'since': datetime.datetime.fromtimestamp(since or time.time(), datetime.timezone.utc).isoformat(),
+                'reconnect_after': settings.WS_SLOW_CONSUMER_RECONNECT_SECONDS,
+            }
+        })
+        await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+
+    async def drain(self, delay: float) -> None:
+        """
+        Закрытие сокета при остановке процесса ws: через delay секунд клиенту отправляется reconnect,
+        сокет закрывается после отправки исходящей очереди (не дольше WS_DRAIN_SEND_TIMEOUT_SECONDS)
+        :param delay: секунды до закрытия, у сокетов процесса разные
+        """
+        await asyncio.sleep(delay)
+        send_queue = self.send_queue
+        if send_queue is None:
+            return
+        # reconnect ставится и в полную очередь: сокет закрывается как остановленный, а не как медленный
+        send_queue.put({
+            'event_type': 'reconnect',
+            'data': {
+                'reason': 'shutdown',
+                'reconnect_after': round(random.uniform(0, settings.WS_DRAIN_RECONNECT_SECONDS), 1),
+            }
+        }, None, time.time(), force=True)
+        try:
+            await asyncio.wait_for(send_queue.join(), settings.WS_DRAIN_SEND_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning(f'ws drain: {self.channel_name} closed with {len(send_queue)} unsent events')
+        if self.send_queue is None:
+            # отключен как медленный, пока отправлялась очередь
+            return
+        WS_DRAIN_DISCONNECTS.labels(role=self.connected_role).inc()
+        await self.close(code=DRAIN_CLOSE_CODE)
 
     async def update_user_status(self, is_connect: bool):
         """
          Добавляет / Удаляет channel_name подключенного пользователя в кэше
         :param is_connect:
         """
-        user_key = settings.USER_CHANNELS_CACHE_KEY.format(user_id=self.scope['user'].id)
-        data = await cache.aget(user_key, dict())
+        data = await presence.aget_user_channels(self.scope['user'].id)
         if is_connect:
             data[self.channel_name] = int(datetime.datetime.now().timestamp())
             await self.send_status('online')
@@ -66,12 +269,12 @@ class WsChatConsumer(AsyncJsonWebsocketConsumer):
             data.pop(self.channel_name, None)
             if not data:
                 await self.send_status('offline')
-        await cache.aset(user_key, data, timeout=settings.USER_CHANNELS_CACHE_TIMEOUT)
+        await presence.aset_user_channels(self.scope['user'].id, data)
 
     async def send_status(self, event):
         """Событие обновления статуса пользователя"""
         status = event if isinstance(event, str) else event['status']
-        await self.channel_layer.group_send(
+        await self._group_send(
             CURATOR_GROUP_NAME,
             {
                 'type': 'send.event',
@@ -93,9 +296,9 @@ class WsChatConsumer(AsyncJsonWebsocketConsumer):
                 'chat_id': event['chat_id'],
             }
         }
-        await self.channel_layer.group_send(event['group_name'], ws_data)
+        await self._group_send(event['group_name'], ws_data)
         for channel_name in await self.get_user_channels(event['client_id']):
-            await self.channel_layer.send(channel_name, ws_data)
+            await self._channel_send(channel_name, ws_data)
 
     async def new_message(self, event):
         """событие новое сообщение"""
@@ -105,9 +308,9 @@ class WsChatConsumer(AsyncJsonWebsocketConsumer):
             'data': event['message_data']
         }
 
-        await self.channel_layer.group_send(event['group_name'], ws_data)
+        await self._group_send(event['group_name'], ws_data)
         for channel_name in await self.get_user_channels(event['client_id']):
-            await self.channel_layer.send(channel_name, ws_data)
+            await self._channel_send(channel_name, ws_data)
 
     async def update_message(self, event):
         """событие куратор обновил сообщение"""
@@ -117,9 +320,9 @@ class WsChatConsumer(AsyncJsonWebsocketConsumer):
             'data': event['message_data']
         }
 
-        await self.channel_layer.group_send(event['group_name'], ws_data)
+        await self._group_send(event['group_name'], ws_data)
         for channel_name in await self.get_user_channels(event['client_id']):
-            await self.channel_layer.send(channel_name, ws_data)
+            await self._channel_send(channel_name, ws_data)
 
     async def curator_delete_message(self, event):
         """событие куратор удалил сообщение"""
@@ -132,13 +335,13 @@ class WsChatConsumer(AsyncJsonWebsocketConsumer):
             }
         }
 
-        await self.channel_layer.group_send(event['group_name'], ws_data)
+        await self._group_send(event['group_name'], ws_data)
         for channel_name in await self.get_user_channels(event['client_id']):
-            await self.channel_layer.send(channel_name, ws_data)
+            await self._channel_send(channel_name, ws_data)
 
     async def assign_curator(self, event):
         """Назначение чата"""
-        await self.channel_layer.group_send(
+        await self._group_send(
             event['group_name'],
             {
                 'type': 'send.event',
@@ -161,10 +364,10 @@ class WsChatConsumer(AsyncJsonWebsocketConsumer):
             }
         }
 
-        await self.channel_layer.group_send(event['group_name'], ws_data)
+        await self._group_send(event['group_name'], ws_data)
 
         for channel_name in await self.get_user_channels(event['client_id']):
-            await self.channel_layer.send(channel_name, ws_data)
+            await self._channel_send(channel_name, ws_data)
 
     async def read_chat_message(self, event):
         """Прочитанное сообщение"""
@@ -178,10 +381,52 @@ class WsChatConsumer(AsyncJsonWebsocketConsumer):
             }
         }
         if self.scope['user'].role == UserRole.CLIENT:
-            await self.channel_layer.group_send(event['group_name'], ws_data)
+            await self._group_send(event['group_name'], ws_data)
         else:
             for channel_name in await self.get_user_channels(event['client_id']):
-                await self.channel_layer.send(channel_name, ws_data)
+                await self._channel_send(channel_name, ws_data)
+
+    async def chat_summary_changed(self, event):
+        """Строка чата в списке чатов: кураторам темы - в формате списка кураторов, клиенту - клиента"""
+        ws_data = {
+            'type': 'send.chat.summary',
+            'last_message_sender_id': event['last_message_sender_id'],
+            'unread_by_sender': event['unread_by_sender'],
+        }
+        await self._group_send(event['group_name'], {**ws_data, 'summary': event['curator_summary']})
+        for channel_name in await self.get_user_channels(event['client_id']):
+            await self._channel_send(channel_name, {**ws_data, 'summary': event['client_summary']})
+
+    async def send_chat_summary(self, event):
+        """Строка чата для пользователя сокета: свои непрочитанные и is_my_message последнего сообщения"""
+        user_id = self.scope['user'].id
+        unread_by_sender = event['unread_by_sender']
+        summary = {
+            **event['summary'],
+            'unread_messages_count': sum(unread_by_sender.values()) - unread_by_sender.get(str(user_id), 0),
+        }
+        if summary['last_message'] is not None:
+            summary['last_message'] = {
+                **summary['last_message'],
+                'is_my_message': event['last_message_sender_id'] == user_id,
+            }
+        await self.send_event({
+            'event_type': 'chat_summary_changed',
+            'data': summary,
+            'trace': event.get('trace'),
+        })
+
+    async def _group_send(self, group: str, message: dict) -> None:
+        if self.relay_trace is not None:
+            message['trace'] = self.relay_trace
+        with CHANNEL_LAYER_SECONDS.labels(operation='group_send').time():
+            await self.channel_layer.group_send(group, message)
+
+    async def _channel_send(self, channel_name: str, message: dict) -> None:
+        if self.relay_trace is not None:
+            message['trace'] = self.relay_trace
+        with CHANNEL_LAYER_SECONDS.labels(operation='send').time():
+            await self.channel_layer.send(channel_name, message)
 
     async def get_user_channels(self, user_id: int) -> list:
         """Получение каналов пользователя"""
@@ -191,11 +436,9 @@ class WsChatConsumer(AsyncJsonWebsocketConsumer):
     async def update_user_connection(self) -> None:
         connections = await self.get_user_connections(self.scope['user'].id)
         connections[self.channel_name] = int(datetime.datetime.now().timestamp())
-        cache_key = settings.USER_CHANNELS_CACHE_KEY.format(user_id=self.scope['user'].id)
-        await cache.aset(cache_key, connections, timeout=settings.USER_CHANNELS_CACHE_TIMEOUT)
+        await presence.aset_user_channels(self.scope['user'].id, connections)
 
     @staticmethod
     async def get_user_connections(user_id: int) -> dict:
         """Получение подключений пользователя"""
-        cache_key = settings.USER_CHANNELS_CACHE_KEY.format(user_id=user_id)
-        return await cache.aget(cache_key, dict())
+        return await presence.aget_user_channels(user_id)
@@ -0,0 +1,43 @@
+"""
+Остановка процесса ws без одновременного переподключения всех сокетов: после SIGTERM (ws/server.py)
+новые подключения не принимаются, каждому сокету в случайный момент окна WS_DRAIN_SECONDS отправляется
+событие reconnect, сокет закрывается после отправки его исходящей очереди. Процесс завершается,
+когда закрыты все сокеты
+"""
+import asyncio
+import random
+import time
+import weakref
+
+from django.conf import settings
+from loguru import logger
+
+# открытые сокеты процесса (WsChatConsumer)
+consumers = weakref.WeakSet()
+draining = False
+
+
+async def drain() -> None:
+    """Закрытие всех сокетов процесса, разнесенное по окну WS_DRAIN_SECONDS"""
+    global draining
+    draining = True
+    started = time.monotonic()
+    open_consumers = list(consumers)
+    logger.info(f'ws drain: {len(open_consumers)} sockets over {settings.WS_DRAIN_SECONDS}s')
+    tasks = [
+        asyncio.create_task(consumer.drain(random.uniform(0, settings.WS_DRAIN_SECONDS)))
+        for consumer in open_consumers
+    ]
+    if tasks:
+        _, pending = await asyncio.wait(
+            tasks, timeout=settings.WS_DRAIN_SECONDS + settings.WS_DRAIN_SEND_TIMEOUT_SECONDS
+        )
+        for task in pending:
+            task.cancel()
+    # disconnect закрытых сокетов: присутствие и группы
+    deadline = time.monotonic() + settings.WS_DRAIN_SEND_TIMEOUT_SECONDS
+    while consumers and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    logger.info(
+        f'ws drain finished in {time.monotonic() - started:.1f}s, {len(consumers)} sockets left'
+    )
@@ -0,0 +1,130 @@
+"""
+Исходящая очередь вебсокета: события из channel layer сразу забираются consumer и ждут отправки
+в сокет здесь, а не в канале Redis. Очередь ограничена WS_SEND_QUEUE_MAX_SIZE, событие состояния
+(статус пользователя, прочтение, статус чата, строка чата в списке) замещает неотправленное событие с тем же ключом.
+
+send daphne не ждет записи в сокет: данные клиента с медленной сетью копятся в буфере Twisted transport.
+ws/server.py передает consumer размер этого буфера (WRITE_BUFFER_EXTENSION), пока он выше
+WS_WRITE_BUFFER_HIGH_WATER, события ждут здесь
+"""
+import asyncio
+import itertools
+import time
+from collections import Counter, OrderedDict
+from typing import Callable, Optional
+
+# scope['extensions'][WRITE_BUFFER_EXTENSION]() - байты, ждущие записи в сокет
+WRITE_BUFFER_EXTENSION = 'crm.write_buffer_size'
+
+
+def get_coalesce_key(event_data: dict) -> Optional[tuple]:
+    """
+    Ключ замещения: новое событие с тем же ключом делает старое ненужным
+    :param event_data: {'event_type': str, 'data': dict}
+    :return: tuple or None - событие не замещается
+    """
+    event_type, data = event_data['event_type'], event_data['data']
+    if event_type == 'update_status':
+        return event_type, data['user_id']
+    if event_type == 'read_chat_message':
+        return event_type, data['chat_id'], data['user_id']
+    if event_type == 'update_chat_status':
+        return event_type, data['chat_id']
+    if event_type == 'chat_summary_changed':
+        return event_type, data['id']
+    return None
+
+
+def get_write_buffer_size(transport) -> Optional[int]:
+    """
+    Байты, ждущие записи в сокет в буфере Twisted transport, у TLS - в буфере транспорта под оберткой
+    :param transport: transport протокола daphne
+    :return: int or None - размер буфера неизвестен
+    """
+    while transport is not None and not hasattr(transport, 'dataBuffer'):
+        transport = getattr(transport, 'transport', None)
+    if transport is None:
+        return None
+    return len(transport.dataBuffer) - transport.offset + getattr(transport, '_tempDataLen', 0)
+
+
+def get_write_buffer_getter(scope: dict) -> Optional[Callable[[], Optional[int]]]:
+    """Функция размера буфера записи сокета из scope, None - сервер ASGI не передает размер"""
+    return scope.get('extensions', {}).get(WRITE_BUFFER_EXTENSION)
+
+
+class SendQueue:
+    """Ограниченная очередь событий одного сокета с замещением по get_coalesce_key"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._items = OrderedDict()  # key -> (event_data, trace, received, queued_at)
+        self._counter = itertools.count()
+        self._ready = asyncio.Event()
+        # события, взятые get и еще не отмеченные task_done
+        self._unfinished = 0
+        self._finished = asyncio.Event()
+        self._finished.set()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def put(self, event_data: dict, trace: Optional[dict], received: float, force: bool = False) -> bool:
+        """
+        Добавление события в конец очереди, неотправленное событие с тем же ключом удаляется
+        :param event_data: событие для send_json
+        :param trace: метка события для observe_event_delivery
+        :param received: time.time() получения события consumer
+        :param force: служебное событие (reconnect при остановке), ставится и в полную очередь
+        :return: bool - замещено неотправленное событие
+        :raises asyncio.QueueFull: в очереди max_size событий
+        """
+        key = get_coalesce_key(event_data)
+        coalesced = key is not None and self._items.pop(key, None) is not None
+        if not coalesced and not force and len(self._items) >= self.max_size:
+            raise asyncio.QueueFull
+        if key is None:
+            key = next(self._counter)
+        self._items[key] = (event_data, trace, received, time.time())
+        self._ready.set()
+        self._finished.clear()
+        return coalesced
+
+    async def get(self) -> tuple:
+        """
+        Первое событие очереди, ждет, пока очередь пуста
+        :return: (event_data, trace, received)
+        """
+        while not self._items:
+            self._ready.clear()
+            await self._ready.wait()
+        event_data, trace, received, _ = self._items.popitem(last=False)[1]
+        self._unfinished += 1
+        return event_data, trace, received
+
+    def task_done(self) -> None:
+        """Событие, взятое get, отправлено"""
+        self._unfinished -= 1
+        if not self._unfinished and not self._items:
+            self._finished.set()
+
+    async def join(self) -> None:
+        """Ждет, пока очередь пуста и все взятые get события отправлены"""
+        await self._finished.wait()
+
+    def oldest(self) -> Optional[float]:
+        """time.time() постановки в очередь самого старого неотправленного события"""
+        for item in self._items.values():
+            return item[3]
+        return None
+
+    def clear(self) -> Counter:
+        """
+        Очистка очереди
+        :return: Counter - количество удаленных событий по event_type
+        """
+        dropped = Counter(item[0]['event_type'] for item in self._items.values())
+        self._items.clear()
+        if not self._unfinished:
+            self._finished.set()
+        return dropped
@@ -1,9 +1,12 @@
 from rest_framework import serializers
 
+from api.v1.serializers import ChatMessageFileUrlField
 from apps.chat.models import ChatMessage, ChatMessageFile
 
 
 class WsChatMessageFileSerializer(serializers.ModelSerializer):
+    file = ChatMessageFileUrlField()
+
     class Meta:
         model = ChatMessageFile
         fields = (
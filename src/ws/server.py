@@ -0,0 +1,61 @@
+"""
+Запуск daphne с плавной остановкой по SIGTERM (ws/drain.py), аргументы те же, что у daphne:
+python -m ws.server -b 0.0.0.0 -p 8001 core.asgi:application
+"""
+import asyncio
+import signal
+
+from daphne.cli import CommandLineInterface
+from daphne.server import Server
+from loguru import logger
+from twisted.internet import reactor
+
+from ws import drain
+from ws.outbox import WRITE_BUFFER_EXTENSION, get_write_buffer_size
+
+
+class DrainingServer(Server):
+    """
+    Server daphne: по SIGTERM перестает слушать порты, закрывает сокеты через drain и останавливается.
+    Вебсокетам передает размер буфера записи transport для отключения медленных клиентов
+    """
+
+    def run(self):
+        self.ports = []
+        self.drain_task = None
+        reactor.callWhenRunning(self.install_drain)
+        super().run()
+
+    def create_application(self, protocol, scope):
+        if scope['type'] == 'websocket':
+            scope['extensions'] = {
+                **scope.get('extensions', {}),
+                WRITE_BUFFER_EXTENSION: lambda: get_write_buffer_size(protocol.transport),
+            }
+        return super().create_application(protocol, scope)
+
+    def listen_success(self, port):
+        self.ports.append(port)
+        super().listen_success(port)
+
+    def install_drain(self) -> None:
+        # обработчик Twisted останавливает reactor сразу, заменяется после его установки
+        loop = asyncio.get_event_loop()
+        loop.add_signal_handler(signal.SIGTERM, self.start_drain)
+
+    def start_drain(self) -> None:
+        if self.drain_task is not None:
+            return
+        logger.info('ws drain started by SIGTERM')
+        for port in self.ports:
+            port.stopListening()
+        self.drain_task = asyncio.ensure_future(drain.drain())
+        self.drain_task.add_done_callback(lambda task: self.stop())
+
+
+class DrainingCommandLineInterface(CommandLineInterface):
+    server_class = DrainingServer
+
+
+if __name__ == '__main__':
+    DrainingCommandLineInterface.entrypoint()
@@ -0,0 +1,80 @@
+"""
+Событие chat_summary_changed: строка чата в формате списка чатов (CuratorChatListSerializer для кураторов,
+ChatListSerializer для клиента), клиент обновляет список без запроса к API. Строки строятся один раз
+на изменение чата, consumer получателя подставляет свои unread_messages_count и last_message.is_my_message
+(WsChatConsumer.send_chat_summary) без запросов в БД
+"""
+from api.v1.client.serializers import ChatListSerializer
+from api.v1.curator.serializers import CuratorChatListSerializer
+from apps.chat.models import Chat, ChatMessage
+from apps.users.models import User
+from ws.consumers import CURATOR_GROUP_NAME
+from ws.utils import asend_event, drop_event, send_event
+
+
+def get_summary_chats(chat_id: int, user: User):
+    return Chat.objects.filter(pk=chat_id).select_related('topic', 'client', 'curator').annotate_messages(user)
+
+
+def get_summary_event(chat: Chat, unread_by_sender: dict, request, online_user_ids=None) -> dict:
+    """
+    Событие для consumer отправителя
+    :param chat: Chat из get_summary_chats с загруженным последним сообщением
+    :param unread_by_sender: {sender_id: count} из ChatMessage.objects.count_unread_by_sender
+    :param request: запрос, изменивший чат, для ссылок на файлы
+    :param online_user_ids: id пользователей онлайн, None - проверяется для каждого пользователя
+    :return: dict
+    """
+    chat.unread_messages_count = sum(unread_by_sender.values())
+    context = {'request': request}
+    if online_user_ids is not None:
+        context['online_user_ids'] = online_user_ids
+    last_message = chat.last_message
+    return {
+        'type': 'chat.summary.changed',
+        'group_name': chat.topic.permission if chat.topic else CURATOR_GROUP_NAME,
+        'client_id': chat.client_id,
+        'curator_summary': CuratorChatListSerializer(chat, context=context).data,
+        'client_summary': ChatListSerializer(chat, context=context).data,
+        'last_message_sender_id': last_message.sender_id if last_message else None,
+        # ключи строками: channel layer сериализует события msgpack
+        'unread_by_sender': {str(sender_id): count for sender_id, count in unread_by_sender.items()},
+    }
+
+
+def ws_event_chat_summary_changed(chat_id: int, user: User, request) -> None:
+    """
+    Отправка события изменения строки чата в списке чатов
+    :param chat_id: id чата
+    :param user: пользователь, изменивший чат
+    :param request: запрос, изменивший чат
+    """
+    channels = user.get_ws_channels()
+    if not channels:
+        drop_event('chat.summary.changed')
+        return
+    chat = get_summary_chats(chat_id, user).first()
+    if chat is None:
+        return
+    ChatMessage.objects.attach_last_messages([chat])
+    send_event(
+        channels[0],
+        get_summary_event(chat, ChatMessage.objects.count_unread_by_sender(chat), request)
+    )
+
+
+async def aws_event_chat_summary_changed(chat_id: int, user: User, request) -> None:
+    """Асинхронная версия ws_event_chat_summary_changed"""
+    channels = await user.aget_ws_channels()
+    if not channels:
+        drop_event('chat.summary.changed')
+        return
+    chat = await get_summary_chats(chat_id, user).afirst()
+    if chat is None:
+        return
+    await ChatMessage.objects.aattach_last_messages([chat])
+    online_user_ids = await User.objects.aget_online_ids({chat.client_id, chat.curator_id} - {None})
+    await asend_event(
+        channels[0],
+        get_summary_event(chat, await ChatMessage.objects.acount_unread_by_sender(chat), request, online_user_ids)
+    )
@@ -1,21 +1,53 @@
 from asgiref.sync import async_to_sync
+from channels.exceptions import ChannelFull
 from channels.layers import get_channel_layer
+from loguru import logger
 
 from apps.chat.models import Chat, ChatMessage
 from apps.users.models import User
+from core.libs.metrics import WS_EVENT_EMIT_SECONDS, WS_EVENTS_DROPPED, new_event_trace
 from ws.consumers import CURATOR_GROUP_NAME
 from ws.serializers import WsChatMessageEventSerializer
 
 
+def send_event(channel_name: str, message: dict) -> None:
+    """
+    Отправка события в канал отправителя, consumer рассылает его группе и получателям.
+    При переполненном канале событие отбрасывается
+    """
+    message['trace'] = new_event_trace(message['type'])
+    with WS_EVENT_EMIT_SECONDS.labels(event=message['type']).time():
+        try:
+            async_to_sync(get_channel_layer().send)(channel_name, message)
+        except ChannelFull:
+            WS_EVENTS_DROPPED.labels(event=message['type'], reason='channel_full').inc()
+            logger.warning(f'ws event {message["type"]} dropped: channel {channel_name} is full')
+
+
+async def asend_event(channel_name: str, message: dict) -> None:
+    """Асинхронная версия send_event"""
+    message['trace'] = new_event_trace(message['type'])
+    with WS_EVENT_EMIT_SECONDS.labels(event=message['type']).time():
+        try:
+            await get_channel_layer().send(channel_name, message)
+        except ChannelFull:
+            WS_EVENTS_DROPPED.labels(event=message['type'], reason='channel_full').inc()
+            logger.warning(f'ws event {message["type"]} dropped: channel {channel_name} is full')
+
+
+def drop_event(event: str) -> None:
+    """У отправителя нет открытого вебсокета, событие некому разослать"""
+    WS_EVENTS_DROPPED.labels(event=event, reason='no_sender_socket').inc()
+
+
 def ws_event_new_chat(chat: Chat, user: User) -> None:
     """
     Отправка события нового чата
     """
     channels = user.get_ws_channels()
     if channels:
-        channel_layer = get_channel_layer()
         group_name = chat.topic.permission if chat.topic else CURATOR_GROUP_NAME
-        async_to_sync(channel_layer.send)(
+        send_event(
             channels[0],
             {
                 'type': 'new.chat',
@@ -26,6 +58,8 @@ def ws_event_new_chat(chat: Chat, user: User) -> None:
                 'chat_type': chat.chat_type,
             }
         )
+    else:
+        drop_event('new.chat')
 
 
 def ws_event_new_message(chat_message: ChatMessage, user: User, request) -> None:
@@ -34,10 +68,30 @@ def ws_event_new_message(chat_message: ChatMessage, user: User, request) -> None
     """
     channels = user.get_ws_channels()
     if channels:
-        channel_layer = get_channel_layer()
         chat = chat_message.chat
         group_name = chat.topic.permission if chat.topic else CURATOR_GROUP_NAME
-        async_to_sync(channel_layer.send)(
+        send_event(
+            channels[0],
+            {
+                'type': 'new.message',
+                'message_data': WsChatMessageEventSerializer(chat_message, context={'request': request}).data,
+                'group_name': group_name,
+                'client_id': chat_message.chat.client_id,
+            }
+        )
+    else:
+        drop_event('new.message')
+
+
+async def aws_event_new_message(chat_message: ChatMessage, user: User, request) -> None:
+    """
+    Асинхронная версия ws_event_new_message, файлы сообщения должны быть загружены
+    """
+    channels = await user.aget_ws_channels()
+    if channels:
+        chat = chat_message.chat
+        group_name = chat.topic.permission if chat.topic else CURATOR_GROUP_NAME
+        await asend_event(
             channels[0],
             {
                 'type': 'new.message',
@@ -46,6 +100,8 @@ def ws_event_new_message(chat_message: ChatMessage, user: User, request) -> None
                 'client_id': chat_message.chat.client_id,
             }
         )
+    else:
+        drop_event('new.message')
 
 
 def ws_event_update_message(curator: User, chat_message: ChatMessage, request) -> None:
@@ -54,10 +110,9 @@ def ws_event_update_message(curator: User, chat_message: ChatMessage, request) -
     """
     channels = curator.get_ws_channels()
     if channels:
-        channel_layer = get_channel_layer()
         chat = chat_message.chat
         group_name = chat.topic.permission if chat.topic else CURATOR_GROUP_NAME
-        async_to_sync(channel_layer.send)(
+        send_event(
             channels[0],
             {
                 'type': 'update.message',
@@ -66,6 +121,8 @@ def ws_event_update_message(curator: User, chat_message: ChatMessage, request) -
                 'client_id': chat_message.chat.client_id,
             }
         )
+    else:
+        drop_event('update.message')
 
 
 def ws_event_delete_message(curator: User, chat: Chat, message_id: int, client_id: int):
@@ -75,9 +132,8 @@ def ws_event_delete_message(curator: User, chat: Chat, message_id: int, client_i
 
     channels = curator.get_ws_channels()
     if channels:
-        channel_layer = get_channel_layer()
         group_name = chat.topic.permission if chat.topic else CURATOR_GROUP_NAME
-        async_to_sync(channel_layer.send)(
+        send_event(
             channels[0],
             {
                 'type': 'curator.delete.message',
@@ -87,6 +143,8 @@ def ws_event_delete_message(curator: User, chat: Chat, message_id: int, client_i
                 'client_id': client_id,
             }
         )
+    else:
+        drop_event('curator.delete.message')
 
 
 def ws_event_assign_curator(chat: Chat, user: User) -> None:
@@ -95,8 +153,7 @@ def ws_event_assign_curator(chat: Chat, user: User) -> None:
     """
     channels = user.get_ws_channels()
     if channels:
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.send)(
+        send_event(
             channels[0],
             {
                 'type': 'assign.curator',
@@ -105,6 +162,8 @@ def ws_event_assign_curator(chat: Chat, user: User) -> None:
                 'group_name': chat.topic.permission,
             }
         )
+    else:
+        drop_event('assign.curator')
 
 
 def ws_update_chat_status(chat: Chat, user: User) -> None:
@@ -113,8 +172,7 @@ def ws_update_chat_status(chat: Chat, user: User) -> None:
     """
     channels = user.get_ws_channels()
     if channels:
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.send)(
+        send_event(
             channels[0],
             {
                 'type': 'update.chat.status',
@@ -124,14 +182,15 @@ def ws_update_chat_status(chat: Chat, user: User) -> None:
                 'client_id': chat.client_id,
             }
         )
+    else:
+        drop_event('update.chat.status')
 
 
 def ws_read_chat_message(chat: Chat, user: User, message_id: int) -> None:
     channels = user.get_ws_channels()
     if channels:
-        channel_layer = get_channel_layer()
         group_name = chat.topic.permission if chat.topic else CURATOR_GROUP_NAME
-        async_to_sync(channel_layer.send)(
+        send_event(
             channels[0],
             {
                 'type': 'read.chat.message',
@@ -142,3 +201,5 @@ def ws_read_chat_message(chat: Chat, user: User, message_id: int) -> None:
                 'user_id': user.pk,
             }
         )
+    else:
+        drop_event('read.chat.message')